@@ -20,6 +20,15 @@ setup(
             'ipdb==0.11',
             'pylint',
             'nose'
+        ],
+        'async': [
+            'aiohttp==3.14.5'
+        ],
+        'orjson': [
+            'orjson==3.8.3'
+        ],
+        'arrow': [
+            'pyarrow==16.1.0'
         ]
     },
     entry_points="""
@@ -28,7 +37,8 @@ setup(
     """,
     packages=["tap_google_analytics"],
     package_data = {
-        "tap_google_analytics": ["tap_google_analytics/ga_cubes.json"]
+        "tap_google_analytics": ["tap_google_analytics/ga_cubes.json",
+                                 "tap_google_analytics/ga_cubes_index.json"]
     },
     include_package_data=True,
 )
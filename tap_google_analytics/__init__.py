@@ -1,5 +1,5 @@
-import functools
 import itertools
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 
 import singer
@@ -7,7 +7,8 @@ from singer import utils, get_bookmark, metadata
 from singer.catalog import write_catalog, Catalog
 from .client import Client
 from .discover import discover
-from .sync import sync_report
+from .planner import plan_report_queries
+from .sync import sync_report_streams, get_transform_pool, OUTPUT_LOCK
 
 LOGGER = singer.get_logger()
 
@@ -55,71 +56,151 @@ def get_end_date(config):
 def get_view_ids(config):
     return config.get('view_ids') or [config.get('view_id')]
 
-def do_sync(client, config, catalog, state):
+def get_view_ids_to_sync(state, tap_stream_id, view_ids):
     """
-    Translate metadata into a set of metrics and dimensions and call out
-    to sync to generate the required reports.
+    Returns the view_ids that still need to be synced for the stream,
+    skipping views marked `sync_complete` by a previous, interrupted sync.
+
+    State written by versions that tracked a single
+    `currently_syncing_view` is resumed by dropping all views before it.
     """
-    selected_streams = catalog.get_selected_streams(state)
-    for stream in selected_streams:
-        # Transform state for this report to new format before proceeding
-        state = clean_state_for_report(config, state, stream.tap_stream_id)
+    current_view = state.pop('currently_syncing_view', None)
+    if current_view in view_ids:
+        view_ids = list(itertools.dropwhile(lambda v: v != current_view, view_ids))
+    return [view_id for view_id in view_ids
+            if not get_bookmark(state, tap_stream_id, view_id, default={}).get('sync_complete')]
+
+def mark_view_complete(state, tap_stream_id, view_id):
+    bookmark = get_bookmark(state, tap_stream_id, view_id, default={})
+    return singer.write_bookmark(state, tap_stream_id, view_id, {**bookmark, 'sync_complete': True})
+
+def clear_view_markers(state, tap_stream_id, view_ids):
+    for view_id in view_ids:
+        bookmark = get_bookmark(state, tap_stream_id, view_id, default={})
+        bookmark.pop('sync_complete', None)
+        if not bookmark:
+            state = singer.clear_bookmark(state, tap_stream_id, view_id)
+    return state
+
+def sync_view(client, config, report, end_date, state, transform_pool=None):
+    for stream in report['streams']:
+        stream['start_date'] = get_start_date(config, report['profile_id'], state, stream['id'])
 
-        state = singer.set_currently_syncing(state, stream.tap_stream_id)
+    sync_report_streams(client, report, end_date, state, config, transform_pool)
+
+    with OUTPUT_LOCK:
+        for stream in report['streams']:
+            mark_view_complete(state, stream['id'], report['profile_id'])
         singer.write_state(state)
 
-        metrics = []
-        dimensions = []
-        mdata = metadata.to_map(stream.metadata)
-        for field_path, field_mdata in mdata.items():
-            if field_path == tuple():
-                continue
-            if field_mdata.get('inclusion') == 'unsupported':
-                continue
-            _, field_name = field_path
-            if field_mdata.get('behavior'):
-                if field_mdata.get('behavior') == 'METRIC':
-                    metrics.append(field_name)
-                elif field_mdata.get('behavior') == 'DIMENSION':
-                    dimensions.append(field_name)
+def get_report_stream(stream):
+    """
+    Translate a catalog entry's metadata into the metrics and dimensions to
+    request, along with the cubes that support all of them.
+    """
+    metrics = []
+    dimensions = []
+    cubes = None
+    mdata = metadata.to_map(stream.metadata)
+    for field_path, field_mdata in mdata.items():
+        if field_path == tuple():
+            continue
+        if field_mdata.get('inclusion') == 'unsupported':
+            continue
+        _, field_name = field_path
+        if field_mdata.get('behavior'):
+            if field_mdata.get('behavior') == 'METRIC':
+                metrics.append(field_name)
+            elif field_mdata.get('behavior') == 'DIMENSION':
+                dimensions.append(field_name)
+            field_cubes = set(field_mdata.get('tap_google_analytics.cubes') or [])
+            cubes = field_cubes if cubes is None else cubes & field_cubes
+
+    return {"tap_stream_id": stream.tap_stream_id,
+            "stream": stream.stream,
+            "schema": stream.schema.to_dict(),
+            "key_properties": stream.key_properties,
+            "metrics": metrics,
+            "dimensions": dimensions,
+            "cubes": cubes}
 
-        view_ids = get_view_ids(config)
+def do_sync(client, config, catalog, state):
+    """
+    Translate metadata into a set of metrics and dimensions and call out
+    to sync to generate the required reports.
 
-        # NB: Resume from previous view for this report, dropping all
-        # views before it to keep streams moving forward
-        current_view = state.get('currently_syncing_view')
-        if current_view:
-            if current_view in view_ids:
-                view_not_current = functools.partial(lambda cv, v: v != cv, current_view)
-                view_ids = list(itertools.dropwhile(view_not_current, view_ids))
-            else:
-                state.pop('currently_syncing_view', None)
-
-        reports_per_view = [{"profile_id": view_id,
-                             "name": stream.stream,
-                             "id": stream.tap_stream_id,
-                             "metrics": metrics,
-                             "dimensions": dimensions}
-                            for view_id in view_ids]
+    If `merge_streams` is set in config, streams selecting the same
+    dimensions are synced together from a single query.
 
-        end_date = get_end_date(config)
+    If `transform_processes` is set in config, one pool of that many
+    processes is shared by all queries and views (see `get_transform_pool`).
+    """
+    transform_pool = get_transform_pool(config)
+    try:
+        sync_queries(client, config, catalog, state, transform_pool)
+    finally:
+        if transform_pool:
+            transform_pool.shutdown()
+
+def sync_queries(client, config, catalog, state, transform_pool=None):
+    report_streams = [get_report_stream(stream) for stream in catalog.get_selected_streams(state)]
+    if config.get('merge_streams'):
+        queries = plan_report_queries(report_streams)
+    else:
+        queries = [{"metrics": s["metrics"], "dimensions": s["dimensions"], "streams": [s]}
+                   for s in report_streams]
 
-        schema = stream.schema.to_dict()
+    for query in queries:
+        query_streams = query["streams"]
+        for stream in query_streams:
+            # Transform state for this report to new format before proceeding
+            state = clean_state_for_report(config, state, stream["tap_stream_id"])
 
-        singer.write_schema(
-            stream.stream,
-            schema,
-            stream.key_properties
-        )
+        state = singer.set_currently_syncing(state, query_streams[0]["tap_stream_id"])
+        singer.write_state(state)
 
-        for report in reports_per_view:
-            state['currently_syncing_view'] = report['profile_id']
-            singer.write_state(state)
+        view_ids = get_view_ids(config)
 
-            start_date = get_start_date(config, report['profile_id'], state, report['id'])
+        # NB: Resume this report by skipping the views completed before
+        # the interruption, to keep streams moving forward
+        view_ids_to_sync = {stream["tap_stream_id"]: get_view_ids_to_sync(state, stream["tap_stream_id"], view_ids)
+                            for stream in query_streams}
+        reports_per_view = []
+        for view_id in view_ids:
+            streams_for_view = [{"name": stream["stream"],
+                                 "id": stream["tap_stream_id"],
+                                 "schema": stream["schema"],
+                                 "metrics": stream["metrics"]}
+                                for stream in query_streams
+                                if view_id in view_ids_to_sync[stream["tap_stream_id"]]]
+            if streams_for_view:
+                reports_per_view.append({"profile_id": view_id,
+                                         "name": query_streams[0]["stream"],
+                                         "metrics": query["metrics"],
+                                         "dimensions": query["dimensions"],
+                                         "streams": streams_for_view})
+
+        end_date = get_end_date(config)
 
-            sync_report(client, schema, report, start_date, end_date, state)
-        state.pop('currently_syncing_view', None)
+        for stream in query_streams:
+            singer.write_schema(
+                stream["stream"],
+                stream["schema"],
+                stream["key_properties"]
+            )
+
+        max_workers = int(config.get('view_workers', 1))
+        if max_workers <= 1:
+            for report in reports_per_view:
+                sync_view(client, config, report, end_date, state, transform_pool)
+        else:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [executor.submit(sync_view, client, config, report, end_date, state, transform_pool)
+                           for report in reports_per_view]
+                for future in futures:
+                    future.result()
+        for stream in query_streams:
+            state = clear_view_markers(state, stream["tap_stream_id"], view_ids)
         singer.write_state(state)
     state = singer.set_currently_syncing(state, None)
     singer.write_state(state)
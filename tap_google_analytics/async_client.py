@@ -0,0 +1,280 @@
+import asyncio
+import json
+from collections import defaultdict
+import singer
+import backoff
+
+from .client import (BaseClient,
+                     get_api_family,
+                     get_view_id,
+                     should_giveup,
+                     raise_for_client_error,
+                     account_summaries_to_profiles,
+                     get_day_report_request,
+                     get_local_raw_cubes,
+                     ReportBatches,
+                     MAX_CONCURRENT_REQUESTS_PER_VIEW,
+                     TOKEN_URL,
+                     REPORTS_URL,
+                     FIELD_METADATA_URL,
+                     RAW_CUBES_URL,
+                     ACCOUNTS_URL,
+                     ACCOUNT_SUMMARIES_URL,
+                     ACCOUNT_SUMMARIES_PAGE_SIZE,
+                     WEB_PROPERTIES_URL,
+                     PROFILES_URL,
+                     GOALS_URL,
+                     CUSTOM_METRICS_URL,
+                     CUSTOM_DIMENSIONS_URL)
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+LOGGER = singer.get_logger()
+
+# NB: Errors with a response, including the token endpoint's, are raised
+# as `AsyncResponseError` to be classified by `should_giveup`
+RETRYABLE_TRANSPORT_ERRORS = (aiohttp.ClientConnectionError, asyncio.TimeoutError) if aiohttp else ()
+MAX_TRIES = 10
+
+class BufferedResponse():
+    """
+    A fully read aiohttp response, exposing the parts of the
+    `requests.Response` interface used by the retry classification in
+    `client.py`.
+    """
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+class AsyncResponseError(Exception):
+    def __init__(self, response):
+        super().__init__("{} Error for response: {}".format(response.status_code, response.content[:200]))
+        self.response = response
+
+def should_giveup_async(e):
+    # NB: Transport errors have no response to classify, and are always retried
+    if isinstance(e, AsyncResponseError):
+        return should_giveup(e)
+    return False
+
+
+class AsyncClient(BaseClient):
+    """
+    An asyncio version of `Client`, backed by aiohttp, for keeping many
+    requests in flight on a single thread.
+
+    Must be used as an async context manager, which opens the HTTP session
+    and populates the profile lookup:
+
+        async with AsyncClient(config) as client:
+            async for report in client.get_report(...):
+                ...
+
+    NB: This is for use as a library; the tap's own discovery and sync
+    use `Client`.
+    """
+    def __init__(self, config):
+        if aiohttp is None:
+            raise Exception("AsyncClient requires aiohttp, install it with `pip install tap-google-analytics[async]`")
+        super().__init__(config)
+        self.session = None
+        self.__token_lock = None
+        self.__view_semaphores = defaultdict(lambda: asyncio.Semaphore(MAX_CONCURRENT_REQUESTS_PER_VIEW))
+
+    async def __aenter__(self):
+        headers = {"User-Agent": self.user_agent} if self.user_agent else None
+        self.session = aiohttp.ClientSession(headers=headers)
+        # NB: Created here so that it belongs to the running event loop
+        self.__token_lock = asyncio.Lock()
+        try:
+            await self.populate_profile_lookup()
+        except BaseException:
+            await self.session.close()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.session.close()
+
+    async def populate_profile_lookup(self):
+        """
+        Get all profiles available and associate them with their web property
+        and account IDs to be looked up later during discovery, from the
+        token's account summaries (see `Client.get_account_summaries`).
+
+        NB: The lookup is filled once, so account summaries are always
+        requested rather than read from the `management_cache`, which could
+        miss views added since.
+        """
+        start_index = 1
+        while True:
+            account_summaries = await self.get_management_json(ACCOUNT_SUMMARIES_URL,
+                                                               params={"start-index": start_index,
+                                                                       "max-results": ACCOUNT_SUMMARIES_PAGE_SIZE},
+                                                               use_cache=False)
+            self.profile_lookup.update(account_summaries_to_profiles(account_summaries))
+            items = account_summaries.get('items', [])
+            if not account_summaries.get('nextLink') or not items:
+                return
+            start_index += len(items)
+
+    async def _ensure_access_token(self):
+        async with self.__token_lock:
+            if self._access_token_is_valid():
+                return
+
+            async with self.session.post(TOKEN_URL, data=self._access_token_request_payload()) as token_response:
+                buffered_response = BufferedResponse(token_response.status, await token_response.read())
+
+            if buffered_response.status_code >= 400:
+                raise AsyncResponseError(buffered_response)
+
+            self._update_access_token(buffered_response.json())
+
+    async def _make_request(self, method, url, params=None, data=None):
+        """
+        Retries with the same policy as `Client._make_request`. Written out
+        rather than with `backoff.on_exception`, as the pinned backoff's
+        coroutine support does not run on newer Pythons.
+        """
+        wait_gen = backoff.expo(factor=4)
+        tries = 0
+        while True:
+            tries += 1
+            try:
+                return await self._send_request(method, url, params=params, data=data)
+            except (AsyncResponseError,) + RETRYABLE_TRANSPORT_ERRORS as ex:
+                if tries >= MAX_TRIES or should_giveup_async(ex):
+                    raise
+                wait = next(wait_gen)
+                LOGGER.info("Backing off %s(...) for %.1fs (%s)", method, wait, ex)
+                await asyncio.sleep(wait)
+
+    async def _send_request(self, method, url, params=None, data=None):
+        data = data or {}
+
+        await self._ensure_access_token()
+
+        headers, params = self._request_headers_and_params(params)
+
+        delay = self.quota_limiter.reserve(get_api_family(url), get_view_id(data))
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        request_kwargs = {"headers": headers, "params": params}
+        if method == 'POST':
+            request_kwargs["json"] = data
+        async with self.session.request(method, url, **request_kwargs) as response:
+            buffered_response = BufferedResponse(response.status, await response.read())
+
+        raise_for_client_error(buffered_response)
+
+        if buffered_response.status_code >= 400:
+            raise AsyncResponseError(buffered_response)
+
+        return buffered_response
+
+    async def get(self, url, params=None):
+        return await self._make_request("GET", url, params=params)
+
+    async def post(self, url, data=None):
+        return await self._make_request("POST", url, data=data)
+
+    async def get_management_json(self, url, params=None, use_cache=True):
+        """ Async version of `Client.get_management_json`. """
+        if self.management_cache and use_cache:
+            cached_json = self.management_cache.get(url, params)
+            if cached_json is not None:
+                return cached_json
+        response_json = (await self.get(url, params=dict(params) if params else None)).json()
+        if self.management_cache:
+            self.management_cache.put(url, params, response_json)
+        return response_json
+
+    # Discovery requests
+
+    async def get_field_metadata(self):
+        metadata_response = await self.get(FIELD_METADATA_URL)
+        return metadata_response.json()
+
+    async def get_raw_cubes(self):
+        try:
+            return (await self.get(RAW_CUBES_URL)).json()
+        except Exception as ex:
+            LOGGER.warning("Error fetching raw cubes, falling back to local copy. Exception message: %s", ex)
+            return get_local_raw_cubes()
+
+    async def get_accounts_for_token(self):
+        accounts_json = await self.get_management_json(ACCOUNTS_URL)
+        return [i['id'] for i in accounts_json['items']]
+
+    async def get_web_properties_for_account(self, account_id):
+        webprops_json = await self.get_management_json(WEB_PROPERTIES_URL.format(accountId=account_id))
+        return [w['id'] for w in webprops_json['items']]
+
+    async def get_profiles_for_property(self, account_id, web_property_id):
+        profiles_json = await self.get_management_json(PROFILES_URL.format(accountId=account_id,
+                                                                           webPropertyId=web_property_id))
+        return [p["id"] for p in profiles_json['items']]
+
+    async def get_goals_for_profile(self, profile_id):
+        return await self.get_goals(self.profile_lookup[profile_id]["account_id"],
+                                    self.profile_lookup[profile_id]["web_property_id"],
+                                    profile_id)
+
+    async def get_goals(self, account_id, web_property_id, profile_id):
+        goals_json = await self.get_management_json(GOALS_URL.format(accountId=account_id,
+                                                                     webPropertyId=web_property_id,
+                                                                     profileId=profile_id))
+        return [g["id"] for g in goals_json['items']]
+
+    async def get_custom_metrics_for_profile(self, profile_id):
+        return await self.get_custom_metrics(self.profile_lookup[profile_id]["account_id"],
+                                             self.profile_lookup[profile_id]["web_property_id"])
+
+    async def get_custom_metrics(self, account_id, web_property_id):
+        return await self.get_management_json(CUSTOM_METRICS_URL.format(accountId=account_id,
+                                                                        webPropertyId=web_property_id))
+
+    async def get_custom_dimensions_for_profile(self, profile_id):
+        return await self.get_custom_dimensions(self.profile_lookup[profile_id]["account_id"],
+                                                self.profile_lookup[profile_id]["web_property_id"])
+
+    async def get_custom_dimensions(self, account_id, web_property_id):
+        return await self.get_management_json(CUSTOM_DIMENSIONS_URL.format(accountId=account_id,
+                                                                           webPropertyId=web_property_id))
+
+    # Sync Requests w/ Pagination and token refresh
+
+    async def get_report(self, name, profile_id, report_date, metrics, dimensions):
+        """
+        Async generator version of `Client.get_report`.
+        """
+        async for _, report in self.get_reports(name, [get_day_report_request(profile_id, report_date,
+                                                                               metrics, dimensions)]):
+            yield report
+
+    async def get_reports(self, name, report_requests):
+        """
+        Async generator version of `Client.get_reports`, yielding
+        (index, report) tuples.
+        """
+        batches = ReportBatches(report_requests)
+        for (profile_id, _, _), batch in batches:
+            body = batches.request_body(batch, self.page_sizer.page_size)
+            async with self.__view_semaphores[profile_id]:
+                with singer.metrics.http_request_timer(name):
+                    report_response = await self.post(REPORTS_URL, body)
+
+            for (index, _), report in zip(batch, report_response.json()["reports"]):
+                yield index, self._assoc_report_request(report, report_requests[index])
+
+                nextPageToken = report.get("nextPageToken")
+                if nextPageToken:
+                    batches.follow(index, nextPageToken)
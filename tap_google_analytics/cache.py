@@ -0,0 +1,72 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from urllib.parse import urlparse
+import singer
+
+LOGGER = singer.get_logger()
+
+# NB: Seconds each kind of Management API resource is cached for, by the
+# last part of its URL path
+DEFAULT_TTLS = {"accountSummaries": 24 * 60 * 60,
+                "accounts": 24 * 60 * 60,
+                "webproperties": 24 * 60 * 60,
+                "profiles": 24 * 60 * 60,
+                "goals": 6 * 60 * 60,
+                "customMetrics": 6 * 60 * 60,
+                "customDimensions": 6 * 60 * 60}
+
+def get_resource_type(url):
+    """ Returns the kind of resource listed by a Management API URL, e.g., `goals`. """
+    return urlparse(url).path.rstrip("/").rsplit("/", 1)[-1]
+
+class ManagementCache():
+    """
+    Caches the JSON responses of Management API requests in `cache_dir`,
+    in a file per request keyed by its URL, params, and the identity of the
+    token that made it (so that tokens never share responses).
+
+    Responses are used for the TTL of their resource type (`DEFAULT_TTLS`,
+    overridden by `ttls`), after which they're requested again. With
+    `force_refresh`, cached responses are ignored and replaced.
+    """
+    def __init__(self, cache_dir, token_identity, ttls=None, force_refresh=False):
+        self.cache_dir = cache_dir
+        self.token_identity = hashlib.sha256(token_identity.encode('utf-8')).hexdigest()
+        self.ttls = {**DEFAULT_TTLS, **(ttls or {})}
+        self.force_refresh = force_refresh
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, url, params):
+        key = json.dumps([self.token_identity, url, sorted((params or {}).items())])
+        return os.path.join(self.cache_dir, hashlib.sha256(key.encode('utf-8')).hexdigest() + ".json")
+
+    def get(self, url, params=None):
+        """ Returns the cached response of a request, or None if it's missing or expired. """
+        ttl = self.ttls.get(get_resource_type(url))
+        if self.force_refresh or not ttl:
+            return None
+        try:
+            with open(self._path(url, params)) as cache_file:
+                cached = json.load(cache_file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as ex:
+            LOGGER.warning("Ignoring unreadable cached response for %s: %s", url, ex)
+            return None
+        if time.time() - cached["cached_at"] >= ttl:
+            return None
+        return cached["response"]
+
+    def put(self, url, params, response):
+        if not self.ttls.get(get_resource_type(url)):
+            return
+        path = self._path(url, params)
+        # NB: Written under a unique name and renamed, so that a concurrent
+        # read never sees part of a file
+        temp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        with open(temp_path, "w") as cache_file:
+            json.dump({"cached_at": time.time(), "url": url, "response": response}, cache_file)
+        os.replace(temp_path, path)
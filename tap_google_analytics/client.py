@@ -1,7 +1,13 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
+import itertools
 import json
 import math
 import os
+import threading
+import time
+from collections import defaultdict
 from jwt import (
     JWT,
     jwk_from_pem,
@@ -11,8 +17,38 @@ import singer
 from singer import utils
 import backoff
 
+from .cache import ManagementCache
+from .quota import QuotaLimiter
+from .streaming import StreamedResponse
+
 LOGGER = singer.get_logger()
 
+# NB: The Reporting API accepts at most 5 reportRequests per batchGet call
+MAX_REPORT_REQUESTS_PER_BATCH = 5
+
+TOKEN_URL = "https://oauth2.googleapis.com/token"
+REPORTS_URL = "https://analyticsreporting.googleapis.com/v4/reports:batchGet"
+FIELD_METADATA_URL = "https://www.googleapis.com/analytics/v3/metadata/ga/columns"
+RAW_CUBES_URL = "https://ga-dev-tools.appspot.com/ga_cubes.json"
+MANAGEMENT_URL = "https://www.googleapis.com/analytics/v3/management"
+ACCOUNTS_URL = MANAGEMENT_URL + "/accounts"
+ACCOUNT_SUMMARIES_URL = MANAGEMENT_URL + "/accountSummaries"
+WEB_PROPERTIES_URL = ACCOUNTS_URL + "/{accountId}/webproperties"
+PROFILES_URL = WEB_PROPERTIES_URL + "/{webPropertyId}/profiles"
+GOALS_URL = PROFILES_URL + "/{profileId}/goals"
+CUSTOM_METRICS_URL = WEB_PROPERTIES_URL + "/{webPropertyId}/customMetrics"
+CUSTOM_DIMENSIONS_URL = WEB_PROPERTIES_URL + "/{webPropertyId}/customDimensions"
+
+# Reporting API limits, docs: https://developers.google.com/analytics/devguides/reporting/core/v4/limits-quotas
+MAX_CONCURRENT_REQUESTS_PER_VIEW = 10
+
+# NB: The API returns 1,000 rows per page unless pageSize is set, up to 100,000
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 100000
+MIN_PAGE_SIZE = 100
+DEFAULT_PAGE_SIZE_MAX_LATENCY_SECONDS = 30
+DEFAULT_PAGE_SIZE_MAX_BYTES = 32 * 1024 * 1024
+
 def is_retryable_403(response):
     """
     The Google Analytics Management API and Metadata API define three types of 403s that are retryable due to quota limits.
@@ -22,7 +58,11 @@ def is_retryable_403(response):
     https://developers.google.com/analytics/devguides/reporting/metadata/v3/errors
     """
     retryable_errors = {"userRateLimitExceeded", "rateLimitExceeded", "quotaExceeded"}
-    error_reasons = {error.get('reason') for error in response.json().get('error', {}).get('errors',[])}
+    error = response.json().get('error', {})
+    # NB: Token endpoint errors are a string, e.g., {"error": "invalid_grant"}
+    if not isinstance(error, dict):
+        return False
+    error_reasons = {e.get('reason') for e in error.get('errors',[])}
 
     if any(error_reasons.intersection(retryable_errors)):
         return True
@@ -55,6 +95,156 @@ def should_giveup(e):
 def should_retry(response):
     return response.status_code == 429 or is_retryable_403(response)
 
+def build_report_request(report_request, page_token=None, page_size=None):
+    """
+    Translates a report request of the form accepted by
+    `Client.get_reports` into a Reporting API v4 `ReportRequest`.
+    """
+    start_date = report_request["report_date"]
+    end_date = report_request.get("end_date") or start_date
+    request_body = {"viewId": report_request["profile_id"],
+                    "dateRanges": [{"startDate": start_date.strftime("%Y-%m-%d"),
+                                    "endDate": end_date.strftime("%Y-%m-%d")}],
+                    "metrics": [{"expression": m} for m in report_request["metrics"]],
+                    "dimensions": [{"name": d} for d in report_request["dimensions"]]}
+    if report_request.get("filters"):
+        request_body["filtersExpression"] = report_request["filters"]
+    if page_token:
+        request_body["pageToken"] = page_token
+    if page_size:
+        request_body["pageSize"] = page_size
+    return request_body
+
+def get_api_family(url):
+    """ Returns the quota family of `QuotaLimiter` that `url` counts against. """
+    if url.startswith(REPORTS_URL):
+        return "reporting"
+    if url.startswith(MANAGEMENT_URL) or url.startswith(FIELD_METADATA_URL):
+        return "management"
+    return None
+
+def get_view_id(data):
+    """ Returns the view a `reports:batchGet` body requests, which every request in a batch shares. """
+    report_requests = (data or {}).get("reportRequests")
+    if report_requests:
+        return report_requests[0].get("viewId")
+    return None
+
+def group_report_requests(report_requests):
+    """
+    Groups the indices of `report_requests` by (profile_id, report_date,
+    end_date), as the API requires every request in a batch to share the
+    same viewId and dateRanges.
+    """
+    requests_per_view_and_date = {}
+    for index, report_request in enumerate(report_requests):
+        key = (report_request["profile_id"],
+               report_request["report_date"],
+               report_request.get("end_date") or report_request["report_date"])
+        requests_per_view_and_date.setdefault(key, []).append(index)
+    return requests_per_view_and_date
+
+def get_day_report_request(profile_id, report_date, metrics, dimensions):
+    """ Returns the report request of `get_report` for a single day (see `Client.get_reports`). """
+    return {"profile_id": profile_id,
+            "report_date": report_date,
+            "metrics": metrics,
+            "dimensions": dimensions}
+
+class ReportBatches():
+    """
+    Plans the `reports:batchGet` calls covering `report_requests`, each of
+    up to 5 requests sharing a viewId and dateRanges (see
+    `group_report_requests`), for `Client` and `AsyncClient`.
+
+    Iterating yields ((profile_id, report_date, end_date), batch) for each
+    call, where `batch` is a list of (index, page_token) pairs into
+    `report_requests`. Pages to request next are added with `follow` as
+    reports come back, and a failed batch can be requested again with
+    `retry`.
+    """
+    def __init__(self, report_requests):
+        self.report_requests = report_requests
+        # NB: Pairs of (index, nextPageToken) still to be requested
+        self.pending = []
+
+    def __iter__(self):
+        for key, indices in group_report_requests(self.report_requests).items():
+            profile_id, report_date, end_date = key
+            self.pending = [(index, None) for index in indices]
+            while self.pending:
+                batch = self.pending[:MAX_REPORT_REQUESTS_PER_BATCH]
+                self.pending = self.pending[MAX_REPORT_REQUESTS_PER_BATCH:]
+
+                LOGGER.info("Making report request for profile ID %s and dates %s to %s (reports: %s, nextPageTokens: %s)",
+                            profile_id,
+                            report_date.strftime("%Y-%m-%d"),
+                            end_date.strftime("%Y-%m-%d"),
+                            len(batch),
+                            [page_token for _, page_token in batch])
+                yield key, batch
+
+    def request_body(self, batch, page_size=None):
+        return {"reportRequests": [build_report_request(self.report_requests[index], page_token, page_size)
+                                   for index, page_token in batch]}
+
+    def follow(self, index, page_token):
+        self.pending.append((index, page_token))
+
+    def retry(self, batch):
+        self.pending = batch + self.pending
+
+def raise_for_client_error(response):
+    """
+    Raises with the API's error message for 4xx responses that will not be
+    retried, rather than the bare status.
+    """
+    error_message = _is_json(response) and response.json().get("error", {}).get("message")
+    if 400 <= response.status_code < 500 and error_message and not should_retry(response):
+        raise Exception("{} Client Error, error message: {}".format(response.status_code, error_message))
+
+def get_local_raw_cubes():
+    local_cubes_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "ga_cubes.json")
+    with open(local_cubes_path, "r") as f:
+        return json.load(f)
+
+def get_remaining_page_tokens(report):
+    """
+    Reporting API page tokens are row offsets, so once a page reports the
+    total `rowCount`, the tokens of every remaining page are known.
+
+    Returns the list of remaining page tokens, or None if they can't be
+    worked out from `report`.
+    """
+    data = report.get("data", {})
+    # NB: The rows of a streamed page may have been iterated already, but
+    # are still counted
+    rows = data.get("rows")
+    page_rows = len(rows) if rows is not None else 0
+    row_count = data.get("rowCount")
+    try:
+        next_offset = int(report.get("nextPageToken"))
+    except (TypeError, ValueError):
+        return None
+    if not page_rows or not row_count:
+        return None
+    return [str(offset) for offset in range(next_offset, row_count, page_rows)]
+
+def is_server_error(ex):
+    """ Timeouts and 5xx responses, which a smaller page may avoid. """
+    if isinstance(ex, requests.exceptions.Timeout):
+        return True
+    response = getattr(ex, "response", None)
+    return response is not None and response.status_code >= 500
+
+def should_giveup_for_smaller_page(e):
+    """
+    `should_giveup` for requests that can be made again with a smaller
+    page, which also gives up on the first timeout or server error (see
+    `is_server_error`).
+    """
+    return is_server_error(e) or should_giveup(e)
+
 def _is_json(response):
     try:
         response.json()
@@ -63,8 +253,126 @@ def _is_json(response):
         return False
 
 
+class PageSizer():
+    """
+    Chooses the `pageSize` of report requests.
+
+    With a fixed `page_size` (or none, for the API's default), this only
+    holds that value. In adaptive mode, the page size doubles while pages
+    come back full with latency and size under half of their ceilings, and
+    halves when a page goes over a ceiling or after a timeout or server
+    error.
+    """
+    def __init__(self, page_size=None, adaptive=False,
+                 max_latency=DEFAULT_PAGE_SIZE_MAX_LATENCY_SECONDS,
+                 max_bytes=DEFAULT_PAGE_SIZE_MAX_BYTES):
+        if page_size is not None and not 0 < int(page_size) <= MAX_PAGE_SIZE:
+            raise Exception("Config Validation Error: page_size must be between 1 and {}.".format(MAX_PAGE_SIZE))
+        self.adaptive = adaptive
+        self.page_size = int(page_size) if page_size else None
+        if adaptive and not self.page_size:
+            self.page_size = DEFAULT_PAGE_SIZE
+        self.max_latency = float(max_latency)
+        self.max_bytes = int(max_bytes)
+        self.lock = threading.Lock()
+
+    def record_page(self, latency, size_bytes, page_was_full):
+        if not self.adaptive:
+            return
+        with self.lock:
+            if latency > self.max_latency or size_bytes > self.max_bytes:
+                self._resize(max(self.page_size // 2, MIN_PAGE_SIZE))
+            elif page_was_full and latency < self.max_latency / 2 and size_bytes < self.max_bytes / 2:
+                self._resize(min(self.page_size * 2, MAX_PAGE_SIZE))
+
+    def can_shrink(self):
+        return self.adaptive and self.page_size > MIN_PAGE_SIZE
+
+    def shrink(self):
+        """ Halves the page size after an error, returning False if it can't. """
+        if not self.adaptive:
+            return False
+        with self.lock:
+            if self.page_size <= MIN_PAGE_SIZE:
+                return False
+            self._resize(max(self.page_size // 2, MIN_PAGE_SIZE))
+            return True
+
+    def _resize(self, page_size):
+        if page_size != self.page_size:
+            LOGGER.info("Changing report page size from %s to %s.", self.page_size, page_size)
+            self.page_size = page_size
+
+
+# NB: The most account summaries the Management API returns per page
+ACCOUNT_SUMMARIES_PAGE_SIZE = 1000
+
+def account_summaries_to_profiles(account_summaries):
+    """ Returns the web property and account IDs of each profile in a page of account summaries. """
+    profiles = {}
+    for account in account_summaries.get('items', []):
+        for web_property in account.get('webProperties', []):
+            for profile in web_property.get('profiles', []):
+                profiles[profile['id']] = {"web_property_id": web_property['id'],
+                                           "account_id": account['id']}
+    return profiles
+
+class ProfileLookup():
+    """
+    Maps profile IDs to their web property and account IDs, reading pages
+    of `account_summaries` (an iterable of `accountSummaries` responses)
+    only until a profile being looked up is found. A sync of a few views
+    usually reads a single page, rather than listing every web property
+    and profile the token can see.
+
+    Unknown profiles raise `KeyError`, once every page has been read. If
+    the pages may be stale (e.g., cached, see `ManagementCache`),
+    `refresh_account_summaries` returns fresh ones to read once before
+    giving up on a profile, e.g., a view added to the config since.
+    """
+    def __init__(self, account_summaries, refresh_account_summaries=None):
+        self.account_summaries = iter(account_summaries)
+        self.refresh_account_summaries = refresh_account_summaries
+        self.profiles = {}
+        self.complete = False
+        # NB: Views may be looked up from several threads
+        self.lock = threading.Lock()
+
+    def _read_until(self, profile_id):
+        with self.lock:
+            while profile_id not in self.profiles and not self.complete:
+                page = next(self.account_summaries, None)
+                if page is not None:
+                    self.profiles.update(account_summaries_to_profiles(page))
+                elif self.refresh_account_summaries:
+                    LOGGER.info("Profile %s not found in cached account summaries, requesting them again.", profile_id)
+                    self.account_summaries = iter(self.refresh_account_summaries())
+                    self.refresh_account_summaries = None
+                else:
+                    self.complete = True
+
+    def __getitem__(self, profile_id):
+        self._read_until(profile_id)
+        return self.profiles[profile_id]
+
+    def __setitem__(self, profile_id, value):
+        self.profiles[profile_id] = value
+
+    def __contains__(self, profile_id):
+        self._read_until(profile_id)
+        return profile_id in self.profiles
+
+    def get(self, profile_id, default=None):
+        self._read_until(profile_id)
+        return self.profiles.get(profile_id, default)
+
+
 # pylint: disable=too-many-instance-attributes
-class Client():
+class BaseClient():
+    """
+    Configuration, authentication, and pacing shared by the HTTP engines,
+    `Client` and `AsyncClient`.
+    """
     def __init__(self, config):
         self.auth_method = config['auth_method']
         if self.auth_method == "oauth2":
@@ -82,62 +390,128 @@ class Client():
         self.quota_user = config.get("quota_user")
         self.user_agent = config.get("user_agent")
 
-        self.session = requests.Session()
-        if self.user_agent:
-            self.session.headers.update({"User-Agent": self.user_agent})
+        # NB: Shared by every thread or task making requests through this client
+        self.quota_limiter = QuotaLimiter(config.get("quota_limits"))
+        self.page_sizer = PageSizer(config.get("page_size"),
+                                    config.get("adaptive_page_size", False),
+                                    config.get("page_size_max_latency_seconds", DEFAULT_PAGE_SIZE_MAX_LATENCY_SECONDS),
+                                    config.get("page_size_max_bytes", DEFAULT_PAGE_SIZE_MAX_BYTES))
+        self.request_timeout = float(config["request_timeout"]) if config.get("request_timeout") else None
+        self.prefetch_pages = config.get("prefetch_pages", False)
+        self.stream_responses = config.get("stream_responses", False)
 
         self.profile_lookup = {}
-        self.__populate_profile_lookup()
 
-    def __populate_profile_lookup(self):
-        """
-        Get all profiles available and associate them with their web property
-        and account IDs to be looked up later during discovery.
-        """
-        for account_id in self.get_accounts_for_token():
-            for web_property_id in self.get_web_properties_for_account(account_id):
-                for profile_id in self.get_profiles_for_property(account_id, web_property_id):
-                    self.profile_lookup[profile_id] = {"web_property_id": web_property_id,
-                                                       "account_id": account_id}
+        self.management_cache = None
+        if config.get("management_cache_dir"):
+            self.management_cache = ManagementCache(config["management_cache_dir"],
+                                                    self._token_identity(),
+                                                    config.get("management_cache_ttls"),
+                                                    config.get("refresh_management_cache", False))
+
+    def _token_identity(self):
+        """ Identifies the credentials whose Management API responses may be shared. """
+        if self.auth_method == "oauth2":
+            return "oauth2:{}:{}".format(self.client_id, self.refresh_token)
+        return "service_account:{}".format(self.client_email)
 
     # Authentication and refresh
-    def _ensure_access_token(self):
-        if self.last_refreshed is not None and \
-           (utils.now() - self.last_refreshed).total_seconds() < self.expires_in:
-            return
+    def _access_token_is_valid(self):
+        return self.last_refreshed is not None and \
+            (utils.now() - self.last_refreshed).total_seconds() < self.expires_in
 
+    def _access_token_request_payload(self):
+        """ Returns the form data to request a new access token from `TOKEN_URL`. """
         LOGGER.info("Refreshing access token.")
         self.last_refreshed = utils.now()
 
         if self.auth_method == "oauth2":
-            payload = {
+            return {
                 "refresh_token": self.refresh_token,
                 "client_id": self.client_id,
                 "client_secret": self.client_secret,
                 "grant_type": "refresh_token"
             }
-        else:
-            message = {
-                "iss": self.client_email,
-                "scope": "https://www.googleapis.com/auth/analytics.readonly",
-                "aud":"https://oauth2.googleapis.com/token",
-                "exp": math.floor((self.last_refreshed + timedelta(hours=1)).timestamp()),
-                "iat": math.floor(self.last_refreshed.timestamp())
-            }
-            signing_key = jwk_from_pem(self.private_key)
-            payload = {
-                "grant_type": "urn:ietf:params:oauth:grant-type:jwt-bearer",
-                "assertion": JWT().encode(message, signing_key, 'RS256')
-            }
 
-        token_response = requests.post("https://oauth2.googleapis.com/token", data=payload)
-
-        token_response.raise_for_status()
-
-        token_json = token_response.json()
+        message = {
+            "iss": self.client_email,
+            "scope": "https://www.googleapis.com/auth/analytics.readonly",
+            "aud": TOKEN_URL,
+            "exp": math.floor((self.last_refreshed + timedelta(hours=1)).timestamp()),
+            "iat": math.floor(self.last_refreshed.timestamp())
+        }
+        signing_key = jwk_from_pem(self.private_key)
+        return {
+            "grant_type": "urn:ietf:params:oauth:grant-type:jwt-bearer",
+            "assertion": JWT().encode(message, signing_key, 'RS256')
+        }
+
+    def _update_access_token(self, token_json):
         self.__access_token = token_json['access_token']
         self.expires_in = token_json['expires_in']
 
+    def _request_headers_and_params(self, params=None):
+        params = params or {}
+        headers = {"Authorization" : "Bearer " + self.__access_token}
+        if self.quota_user:
+            params["quotaUser"] = self.quota_user
+        return headers, params
+
+    def _assoc_report_request(self, report, report_request):
+        """
+        Wraps a single report from a batch response in the shape of a
+        one-report response, and assocs in the request data to be used by
+        the caller.
+        """
+        profile_id = report_request["profile_id"]
+        return {"reports": [report],
+                "profileId": profile_id,
+                "webPropertyId": self.profile_lookup[profile_id]["web_property_id"],
+                "accountId": self.profile_lookup[profile_id]["account_id"],
+                "reportDate": report_request["report_date"],
+                "metrics": report_request["metrics"],
+                "dimensions": report_request["dimensions"]}
+
+
+class Client(BaseClient):
+    def __init__(self, config):
+        super().__init__(config)
+        # NB: Requests may be made from several threads during sync
+        self.__token_lock = threading.Lock()
+
+        self.session = requests.Session()
+        if self.user_agent:
+            self.session.headers.update({"User-Agent": self.user_agent})
+
+        # NB: Size the connection pool to the number of requests that may
+        # be in flight at once when syncing views and days, or discovering
+        # profiles, concurrently
+        pool_size = max(int(config.get("view_workers", 1)) * int(config.get("day_workers", 1)),
+                        int(config.get("discovery_workers", 1)) + 2,
+                        requests.adapters.DEFAULT_POOLSIZE)
+        if self.prefetch_pages:
+            pool_size *= MAX_CONCURRENT_REQUESTS_PER_VIEW
+        self.session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=pool_size))
+
+        self.__view_semaphores = defaultdict(lambda: threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS_PER_VIEW))
+        self.__view_semaphores_lock = threading.Lock()
+
+        # NB: Profiles are looked up from the token's account summaries as
+        # they are first needed, during discovery or sync
+        self.profile_lookup = ProfileLookup(self.get_account_summaries(),
+                                            (lambda: self.get_account_summaries(use_cache=False))
+                                            if self.management_cache else None)
+
+    def _ensure_access_token(self):
+        with self.__token_lock:
+            if self._access_token_is_valid():
+                return
+
+            token_response = requests.post(TOKEN_URL, data=self._access_token_request_payload())
+
+            token_response.raise_for_status()
+
+            self._update_access_token(token_response.json())
 
     @backoff.on_exception(backoff.expo,
                           (requests.exceptions.RequestException),
@@ -145,73 +519,125 @@ class Client():
                           giveup=should_giveup,
                           factor=4,
                           jitter=None)
-    def _make_request(self, method, url, params=None, data=None):
-        params = params or {}
+    def _make_request(self, method, url, params=None, data=None, stream=False):
+        return self._send_request(method, url, params=params, data=data, stream=stream)
+
+    @backoff.on_exception(backoff.expo,
+                          (requests.exceptions.RequestException),
+                          max_tries=10,
+                          giveup=should_giveup_for_smaller_page,
+                          factor=4,
+                          jitter=None)
+    def _make_request_for_smaller_page(self, method, url, params=None, data=None, stream=False):
+        return self._send_request(method, url, params=params, data=data, stream=stream)
+
+    def _send_request(self, method, url, params=None, data=None, stream=False):
         data = data or {}
 
         self._ensure_access_token()
 
-        headers = {"Authorization" : "Bearer " + self.__access_token}
-        if self.quota_user:
-            params["quotaUser"] = self.quota_user
+        headers, params = self._request_headers_and_params(params)
+
+        self.quota_limiter.wait(get_api_family(url), get_view_id(data))
 
         if method == 'POST':
-            response = self.session.post(url, headers=headers, params=params, json=data)
+            response = self.session.post(url, headers=headers, params=params, json=data,
+                                         timeout=self.request_timeout, stream=stream)
         else:
-            response = self.session.request(method, url, headers=headers, params=params)
+            response = self.session.request(method, url, headers=headers, params=params,
+                                            timeout=self.request_timeout, stream=stream)
 
-        error_message = _is_json(response) and response.json().get("error", {}).get("message")
-        if 400 <= response.status_code < 500 and error_message and not should_retry(response):
-            raise Exception("{} Client Error, error message: {}".format(response.status_code, error_message))
+        raise_for_client_error(response)
 
         response.raise_for_status()
 
         return response
 
+    def _view_semaphore(self, profile_id):
+        """ Returns the semaphore bounding concurrent requests for a view. """
+        with self.__view_semaphores_lock:
+            return self.__view_semaphores[profile_id]
+
     def get(self, url, params=None):
         return self._make_request("GET", url, params=params)
 
-    def post(self, url, data=None):
-        return self._make_request("POST", url, data=data)
+    def post(self, url, data=None, stream=False, retry_server_errors=True):
+        """
+        If `retry_server_errors` is False, timeouts and server errors are
+        raised rather than retried, for the caller to request a smaller page.
+        """
+        if not retry_server_errors:
+            return self._make_request_for_smaller_page("POST", url, data=data, stream=stream)
+        return self._make_request("POST", url, data=data, stream=stream)
+
+    def get_management_json(self, url, params=None, use_cache=True):
+        """
+        Returns the JSON response of a Management API request, from the
+        `management_cache` if configured and the response is still fresh.
+        With `use_cache` off, the response is requested and cached again.
+        """
+        if self.management_cache and use_cache:
+            cached_json = self.management_cache.get(url, params)
+            if cached_json is not None:
+                return cached_json
+        # NB: Copied, as requests add their quotaUser to params
+        response_json = self.get(url, params=dict(params) if params else None).json()
+        if self.management_cache:
+            self.management_cache.put(url, params, response_json)
+        return response_json
 
     # Discovery requests
 
     def get_field_metadata(self):
-        metadata_response = self.get("https://www.googleapis.com/analytics/v3/metadata/{reportType}/columns".format(reportType="ga"))
+        metadata_response = self.get(FIELD_METADATA_URL)
         return metadata_response.json()
 
     def get_raw_cubes(self):
         try:
-            cubes_response = self.get("https://ga-dev-tools.appspot.com/ga_cubes.json")
+            cubes_response = self.get(RAW_CUBES_URL)
             cubes_response.raise_for_status()
             cubes_json = cubes_response.json()
         except Exception as ex:
             LOGGER.warning("Error fetching raw cubes, falling back to local copy. Exception message: %s", ex)
-            local_cubes_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "ga_cubes.json")
-            with open(local_cubes_path, "r") as f:
-                cubes_json = json.load(f)
+            cubes_json = get_local_raw_cubes()
         return cubes_json
 
+    def get_account_summaries(self, use_cache=True):
+        """
+        Yields each page of the token's account summaries, which list the
+        web properties and profiles of each account in a single request.
+        """
+        start_index = 1
+        while True:
+            account_summaries = self.get_management_json(ACCOUNT_SUMMARIES_URL,
+                                                         params={"start-index": start_index,
+                                                                 "max-results": ACCOUNT_SUMMARIES_PAGE_SIZE},
+                                                         use_cache=use_cache)
+            yield account_summaries
+            items = account_summaries.get('items', [])
+            if not account_summaries.get('nextLink') or not items:
+                return
+            start_index += len(items)
+
     def get_accounts_for_token(self):
         """ Return a list of account IDs available to hte associated token. """
-        accounts_response = self.get('https://www.googleapis.com/analytics/v3/management/accounts')
-        account_ids = [i['id'] for i in accounts_response.json()['items']]
+        accounts_json = self.get_management_json(ACCOUNTS_URL)
+        account_ids = [i['id'] for i in accounts_json['items']]
         return account_ids
 
     def get_web_properties_for_account(self, account_id):
         """ Return a list of webproperty IDs for the account specified. """
-        webprops_response = self.get('https://www.googleapis.com/analytics/v3/management/accounts/{accountId}/webproperties'.format(accountId=account_id))
-        webprops_ids = [w['id'] for w in webprops_response.json()['items']]
+        webprops_json = self.get_management_json(WEB_PROPERTIES_URL.format(accountId=account_id))
+        webprops_ids = [w['id'] for w in webprops_json['items']]
         return webprops_ids
 
     def get_profiles_for_property(self, account_id, web_property_id):
         """
         Gets all profiles for property to associate with custom metrics and dimensions.
         """
-        profiles_url = 'https://www.googleapis.com/analytics/v3/management/accounts/{accountId}/webproperties/{webPropertyId}/profiles'
-        profiles_response = self.get(profiles_url.format(accountId=account_id,
-                                                         webPropertyId=web_property_id))
-        return [p["id"] for p in profiles_response.json()['items']]
+        profiles_json = self.get_management_json(PROFILES_URL.format(accountId=account_id,
+                                                                     webPropertyId=web_property_id))
+        return [p["id"] for p in profiles_json['items']]
 
     def get_goals_for_profile(self, profile_id):
         """
@@ -225,11 +651,10 @@ class Client():
         """
         Gets all goal IDs for property and account to name custom metrics and dimensions.
         """
-        profiles_url = 'https://www.googleapis.com/analytics/v3/management/accounts/{accountId}/webproperties/{webPropertyId}/profiles/{profileId}/goals'
-        goals_response = self.get(profiles_url.format(accountId=account_id,
-                                                      webPropertyId=web_property_id,
-                                                      profileId=profile_id))
-        return [g["id"] for g in goals_response.json()['items']]
+        goals_json = self.get_management_json(GOALS_URL.format(accountId=account_id,
+                                                               webPropertyId=web_property_id,
+                                                               profileId=profile_id))
+        return [g["id"] for g in goals_json['items']]
 
     def get_custom_metrics_for_profile(self, profile_id):
         """
@@ -243,11 +668,8 @@ class Client():
         Gets all metrics for the specified web_property_id.
 
         """
-        metrics_url = 'https://www.googleapis.com/analytics/v3/management/accounts/{accountId}/webproperties/{webPropertyId}/customMetrics'
-
-        custom_metrics_response = self.get(metrics_url.format(accountId=account_id,
-                                                              webPropertyId=web_property_id))
-        return custom_metrics_response.json()
+        return self.get_management_json(CUSTOM_METRICS_URL.format(accountId=account_id,
+                                                                  webPropertyId=web_property_id))
 
     def get_custom_dimensions_for_profile(self, profile_id):
         """
@@ -260,12 +682,9 @@ class Client():
         """
         Gets all dimensions for the specified web_property_id
         """
-        url = 'https://www.googleapis.com/analytics/v3/management/accounts/{accountId}/webproperties/{webPropertyId}/customDimensions'
-        custom_dimensions_response = self.get(url.format(accountId=account_id,
-                                                         webPropertyId=web_property_id))
-
         # NOTE: Assuming that all custom dimensions are STRING, since there's no type information
-        return custom_dimensions_response.json()
+        return self.get_management_json(CUSTOM_DIMENSIONS_URL.format(accountId=account_id,
+                                                                     webPropertyId=web_property_id))
 
     # Sync Requests w/ Pagination and token refresh
     # Docs for more info: https://developers.google.com/analytics/devguides/reporting/core/v4/rest/v4/reports/batchGet
@@ -281,39 +700,137 @@ class Client():
         Returns:
         - A generator of a sequence of reports w/ associated metadata (metrics/dims/report_date/profile)
         """
-        nextPageToken = None
-        # TODO: Optimization, if speed is an issue, up to 5 requests can be placed per HTTP batch
-        # - This will require changes to all parsing code to account for multiple report responses coming back
-        while True:
-            report_date_string = report_date.strftime("%Y-%m-%d")
-            LOGGER.info("Making report request for profile ID %s and date %s (nextPageToken: %s)",
-                        profile_id,
-                        report_date_string,
-                        nextPageToken)
-            body = {"reportRequests":
-                    [{"viewId": profile_id,
-                      "dateRanges": [{"startDate": report_date_string,
-                                      "endDate": report_date_string}],
-                      "metrics": [{"expression": m} for m in metrics],
-                      "dimensions": [{"name": d} for d in dimensions]}]}
-            if nextPageToken:
-                body["reportRequests"][0]["pageToken"] = nextPageToken
-            with singer.metrics.http_request_timer(name):
-                report_response = self.post("https://analyticsreporting.googleapis.com/v4/reports:batchGet", body)
-            report = report_response.json()
-
-            # Assoc in the request data to be used by the caller
-            report.update({"profileId": profile_id,
-                           "webPropertyId": self.profile_lookup[profile_id]["web_property_id"],
-                           "accountId": self.profile_lookup[profile_id]["account_id"],
-                           "reportDate": report_date,
-                           "metrics": metrics,
-                           "dimensions": dimensions})
-
+        for _, report in self.get_reports(name, [get_day_report_request(profile_id, report_date, metrics, dimensions)]):
             yield report
 
-            # NB: Assumes only one report at a time
-            nextPageToken = report["reports"][0].get("nextPageToken")
+    def get_reports(self, name, report_requests):
+        """
+        Batched version of `get_report`, placing up to 5 report requests
+        in each `reports:batchGet` call.
+
+        The API requires every request in a batch to share the same viewId
+        and dateRanges, so requests are grouped by profile and date before
+        being batched. Reports with more pages are re-batched with their
+        `nextPageToken` until every report is exhausted.
+
+        During sync, only requests for the same query share a call: the
+        metric groups of a report wider than the API allows, and the shards
+        of a sampled day. Each query and day (or date window) is otherwise
+        requested in its own call, so streams only share requests when
+        merged into one query (see `merge_streams`).
+
+        If `prefetch_pages` is set in config, the remaining pages of a report
+        are requested concurrently as soon as its first page gives the
+        `rowCount`, and yielded in order.
 
-            if not nextPageToken:
-                break
+        If `stream_responses` is set in config, responses are parsed as
+        they are read, and each page's rows are decoded as they're iterated
+        (see `StreamedResponse`). Pages are then only valid until the next
+        one is requested, and their rows can only be iterated once.
+
+        Parameters:
+        - name - the tap_stream_id of the report being run
+        - report_requests - list of dicts with the keys `profile_id`,
+          `report_date`, `metrics`, and `dimensions`, as passed to
+          `get_report`, and optionally `end_date` to request the range from
+          `report_date` through `end_date` and `filters` as a
+          filtersExpression
+
+        Returns:
+        - A generator of (index, report) tuples, where `index` is the position
+          of the originating request in `report_requests` and `report` is a
+          single page of the same shape yielded by `get_report`
+        """
+        batches = ReportBatches(report_requests)
+        for (profile_id, report_date, end_date), batch in batches:
+            body = batches.request_body(batch, self.page_sizer.page_size)
+            # NB: Page tokens are row offsets, so after a timeout or server
+            # error the batch is requested again with a smaller page size,
+            # rather than retried at the same size
+            can_shrink = self.page_sizer.can_shrink()
+            requested_at = time.monotonic()
+            try:
+                with self._view_semaphore(profile_id):
+                    with singer.metrics.http_request_timer(name):
+                        report_response = self.post(REPORTS_URL, body, stream=self.stream_responses,
+                                                    retry_server_errors=not can_shrink)
+            except requests.exceptions.RequestException as ex:
+                if can_shrink and is_server_error(ex):
+                    # NB: Another thread may have shrunk it to the minimum
+                    # already, so the batch is then retried as usual
+                    if self.page_sizer.shrink():
+                        LOGGER.warning("Report request failed with %s, retrying with a smaller page size.", ex)
+                    batches.retry(batch)
+                    continue
+                raise
+
+            if self.stream_responses:
+                reports = StreamedResponse.from_response(report_response).reports()
+            else:
+                reports = report_response.json()["reports"]
+            # NB: Streamed responses aren't read yet, so can't be measured
+            if self.page_sizer.adaptive and not self.stream_responses:
+                self.page_sizer.record_page(time.monotonic() - requested_at,
+                                            len(report_response.content),
+                                            any(report.get("nextPageToken") for report in reports))
+
+            # NB: Triples of (index, pageToken, pageSize) to prefetch
+            prefetch = []
+            # NB: Reports are returned in the same order as they were requested
+            for (index, _), report in zip(batch, reports):
+                yield index, self._assoc_report_request(report, report_requests[index])
+
+                nextPageToken = report.get("nextPageToken")
+                if not nextPageToken:
+                    continue
+                remaining_page_tokens = get_remaining_page_tokens(report) if self.prefetch_pages else None
+                if remaining_page_tokens:
+                    # NB: Offsets only line up at the first page's size
+                    page_rows = len(report["data"]["rows"])
+                    prefetch.extend((index, page_token, page_rows) for page_token in remaining_page_tokens)
+                else:
+                    batches.follow(index, nextPageToken)
+
+            if prefetch:
+                LOGGER.info("Prefetching %s pages for profile ID %s and dates %s to %s",
+                            len(prefetch),
+                            profile_id,
+                            report_date.strftime("%Y-%m-%d"),
+                            end_date.strftime("%Y-%m-%d"))
+                last_pages = {}
+                for prefetch_batch, prefetch_reports in self._prefetch_report_pages(name, profile_id,
+                                                                                     report_requests, prefetch):
+                    for (index, _, _), report in zip(prefetch_batch, prefetch_reports):
+                        yield index, self._assoc_report_request(report, report_requests[index])
+                        last_pages[index] = report
+                # NB: Rows added since the first page are followed as usual
+                for index, report in last_pages.items():
+                    if report.get("nextPageToken"):
+                        batches.follow(index, report["nextPageToken"])
+
+    def _prefetch_report_pages(self, name, profile_id, report_requests, page_tokens):
+        """
+        Requests the (index, page_token, page_size) triples in `page_tokens`
+        in batches, keeping up to the per-view concurrency limit in flight.
+
+        Yields (batch, reports) tuples in the order of `page_tokens`.
+        """
+        def fetch_batch(batch):
+            body = {"reportRequests": [build_report_request(report_requests[index], page_token, page_size)
+                                       for index, page_token, page_size in batch]}
+            with self._view_semaphore(profile_id):
+                with singer.metrics.http_request_timer(name):
+                    return self.post(REPORTS_URL, body).json()["reports"]
+
+        batches = iter([page_tokens[i:i + MAX_REPORT_REQUESTS_PER_BATCH]
+                        for i in range(0, len(page_tokens), MAX_REPORT_REQUESTS_PER_BATCH)])
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS_PER_VIEW) as executor:
+            in_flight = deque((batch, executor.submit(fetch_batch, batch))
+                              for batch in itertools.islice(batches, MAX_CONCURRENT_REQUESTS_PER_VIEW))
+            while in_flight:
+                batch, future = in_flight.popleft()
+                reports = future.result()
+                next_batch = next(batches, None)
+                if next_batch:
+                    in_flight.append((next_batch, executor.submit(fetch_batch, next_batch)))
+                yield batch, reports
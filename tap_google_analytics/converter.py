@@ -0,0 +1,162 @@
+from singer import Transformer
+from singer.transform import string_to_datetime
+
+# NB: Dates repeat across the rows of a report, so their conversions are
+# remembered, up to this many per field
+MAX_MEMOIZED_DATETIMES = 10000
+
+def _convert_null(value):
+    if value is None or value == "":
+        return True, None
+    return False, None
+
+def _convert_string(value):
+    if value is None:
+        return False, None
+    try:
+        return True, str(value)
+    except Exception: # pylint: disable=broad-except
+        return False, None
+
+def _convert_integer(value):
+    if isinstance(value, str):
+        value = value.replace(",", "")
+    try:
+        return True, int(value)
+    except Exception: # pylint: disable=broad-except
+        return False, None
+
+def _convert_number(value):
+    if isinstance(value, str):
+        value = value.replace(",", "")
+    try:
+        return True, float(value)
+    except Exception: # pylint: disable=broad-except
+        return False, None
+
+def _convert_boolean(value):
+    if isinstance(value, str) and value.lower() == "false":
+        return True, False
+    try:
+        return True, bool(value)
+    except Exception: # pylint: disable=broad-except
+        return False, None
+
+def _compile_datetime_converter():
+    memo = {}
+
+    def convert_datetime(value):
+        if value is None or value == "":
+            return False, None
+        try:
+            converted = memo[value]
+        except (KeyError, TypeError):
+            converted = string_to_datetime(value)
+            if len(memo) >= MAX_MEMOIZED_DATETIMES:
+                memo.clear()
+            try:
+                memo[value] = converted
+            except TypeError:
+                pass
+        return converted is not None, converted
+    return convert_datetime
+
+SIMPLE_TYPE_CONVERTERS = {"null": _convert_null,
+                          "string": _convert_string,
+                          "integer": _convert_integer,
+                          "number": _convert_number,
+                          "boolean": _convert_boolean}
+
+def _compile_type_converter(typ, schema):
+    if typ == "null":
+        return _convert_null
+    if schema.get("format") == "date-time":
+        return _compile_datetime_converter()
+    if typ in SIMPLE_TYPE_CONVERTERS:
+        return SIMPLE_TYPE_CONVERTERS[typ]
+    if typ in ("object", "array"):
+        # NB: Reports never return nested values, so these are left to singer
+        return lambda value: Transformer()._transform(value, typ, schema, []) # pylint: disable=protected-access
+    return lambda value: (False, None)
+
+def _first_success(converters):
+    if len(converters) == 1:
+        return converters[0]
+
+    def convert(value):
+        for converter in converters:
+            success, converted = converter(value)
+            if success:
+                return success, converted
+        return False, None
+    return convert
+
+def compile_value_converter(schema):
+    """
+    Returns a function of a value to a tuple of (success, converted_value)
+    following the rules of `singer.Transformer` for `schema`.
+    """
+    if "anyOf" in schema:
+        return _first_success([compile_value_converter(sub_schema) for sub_schema in schema["anyOf"]])
+
+    if "type" not in schema:
+        return lambda value: (True, value)
+
+    types = schema["type"] if isinstance(schema["type"], list) else [schema["type"]]
+    # NB: Transformer tries "null" last
+    types = [t for t in types if t != "null"] + [t for t in types if t == "null"]
+    return _first_success([_compile_type_converter(typ, schema) for typ in types])
+
+class RecordConverter():
+    """
+    A stream's schema compiled into a function transforming one flat
+    record, as `Transformer().transform(record, schema)` would. Each
+    field's conversion is worked out once, rather than walking the schema
+    for every record.
+
+    `field_converters` maps each field in the schema to its compiled
+    converter (see `compile_value_converter`), or is None if the schema
+    isn't a flat object and records are transformed by `Transformer`.
+    `keep_all` is set for an empty schema, which leaves records untouched.
+
+    Records with a value that doesn't fit the schema are handed to
+    `Transformer`, so that they fail with the same error.
+    """
+    def __init__(self, schema):
+        self.schema = schema
+        self.field_converters = None
+        self.keep_all = False
+
+        types = schema.get("type")
+        if types not in ("object", ["object"]) or "anyOf" in schema or schema.get("patternProperties"):
+            return
+
+        properties = schema.get("properties", {})
+        # NB: Transformer leaves records for an empty schema untouched
+        self.keep_all = not properties
+        self.field_converters = {field_name: compile_value_converter(field_schema)
+                                 for field_name, field_schema in properties.items()}
+
+    def transform_with_singer(self, record):
+        with Transformer() as transformer:
+            return transformer.transform(record, self.schema)
+
+    def __call__(self, record):
+        if self.field_converters is None:
+            return self.transform_with_singer(record)
+        if self.keep_all:
+            return record
+
+        result = {}
+        for field_name, value in record.items():
+            converter = self.field_converters.get(field_name)
+            if converter is None:
+                # NB: Fields missing from the schema are dropped
+                continue
+            success, result[field_name] = converter(value)
+            if not success:
+                return self.transform_with_singer(record)
+        return result
+
+def compile_record_converter(schema):
+    return RecordConverter(schema)
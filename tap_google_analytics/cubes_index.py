@@ -0,0 +1,104 @@
+"""
+Builds the cubes index shipped with the package, `ga_cubes_index.json`,
+from the raw cube definitions in `ga_cubes.json`:
+
+    python -m tap_google_analytics.cubes_index [path/to/ga_cubes.json]
+
+The index is pre-inverted into the lookup discovery needs, {field_id:
+cubes}, with cubes numbered, and the fields matching each `XX` field ID
+(see `discover.handle_static_XX_field`). Its `version` is a hash of the
+cube definitions it was built from, to compare with the remote ones.
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+
+# NB: Bumped when the structure of the index changes
+CUBES_INDEX_FORMAT = 1
+
+PACKAGE_DIR = os.path.dirname(os.path.realpath(__file__))
+LOCAL_CUBES_PATH = os.path.join(PACKAGE_DIR, "ga_cubes.json")
+CUBES_INDEX_PATH = os.path.join(PACKAGE_DIR, "ga_cubes_index.json")
+
+def get_cubes_version(raw_cubes):
+    """ Returns a hash of cube definitions, ignoring the order of cubes and fields. """
+    canonical_cubes = {cube: sorted(set(fields)) for cube, fields in raw_cubes.items()}
+    return hashlib.sha256(json.dumps(canonical_cubes, sort_keys=True).encode('utf-8')).hexdigest()
+
+def match_XX_field(xx_field_id, field_ids):
+    """ Returns the IDs in `field_ids` that match an `XX` field ID, with `XX` standing for a number. """
+    regex_matcher = xx_field_id.replace("XX", r'\d\d?')
+    return [field_id for field_id in field_ids if re.match(regex_matcher, field_id)]
+
+class CubesLookup(dict):
+    """
+    A map of {field_id: cubes} as built by `discover.generate_cubes_lookup`,
+    with the precomputed matches of `XX` field IDs in `xx_fields`. IDs
+    missing from `xx_fields` are matched against every field.
+    """
+    def __init__(self, lookup, xx_fields=None):
+        super().__init__(lookup)
+        self.xx_fields = xx_fields or {}
+
+    def match_XX_field(self, xx_field_id):
+        if xx_field_id in self.xx_fields:
+            return self.xx_fields[xx_field_id]
+        return match_XX_field(xx_field_id, self.keys())
+
+def build_cubes_index(raw_cubes):
+    cubes = sorted(raw_cubes.keys())
+    cube_numbers = {cube: number for number, cube in enumerate(cubes)}
+    field_cubes = {}
+    for cube, fields in raw_cubes.items():
+        for field in fields:
+            field_cubes.setdefault(field, set()).add(cube_numbers[cube])
+    fields = {field: sorted(field_cubes[field]) for field in sorted(field_cubes)}
+
+    # NB: Numbered fields give the `XX` IDs that discovery will look up,
+    # e.g., `ga:contentGroupXX` from `ga:contentGroup1`
+    xx_field_ids = sorted({re.sub(r'\d+', 'XX', field) for field in fields} - set(fields))
+    xx_fields = {xx_field_id: match_XX_field(xx_field_id, fields)
+                 for xx_field_id in xx_field_ids
+                 if 'XX' in xx_field_id}
+    return {"format": CUBES_INDEX_FORMAT,
+            "version": get_cubes_version(raw_cubes),
+            "cubes": cubes,
+            "fields": fields,
+            "xx_fields": xx_fields}
+
+def read_cubes_index(cubes_index):
+    """
+    Returns the cubes of an index built by `build_cubes_index`:
+       all_cubes -> names of all cubes that exist
+       cubes_lookup -> a `CubesLookup` of field name to compatible cubes
+    """
+    cubes = cubes_index["cubes"]
+    cubes_lookup = CubesLookup({field: {cubes[number] for number in numbers}
+                                for field, numbers in cubes_index["fields"].items()},
+                               cubes_index["xx_fields"])
+    return set(cubes), cubes_lookup
+
+def load_cubes_index(path=CUBES_INDEX_PATH):
+    with open(path, "r") as f:
+        cubes_index = json.load(f)
+    if cubes_index.get("format") != CUBES_INDEX_FORMAT:
+        raise Exception("Unsupported cubes index format {} in {}, rebuild it with "
+                        "`python -m tap_google_analytics.cubes_index`".format(cubes_index.get("format"), path))
+    return cubes_index
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the cubes index shipped with the tap.")
+    parser.add_argument("raw_cubes_path", nargs="?", default=LOCAL_CUBES_PATH)
+    parser.add_argument("--output", default=CUBES_INDEX_PATH)
+    args = parser.parse_args()
+
+    with open(args.raw_cubes_path, "r") as f:
+        cubes_index = build_cubes_index(json.load(f))
+    with open(args.output, "w") as f:
+        json.dump(cubes_index, f, separators=(",", ":"))
+        f.write("\n")
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,15 @@
-import re
+from concurrent.futures import Future, ThreadPoolExecutor
 from functools import reduce
+import threading
 import singer
 from singer import metadata, Schema, CatalogEntry, Catalog
 
+from tap_google_analytics.cubes_index import (CubesLookup,
+                                              build_cubes_index,
+                                              get_cubes_version,
+                                              load_cubes_index,
+                                              match_XX_field,
+                                              read_cubes_index)
 from tap_google_analytics.reports import PREMADE_REPORTS
 
 LOGGER = singer.get_logger()
@@ -128,10 +135,12 @@ def handle_static_XX_field(field, cubes_lookup):
     - Sub Schemas  {"<numeric_field_id>": {...field schema}, ...}
     - Sub Metadata {"numeric_field_id>": {...cubes metadata value}, ...}
     """
-    regex_matcher = field['id'].replace("XX", r'\d\d?')
+    if isinstance(cubes_lookup, CubesLookup):
+        matching_field_ids = cubes_lookup.match_XX_field(field['id'])
+    else:
+        matching_field_ids = match_XX_field(field['id'], cubes_lookup.keys())
     matching_cubes = {field_id: cubes_lookup[field_id]
-                      for field_id in cubes_lookup.keys()
-                      if re.match(regex_matcher, field_id)}
+                      for field_id in matching_field_ids}
 
     sub_schemas = {field_id: type_to_schema(field["dataType"], field["id"])
                    for field_id in matching_cubes.keys()}
@@ -162,6 +171,17 @@ def get_dynamic_fields_named(client, field, profile_id):
         # Skip unknown, or already handled, dynamic fields
         return []
 
+def map_profiles(function, profile_ids, max_workers=1):
+    """
+    Returns {profile_id: function(profile_id)} in the order of
+    `profile_ids`, calling `function` for up to `max_workers` profiles at
+    once.
+    """
+    if max_workers <= 1:
+        return {profile_id: function(profile_id) for profile_id in profile_ids}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(profile_ids, executor.map(function, profile_ids)))
+
 def handle_dynamic_XX_field(client, field, cubes_lookup, profile_ids):
     """
     Discovers dynamic names of a given XX field using `client` with
@@ -343,19 +363,26 @@ def generate_cubes_lookup(raw_cubes):
             cubes_lookup[field].add(raw_cube)
     return cubes_lookup
 
-def parse_cube_definitions(client):
+def parse_cube_definitions(client, check_version=False):
     """
-    Requests cube definitions from Google Metrics and Dimensions
-    Explorer, and parses it into a structure for metadata usage.
+    Loads the cube definitions from the index shipped with the tap (see
+    `cubes_index.py`). If `check_version` is set, cube definitions are
+    also requested from Google Metrics and Dimensions Explorer, and used
+    instead if they differ from the index.
 
     Returns:
        all_cubes -> names of all cubes that exist
        cubes_lookup -> mapping of field name to compatible cubes
     """
-    raw_cubes = client.get_raw_cubes()
-    all_cubes = set(raw_cubes.keys())
-    cubes_lookup = generate_cubes_lookup(raw_cubes)
-    return all_cubes, cubes_lookup
+    cubes_index = load_cubes_index()
+    if check_version:
+        raw_cubes = client.get_raw_cubes()
+        remote_version = get_cubes_version(raw_cubes)
+        if remote_version != cubes_index["version"]:
+            LOGGER.warning("Remote cube definitions (version %s) differ from the packaged index (version %s), "
+                           "using the remote definitions.", remote_version, cubes_index["version"])
+            cubes_index = build_cubes_index(raw_cubes)
+    return read_cubes_index(cubes_index)
 
 def get_custom_metrics(client, profile_id):
     custom_metrics = client.get_custom_metrics_for_profile(profile_id)
@@ -394,6 +421,68 @@ def get_custom_fields(client, profile_id):
     return custom_metrics_and_dimensions
 
 
+class MemoizedClient():
+    """
+    Wraps a client for a single discovery, requesting each Management API
+    resource once per (account, web property[, profile]) however many
+    fields and profiles ask for it, e.g., the goals of a profile for each
+    `ga:goalXX*` field, or the custom fields of a web property shared by
+    several profiles.
+
+    Other attributes are those of the client. Safe to use from several
+    threads: a resource requested while it's already being fetched waits
+    for that request.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.memo = {}
+        self.memo_lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def _memoized(self, key, request):
+        with self.memo_lock:
+            future = self.memo.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = self.memo[key] = Future()
+        if is_owner:
+            try:
+                future.set_result(request())
+            except Exception as ex: # pylint: disable=broad-except
+                future.set_exception(ex)
+        return future.result()
+
+    def get_profiles_for_property(self, account_id, web_property_id):
+        return self._memoized(("profiles", account_id, web_property_id),
+                              lambda: self.client.get_profiles_for_property(account_id, web_property_id))
+
+    def get_goals_for_profile(self, profile_id):
+        return self.get_goals(self.profile_lookup[profile_id]["account_id"],
+                              self.profile_lookup[profile_id]["web_property_id"],
+                              profile_id)
+
+    def get_goals(self, account_id, web_property_id, profile_id):
+        return self._memoized(("goals", account_id, web_property_id, profile_id),
+                              lambda: self.client.get_goals(account_id, web_property_id, profile_id))
+
+    def get_custom_metrics_for_profile(self, profile_id):
+        return self.get_custom_metrics(self.profile_lookup[profile_id]["account_id"],
+                                       self.profile_lookup[profile_id]["web_property_id"])
+
+    def get_custom_metrics(self, account_id, web_property_id):
+        return self._memoized(("customMetrics", account_id, web_property_id),
+                              lambda: self.client.get_custom_metrics(account_id, web_property_id))
+
+    def get_custom_dimensions_for_profile(self, profile_id):
+        return self.get_custom_dimensions(self.profile_lookup[profile_id]["account_id"],
+                                          self.profile_lookup[profile_id]["web_property_id"])
+
+    def get_custom_dimensions(self, account_id, web_property_id):
+        return self._memoized(("customDimensions", account_id, web_property_id),
+                              lambda: self.client.get_custom_dimensions(account_id, web_property_id))
+
 def transform_field(field):
     interesting_attributes = {k: v for k, v in field["attributes"].items()
                               if k in {"dataType", "group", "status", "type"}}
@@ -448,16 +537,38 @@ def generate_catalog(client, report_config, standard_fields, custom_fields, all_
     return Catalog(catalog_entries)
 
 def discover(client, config, profile_ids):
+    """
+    Cube definitions come from the index shipped with the tap, unless
+    `check_cubes_version` is set in `config` and the remote definitions
+    differ (see `parse_cube_definitions`).
+
+    If `discovery_workers` is greater than 1 in `config`, the standard
+    fields, cube definitions and each profile's custom fields are
+    requested concurrently with up to that many requests at once. The
+    catalog is assembled in the same order regardless.
+    """
     # Draw from spike to discover all the things
     # Get field_infos (standard and custom)
     report_config = config.get("report_definitions") or []
-    LOGGER.info("Discovering standard fields...")
-    standard_fields = get_standard_fields(client)
-    LOGGER.info("Discovering custom fields...")
-    custom_fields = {}
-    for profile_id in profile_ids:
-        custom_fields[profile_id] = get_custom_fields(client, profile_id)
-    LOGGER.info("Parsing cube definitions...")
-    all_cubes, cubes_lookup = parse_cube_definitions(client)
+    client = MemoizedClient(client)
+    max_workers = int(config.get("discovery_workers", 1))
+    if max_workers > 1:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            LOGGER.info("Discovering standard fields, custom fields and cube definitions...")
+            standard_fields_future = executor.submit(get_standard_fields, client)
+            cube_definitions_future = executor.submit(parse_cube_definitions, client,
+                                                      config.get("check_cubes_version", False))
+            custom_fields = map_profiles(lambda profile_id: get_custom_fields(client, profile_id),
+                                         profile_ids,
+                                         max_workers)
+            standard_fields = standard_fields_future.result()
+            all_cubes, cubes_lookup = cube_definitions_future.result()
+    else:
+        LOGGER.info("Discovering standard fields...")
+        standard_fields = get_standard_fields(client)
+        LOGGER.info("Discovering custom fields...")
+        custom_fields = map_profiles(lambda profile_id: get_custom_fields(client, profile_id), profile_ids)
+        LOGGER.info("Parsing cube definitions...")
+        all_cubes, cubes_lookup = parse_cube_definitions(client, config.get("check_cubes_version", False))
     LOGGER.info("Generating catalog...")
     return generate_catalog(client, report_config, standard_fields, custom_fields, all_cubes, cubes_lookup, profile_ids)
@@ -0,0 +1,260 @@
+from datetime import timezone
+import itertools
+import os
+import sys
+import uuid
+import simplejson
+import singer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# NB: Kept to report why pyarrow can't be used, e.g., an installed
+# version built against another numpy
+PYARROW_IMPORT_ERROR = None
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError as ex:
+    pyarrow = None
+    PYARROW_IMPORT_ERROR = ex
+
+LOGGER = singer.get_logger()
+
+DEFAULT_BUFFER_RECORDS = 10000
+
+# NB: Rows per file written by `ArrowWriter`, unless partitioned by day first
+DEFAULT_FILE_ROWS = 1000000
+
+def encode_message(message):
+    """ Serializes a message dict as `singer.format_message` does. """
+    return simplejson.dumps(message, use_decimal=True)
+
+def encode_message_orjson(message):
+    """
+    Serializes a message dict with orjson. Its output is compact, UTF-8
+    JSON, which Singer targets parse the same. Values orjson can't
+    represent (e.g., integers over 64 bits) fall back to `encode_message`.
+    """
+    # NB: orjson is a compiled extension, whose members pylint can't see
+    # pylint: disable=no-member
+    try:
+        return orjson.dumps(message).decode('utf-8')
+    except orjson.JSONEncodeError:
+        return encode_message(message)
+
+def get_message_encoder(name):
+    if name in (None, "json"):
+        return encode_message
+    if name == "orjson":
+        if orjson is None:
+            LOGGER.warning("orjson is not installed, serializing messages with json.")
+            return encode_message
+        return encode_message_orjson
+    raise Exception("Config Validation Error: Unknown json_encoder '{}', expected one of: json, orjson.".format(name))
+
+class RecordWriter():
+    """
+    Writes RECORD messages in chunks of up to `buffer_size` serialized
+    records, rather than a write and flush per record.
+
+    Each call to `write_records` flushes its records before returning, so
+    that STATE messages written after a page still follow its records.
+    """
+    def __init__(self, encoder=encode_message, buffer_size=DEFAULT_BUFFER_RECORDS):
+        self.encoder = encoder
+        self.buffer_size = buffer_size
+
+    def write_records(self, stream, records, time_extracted):
+        time_extracted = singer.utils.strftime(time_extracted.astimezone(timezone.utc))
+        buffer = []
+        with singer.metrics.record_counter(stream['name']) as counter:
+            for record in records:
+                # NB: Keys in the same order as `singer.RecordMessage.asdict`
+                buffer.append(self.encoder({"type": "RECORD",
+                                            "stream": stream['name'],
+                                            "record": record,
+                                            "time_extracted": time_extracted}))
+                if len(buffer) >= self.buffer_size:
+                    self._flush(buffer)
+                    counter.increment(len(buffer))
+                    buffer = []
+            if buffer:
+                self._flush(buffer)
+                counter.increment(len(buffer))
+
+    def _flush(self, lines):
+        sys.stdout.write("\n".join(lines) + "\n")
+        sys.stdout.flush()
+
+# NB: File extension of each file output format
+OUTPUT_FORMATS = {"parquet": ".parquet",
+                  "arrow": ".arrow"}
+
+def get_arrow_type_name(field_schema):
+    """
+    Returns the name of the Arrow type of a field from its JSON schema (see
+    `discover.type_to_schema`). Fields of more than one type (`anyOf`) are
+    stored as strings.
+    """
+    if "anyOf" in field_schema:
+        return "string"
+    types = field_schema.get("type", [])
+    types = [t for t in (types if isinstance(types, list) else [types]) if t != "null"]
+    if len(types) != 1:
+        return "string"
+    if types[0] == "string" and field_schema.get("format") == "date-time":
+        return "timestamp"
+    return {"integer": "int64",
+            "number": "float64",
+            "boolean": "bool"}.get(types[0], "string")
+
+def get_partition_dir(output_dir, stream_name, profile_id=None, report_date=None):
+    """ Returns the directory of a stream's files, in `key=value` partitions if given a view and date. """
+    path = os.path.join(output_dir, stream_name)
+    if profile_id is not None:
+        path = os.path.join(path, "profile_id={}".format(profile_id))
+    if report_date is not None:
+        path = os.path.join(path, "report_date={}".format(report_date.strftime("%Y-%m-%d")))
+    return path
+
+def _to_string(value):
+    if value is None or isinstance(value, str):
+        return value
+    return str(value)
+
+def _compile_timestamp_converter():
+    memo = {}
+
+    def to_timestamp(value):
+        if value is None:
+            return None
+        if value not in memo:
+            memo[value] = singer.utils.strptime_to_utc(value)
+        return memo[value]
+    return to_timestamp
+
+# pylint: disable=too-many-instance-attributes
+class ArrowWriter():
+    """
+    Writes records to Parquet or Arrow IPC files instead of RECORD
+    messages, with a column per field typed from the stream's schema (see
+    `get_arrow_type_name`).
+
+    Pages are given column by column (see `write_columns`) and buffered
+    per stream, and written to a file under
+    `output_dir/<stream>/` once `file_rows` rows are buffered or on
+    `flush`. If `partition` is set, a file is written per view and day
+    under `profile_id=<view>/report_date=<date>/` partitions, once the
+    stream moves on to the next day. Files are written under a temporary
+    name and renamed once complete, and `earliest_buffered_date` tells
+    which days are not written yet, so that STATE messages only follow
+    complete files.
+    """
+    def __init__(self, output_dir, output_format="parquet", partition=False, file_rows=DEFAULT_FILE_ROWS):
+        if output_format not in OUTPUT_FORMATS:
+            raise Exception("Config Validation Error: Unknown output_format '{}', expected one of: {}.".format(
+                output_format, ", ".join(["singer"] + list(OUTPUT_FORMATS))))
+        if pyarrow is None:
+            raise Exception("Config Validation Error: output_format '{}' requires pyarrow, install it with "
+                            "`pip install tap-google-analytics[arrow]` (import failed with: {})".format(
+                                output_format, PYARROW_IMPORT_ERROR))
+        self.output_dir = output_dir
+        self.output_format = output_format
+        self.partition = partition
+        self.file_rows = file_rows
+        # NB: Names files uniquely across writers and syncs to the same directory
+        self.file_prefix = "part-{}".format(uuid.uuid4().hex)
+        self.file_numbers = itertools.count()
+        self.stream_schemas = {}
+        # NB: Keyed by (stream id, profile_id, report_date) if partitioned,
+        # and by (stream id,) otherwise
+        self.buffers = {}
+
+    def _get_stream_schema(self, stream, fields):
+        key = (stream['id'], tuple(fields))
+        if key not in self.stream_schemas:
+            properties = stream['schema'].get('properties', {})
+            arrow_fields = []
+            converters = []
+            for field in fields:
+                type_name = get_arrow_type_name(properties[field])
+                if type_name == "timestamp":
+                    arrow_fields.append(pyarrow.field(field, pyarrow.timestamp("us", tz="UTC")))
+                    converters.append(_compile_timestamp_converter())
+                else:
+                    arrow_fields.append(pyarrow.field(field, getattr(pyarrow, type_name)()))
+                    converters.append(_to_string if type_name == "string" else None)
+            self.stream_schemas[key] = (pyarrow.schema(arrow_fields), converters)
+        return self.stream_schemas[key]
+
+    def write_columns(self, stream, fields, columns, profile_id, report_date):
+        """
+        Buffers a page given as a list of the values of each of `fields`,
+        which must all be in the stream's schema (see
+        `sync.transform_stream_columns`).
+        """
+        if not columns or not columns[0]:
+            return
+        arrow_schema, converters = self._get_stream_schema(stream, fields)
+        arrays = []
+        for column, converter, field in zip(columns, converters, arrow_schema):
+            if converter is not None:
+                column = [converter(value) for value in column]
+            arrays.append(pyarrow.array(column, type=field.type))
+        table = pyarrow.Table.from_arrays(arrays, schema=arrow_schema)
+        if self.partition:
+            key = (stream['id'], profile_id, report_date)
+            # NB: A stream's days come in order, so earlier days are complete
+            for other_key in [k for k in self.buffers if k[:2] == key[:2] and k != key]:
+                self._flush_buffer(other_key)
+        else:
+            key = (stream['id'],)
+        buffer = self.buffers.setdefault(key, {"stream": stream,
+                                               "profile_id": profile_id,
+                                               "report_date": report_date,
+                                               "tables": [],
+                                               "row_count": 0})
+        buffer["tables"].append(table)
+        buffer["row_count"] += table.num_rows
+
+        with singer.metrics.record_counter(stream['name']) as counter:
+            counter.increment(table.num_rows)
+
+        if buffer["row_count"] >= self.file_rows:
+            self._flush_buffer(key)
+
+    def earliest_buffered_date(self, stream_id):
+        """ Returns the earliest report date with records of the stream not yet written to a file, if any. """
+        return min((buffer["report_date"] for key, buffer in self.buffers.items() if key[0] == stream_id),
+                   default=None)
+
+    def flush(self):
+        """ Writes the records buffered for every stream to files. """
+        for key in list(self.buffers):
+            self._flush_buffer(key)
+
+    def _flush_buffer(self, key):
+        buffer = self.buffers.pop(key)
+        stream = buffer["stream"]
+        if self.partition:
+            directory = get_partition_dir(self.output_dir, stream['name'], buffer["profile_id"], buffer["report_date"])
+        else:
+            directory = get_partition_dir(self.output_dir, stream['name'])
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, "{}-{:05d}{}".format(self.file_prefix,
+                                                           next(self.file_numbers),
+                                                           OUTPUT_FORMATS[self.output_format]))
+        self._write_table(pyarrow.concat_tables(buffer["tables"]), path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    def _write_table(self, table, path):
+        if self.output_format == "parquet":
+            pyarrow.parquet.write_table(table, path)
+        else:
+            with pyarrow.OSFile(path, "wb") as sink:
+                with pyarrow.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
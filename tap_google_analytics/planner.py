@@ -0,0 +1,54 @@
+import singer
+
+LOGGER = singer.get_logger()
+
+# Docs: https://developers.google.com/analytics/devguides/reporting/core/v4/rest/v4/reports/batchGet#ReportRequest
+MAX_METRICS_PER_QUERY = 10
+MAX_DIMENSIONS_PER_QUERY = 7
+
+def can_merge(query, stream):
+    """
+    A stream can share a query if it selects exactly the same dimensions,
+    the union of metrics stays within the API's limit, and some cube still
+    supports every field of both.
+    """
+    if set(query["dimensions"]) != set(stream["dimensions"]):
+        return False
+    if len(query["dimensions"]) > MAX_DIMENSIONS_PER_QUERY:
+        return False
+    if len(set(query["metrics"]) | set(stream["metrics"])) > MAX_METRICS_PER_QUERY:
+        return False
+    if query["cubes"] is None or stream["cubes"] is None:
+        return False
+    return bool(query["cubes"] & stream["cubes"])
+
+def plan_report_queries(streams):
+    """
+    Groups `streams` into the queries needed to sync them, merging streams
+    that select the same dimensions into a single query with the union of
+    their metrics. Streams that can't be merged get a query of their own.
+
+    `streams` is a list of dicts with at least `tap_stream_id`, `metrics`,
+    `dimensions`, and `cubes` (the set of cubes supporting all selected
+    fields, or None if unknown).
+
+    Returns a list of queries in the order their first stream appears:
+    [{"metrics": [...], "dimensions": [...], "cubes": {...}, "streams": [stream, ...]}, ...]
+    """
+    queries = []
+    for stream in streams:
+        query = next((q for q in queries if can_merge(q, stream)), None)
+        if query is None:
+            queries.append({"metrics": list(stream["metrics"]),
+                            "dimensions": list(stream["dimensions"]),
+                            "cubes": stream["cubes"],
+                            "streams": [stream]})
+            continue
+
+        query["metrics"].extend(m for m in stream["metrics"] if m not in query["metrics"])
+        query["cubes"] = query["cubes"] & stream["cubes"]
+        query["streams"].append(stream)
+        LOGGER.info("Merging stream %s into the query for %s",
+                    stream["tap_stream_id"],
+                    query["streams"][0]["tap_stream_id"])
+    return queries
@@ -0,0 +1,111 @@
+import threading
+import time
+import singer
+
+LOGGER = singer.get_logger()
+
+# Docs:
+# https://developers.google.com/analytics/devguides/reporting/core/v4/limits-quotas
+# https://developers.google.com/analytics/devguides/config/mgmt/v3/limits-quotas
+DEFAULT_QUOTA_LIMITS = {
+    "reporting": {"per_second": 10,
+                  "per_100_seconds": 2000,
+                  "per_user_per_100_seconds": 100,
+                  "per_day": 50000,
+                  "per_view_per_day": 10000},
+    "management": {"per_second": 10,
+                   "per_100_seconds": None,
+                   "per_day": 50000},
+}
+
+QUOTA_PERIODS = {"per_second": 1,
+                 "per_100_seconds": 100,
+                 "per_user_per_100_seconds": 100,
+                 "per_day": 86400,
+                 "per_view_per_day": 86400}
+
+# NB: Budgets counted separately for each view, rather than across all of
+# a limiter's requests
+PER_VIEW_QUOTAS = {"per_view_per_day"}
+
+class TokenBucket():
+    """
+    A bucket of `capacity` tokens that refills continuously over `period`
+    seconds.
+
+    Reservations may take the bucket below zero, in which case the caller
+    is told how long to wait for its token. This queues concurrent callers
+    one behind the other rather than having them all wake up and race for
+    the next token.
+    """
+    def __init__(self, capacity, period, now):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = capacity
+        self.last_update = now
+
+    def reserve(self, now):
+        """ Takes a token and returns the seconds to wait before using it. """
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_update) * self.rate)
+        self.last_update = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+class QuotaLimiter():
+    """
+    Paces requests to each API family (see `DEFAULT_QUOTA_LIMITS`) under
+    all of its configured budgets at once. A single limiter is meant to be
+    shared by every thread or task making requests with one set of
+    credentials, which all count against the same user's budgets. Budgets
+    per view are kept for each view requested.
+
+    `quota_limits` overrides the defaults per family and period, e.g.,
+    {"reporting": {"per_100_seconds": 1000}}. A period set to null is not
+    limited.
+    """
+    def __init__(self, quota_limits=None, clock=time.monotonic):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.limits = {}
+        self.buckets = {}
+        self.view_buckets = {}
+        now = clock()
+        for api_family, default_limits in DEFAULT_QUOTA_LIMITS.items():
+            limits = {**default_limits, **(quota_limits or {}).get(api_family, {})}
+            self.limits[api_family] = {period: float(limit) for period, limit in limits.items() if limit}
+            self.buckets[api_family] = [TokenBucket(limit, QUOTA_PERIODS[period], now)
+                                        for period, limit in self.limits[api_family].items()
+                                        if period not in PER_VIEW_QUOTAS]
+
+    def get_view_buckets(self, api_family, view_id, now):
+        key = (api_family, view_id)
+        if key not in self.view_buckets:
+            self.view_buckets[key] = [TokenBucket(limit, QUOTA_PERIODS[period], now)
+                                      for period, limit in self.limits[api_family].items()
+                                      if period in PER_VIEW_QUOTAS]
+        return self.view_buckets[key]
+
+    def reserve(self, api_family, view_id=None):
+        """
+        Reserves a request for `api_family` against every budget, and the
+        budgets of `view_id` if given, returning the seconds to wait before
+        sending it.
+        """
+        if api_family not in self.buckets:
+            return 0
+        with self.lock:
+            now = self.clock()
+            buckets = self.buckets[api_family]
+            if view_id is not None:
+                buckets = buckets + self.get_view_buckets(api_family, view_id, now)
+            delay = max((bucket.reserve(now) for bucket in buckets), default=0)
+        if delay > 1:
+            LOGGER.info("Pacing %s request for %.1f seconds to stay under quota.", api_family, delay)
+        return delay
+
+    def wait(self, api_family, view_id=None):
+        delay = self.reserve(api_family, view_id)
+        if delay > 0:
+            time.sleep(delay)
@@ -0,0 +1,304 @@
+import codecs
+from collections import deque
+import json
+
+# NB: Bytes read from the response at a time
+CHUNK_SIZE = 64 * 1024
+
+WHITESPACE = " \t\n\r"
+
+_DECODER = json.JSONDecoder()
+
+def decode_chunks(byte_chunks):
+    """ Decodes UTF-8 chunks, including characters split between chunks. """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    for chunk in byte_chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+class JsonStreamReader():
+    """
+    Reads JSON from an iterable of text chunks, keeping only what hasn't
+    been read yet in memory.
+    """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """ Returns the next character that isn't whitespace, without reading it. """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON response")
+
+    def expect(self, chars):
+        """ Reads the next character, which must be one of `chars`. """
+        char = self.peek()
+        if char not in chars:
+            raise ValueError("Expected one of {!r} in JSON response, found {!r}".format(chars, char))
+        self.pos += 1
+        return char
+
+    def read_value(self):
+        """ Reads a whole JSON value, e.g., a row. """
+        self.peek()
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # NB: A number ending the buffer may continue in the next chunk
+            if end == len(self.buffer) and not self.eof and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def object_keys(self):
+        """ Yields the keys of an object after its "{", reading its separators. """
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.read_value()
+            self.expect(":")
+            yield key
+            if self.expect(",}") == "}":
+                return
+
+    def array_items(self):
+        """ Yields before each item of an array after its "[", reading its separators. """
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield
+            if self.expect(",]") == "]":
+                return
+
+class LazyObject(dict):
+    """
+    A JSON object of a streamed response that may not have been read in
+    full yet. Keys already read are returned straight away, while looking
+    up any other key reads the response up to that key, or to the end of
+    the object if it's missing.
+    """
+    def __init__(self, response):
+        super().__init__()
+        self.response = response
+        self.complete = False
+
+    def _read_key(self, key):
+        while not self.complete and not dict.__contains__(self, key) and self.response.read_next():
+            pass
+
+    def _read_all(self):
+        if not self.complete:
+            self.response.read_until_complete(self)
+
+    def __getitem__(self, key):
+        self._read_key(key)
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        self._read_key(key)
+        return dict.get(self, key, default)
+
+    def __contains__(self, key):
+        self._read_key(key)
+        return dict.__contains__(self, key)
+
+    def keys(self):
+        self._read_all()
+        return dict.keys(self)
+
+    def items(self):
+        self._read_all()
+        return dict.items(self)
+
+    def values(self):
+        self._read_all()
+        return dict.values(self)
+
+    def __iter__(self):
+        self._read_all()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self._read_all()
+        return dict.__len__(self)
+
+    def __eq__(self, other):
+        self._read_all()
+        return dict.__eq__(self, other)
+
+    __hash__ = None
+
+    def __reduce__(self):
+        # NB: Pickled (e.g., for a transform process) as a plain dict
+        return (dict, (dict(self.items()),))
+
+class RowStream():
+    """
+    The rows of a streamed report, decoded as they are iterated. Rows can
+    only be iterated once, unless the report is read past them first, in
+    which case they are kept in memory.
+
+    `len` is the number of rows in the report, whether or not they've been
+    iterated, once they've all been read.
+    """
+    def __init__(self, response):
+        self.response = response
+        self.pending = deque()
+        self.row_count = 0
+        self.complete = False
+        self.iterated = False
+
+    def __iter__(self):
+        if self.iterated:
+            raise RuntimeError("The rows of a streamed report can only be read once.")
+        self.iterated = True
+        while True:
+            if self.pending:
+                yield self.pending.popleft()
+            elif self.complete or not self.response.read_next():
+                return
+
+    def __bool__(self):
+        while not self.pending and not self.complete and self.response.read_next():
+            pass
+        return bool(self.pending)
+
+    def __len__(self):
+        self.response.read_until_complete(self)
+        return self.row_count
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+class StreamedResponse():
+    """
+    Parses a `reports:batchGet` response incrementally from `chunks` of
+    text, so that rows are decoded as they're consumed rather than the
+    whole response at once.
+
+    `reports()` yields each report as a dict whose `columnHeader` is
+    readable as soon as the report starts and whose `data.rows` is a
+    `RowStream`. Keys sent after the rows (e.g., `isDataGolden` and
+    `nextPageToken`) are read when they're looked up, which keeps any rows
+    not read yet in memory.
+    """
+    def __init__(self, chunks):
+        self.reader = JsonStreamReader(chunks)
+        self.parsed_reports = []
+        self.done = False
+        self.parser = self._parse()
+
+    @classmethod
+    def from_response(cls, response):
+        return cls(decode_chunks(response.iter_content(CHUNK_SIZE)))
+
+    def read_next(self):
+        """ Parses up to the next row or object, returning False at the end. """
+        if self.done:
+            return False
+        try:
+            next(self.parser)
+        except StopIteration:
+            self.done = True
+        return not self.done
+
+    def read_until_complete(self, value):
+        while not value.complete and self.read_next():
+            pass
+
+    def reports(self):
+        index = 0
+        while True:
+            while index >= len(self.parsed_reports) and self.read_next():
+                pass
+            if index >= len(self.parsed_reports):
+                return
+            yield self.parsed_reports[index]
+            index += 1
+
+    def _parse(self):
+        reader = self.reader
+        reader.expect("{")
+        for key in reader.object_keys():
+            if key != "reports":
+                reader.read_value()
+                continue
+            reader.expect("[")
+            for _ in reader.array_items():
+                report = LazyObject(self)
+                self.parsed_reports.append(report)
+                yield
+                yield from self._parse_object(report, "data", self._parse_data)
+
+    def _parse_data(self, data):
+        yield from self._parse_object(data, "rows", self._parse_rows)
+
+    def _parse_rows(self, rows):
+        reader = self.reader
+        for _ in reader.array_items():
+            rows.pending.append(reader.read_value())
+            rows.row_count += 1
+            yield
+
+    def _parse_object(self, obj, streamed_key, parse_streamed_value):
+        """ Reads `obj`, handing the value of `streamed_key` to `parse_streamed_value`. """
+        reader = self.reader
+        reader.expect("{")
+        for key in reader.object_keys():
+            if key != streamed_key:
+                dict.__setitem__(obj, key, reader.read_value())
+                continue
+            if streamed_key == "rows":
+                value = RowStream(self)
+                reader.expect("[")
+            else:
+                value = LazyObject(self)
+            dict.__setitem__(obj, key, value)
+            yield
+            yield from parse_streamed_value(value)
+            value.complete = True
+        obj.complete = True
+
+def read_all_rows(raw_report):
+    """
+    Reads the rows of a streamed page into a list, and the rest of its
+    report, for pages that are read more than once or on another thread
+    than the one requesting pages. Other pages are left as they are.
+
+    NB: Only one thread may read a streamed response, so this must be
+    called on the thread iterating `Client.get_reports`.
+    """
+    report = raw_report["reports"][0]
+    data = report.get("data", {})
+    rows = data.get("rows")
+    if isinstance(rows, RowStream):
+        dict.__setitem__(data, "rows", list(rows))
+    if isinstance(report, LazyObject):
+        report.response.read_until_complete(report)
+    return raw_report
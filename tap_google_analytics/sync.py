@@ -1,11 +1,31 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import timedelta, datetime
 import hashlib
+import itertools
 import json
+import multiprocessing
+from json.encoder import encode_basestring_ascii
+import queue
+import sys
+import threading
 import singer
-from singer import Transformer
+
+from .converter import compile_record_converter
+from .output import RecordWriter, ArrowWriter, get_message_encoder, DEFAULT_BUFFER_RECORDS, DEFAULT_FILE_ROWS
+from .planner import MAX_METRICS_PER_QUERY
+from .streaming import read_all_rows, RowStream
 
 LOGGER = singer.get_logger()
 
+# NB: Views may be synced from several threads, so writing records and
+# state for a page happens under this lock to keep messages whole and state
+# consistent when it is serialized
+OUTPUT_LOCK = threading.RLock()
+
+# NB: Fields added to every record, as in `discover.generate_base_schema`
+REPORT_FIELDS = ["_sdc_record_hash", "start_date", "end_date", "account_id", "web_property_id", "profile_id"]
+
 def generate_sdc_record_hash(raw_report, row, start_date, end_date):
     """
     Generates a SHA 256 hash to be used as the primary key for records
@@ -41,6 +61,43 @@ def generate_sdc_record_hash(raw_report, row, start_date, end_date):
     hash_source_bytes = json.dumps(hash_source_data).encode('utf-8')
     return hashlib.sha256(hash_source_bytes).hexdigest()
 
+class RecordHasher():
+    """
+    Generates the same hashes as `generate_sdc_record_hash` for every row
+    of a page, serializing and hashing the parts shared by the page once.
+
+    The hash source is produced with the same text as `json.dumps`: the
+    constant prefix of IDs is hashed up front and copied for each row,
+    the dimension headers are sorted and encoded once, and only each
+    row's dimension values are encoded per row.
+    """
+    def __init__(self, raw_report, start_date, end_date):
+        dimensions_headers = raw_report["reports"][0]["columnHeader"].get("dimensions", [])
+        prefix = json.dumps([raw_report["accountId"],
+                             raw_report["webPropertyId"],
+                             raw_report["profileId"]])[:-1] + ", ["
+        self.prefix_hash = hashlib.sha256(prefix.encode('utf-8'))
+        self.suffix = "], {}, {}]".format(json.dumps(start_date.strftime("%Y-%m-%d")),
+                                          json.dumps(end_date.strftime("%Y-%m-%d"))).encode('utf-8')
+        # NB: A stable sort of the positions orders duplicate headers as
+        # sorting the (header, value) pairs does
+        self.sorted_positions = sorted(range(len(dimensions_headers)), key=lambda i: dimensions_headers[i])
+        self.encoded_headers = ["[" + json.dumps(header) + ", " for header in dimensions_headers]
+
+    def hash_row(self, row):
+        values = row.get("dimensions", [])
+        positions = self.sorted_positions
+        if len(values) < len(positions):
+            positions = [i for i in positions if i < len(values)]
+        pairs = ", ".join(self.encoded_headers[i] +
+                          (encode_basestring_ascii(values[i]) if isinstance(values[i], str) else json.dumps(values[i])) +
+                          "]"
+                          for i in positions)
+        row_hash = self.prefix_hash.copy()
+        row_hash.update(pairs.encode('utf-8'))
+        row_hash.update(self.suffix)
+        return row_hash.hexdigest()
+
 
 def generate_report_dates(start_date, end_date):
     total_days = (end_date - start_date).days
@@ -48,6 +105,324 @@ def generate_report_dates(start_date, end_date):
     for day_offset in range(total_days + 1):
         yield start_date + timedelta(days=day_offset)
 
+class WindowSizer():
+    """
+    Sizes the date windows requested for a report on one view.
+
+    A window that comes back sampled is split in half until its parts are
+    unsampled, and the windows after it start from that smaller size.
+    `sampled` records whether this happened, so the size can be kept for
+    the next sync (see `next_window_days`).
+    """
+    def __init__(self, window_days=1, max_window_days=None):
+        self.window_days = window_days
+        self.max_window_days = max(max_window_days or window_days, window_days)
+        self.sampled = False
+        self.lock = threading.Lock()
+
+    def windows(self, start_date, end_date):
+        """
+        Yields inclusive (window_start, window_end) date ranges covering
+        start_date through end_date, each of the current window size.
+        """
+        window_start = start_date
+        while window_start <= end_date:
+            window_end = min(window_start + timedelta(days=self.window_days - 1), end_date)
+            yield window_start, window_end
+            window_start = window_end + timedelta(days=1)
+
+    def record_sampled(self, window):
+        """ Halves the window size after a sampled window. Single days can't be split, so are ignored. """
+        window_start, window_end = window
+        if window_start == window_end:
+            return
+        half_window_days = ((window_end - window_start).days + 2) // 2
+        with self.lock:
+            self.sampled = True
+            self.window_days = min(self.window_days, half_window_days)
+
+    def next_window_days(self):
+        """
+        Returns the size to start from on the next sync: the size reached
+        if windows came back sampled, and otherwise double the current
+        size, up to `max_window_days`, so that larger windows are tried
+        again once sampling has stopped.
+        """
+        if self.sampled:
+            return self.window_days
+        return min(self.window_days * 2, self.max_window_days)
+
+def get_date_dimension(dimensions):
+    """
+    Returns the selected dimension that identifies the day of each row, if
+    any, which allows requesting several days at once.
+    """
+    return next((d for d in dimensions if d in DATETIME_FORMATS), None)
+
+def is_sampled(raw_report):
+    return bool(raw_report["reports"][0].get("data", {}).get("samplesReadCounts"))
+
+def escape_filter_value(value):
+    return value.replace("\\", "\\\\").replace(",", "\\,").replace(";", "\\;")
+
+def get_shard_filters(report, sampling_shards):
+    """
+    Returns filter expressions that partition a report's rows on the
+    configured shard dimension, one per listed value plus one for all other
+    values. Sharding is only exact if the dimension is selected, as
+    otherwise rows would be summed across shards, so no filters are
+    returned in that case, nor if no values are listed.
+
+    sampling_shards = {"dimension": "ga:deviceCategory",
+                       "values": ["desktop", "mobile", "tablet"]}
+    """
+    dimension = (sampling_shards or {}).get("dimension")
+    values = [escape_filter_value(value) for value in (sampling_shards or {}).get("values") or []]
+    if dimension not in report['dimensions'] or not values:
+        return []
+    return (["{}=={}".format(dimension, value) for value in values]
+            + [";".join("{}!={}".format(dimension, value) for value in values)])
+
+def split_metrics(metrics):
+    return [metrics[i:i + MAX_METRICS_PER_QUERY]
+            for i in range(0, len(metrics), MAX_METRICS_PER_QUERY)]
+
+def join_metric_group_pages(pages_per_group):
+    """
+    Joins the pages of requests that each fetched a group of a report's
+    metrics with the same dimensions into a single page with every metric,
+    matching rows on their dimension values.
+
+    The API omits rows where all metrics are zero, so a row missing from
+    one group's pages has zeros for that group's metrics.
+    """
+    first_page = pages_per_group[0][0]
+    column_header = first_page["reports"][0]["columnHeader"]
+
+    metric_header_entries = []
+    for pages in pages_per_group:
+        metric_header_entries.extend(pages[0]["reports"][0]["columnHeader"]["metricHeader"]["metricHeaderEntries"])
+
+    rows = {}
+    is_data_golden = True
+    sampling = {}
+    offset = 0
+    for pages in pages_per_group:
+        group_size = len(pages[0]["reports"][0]["columnHeader"]["metricHeader"]["metricHeaderEntries"])
+        for page in pages:
+            data = page["reports"][0].get("data", {})
+            is_data_golden = is_data_golden and bool(data.get("isDataGolden"))
+            if data.get("samplesReadCounts"):
+                sampling = {"samplesReadCounts": data["samplesReadCounts"],
+                            "samplingSpaceSizes": data.get("samplingSpaceSizes")}
+            for row in data.get("rows", []):
+                values = rows.setdefault(tuple(row.get("dimensions", [])), ["0"] * len(metric_header_entries))
+                values[offset:offset + group_size] = row["metrics"][0]["values"]
+        offset += group_size
+
+    joined_rows = [{"dimensions": list(dimension_values), "metrics": [{"values": values}]}
+                   for dimension_values, values in rows.items()]
+    return {**first_page,
+            "reports": [{"columnHeader": {**column_header,
+                                          "metricHeader": {"metricHeaderEntries": metric_header_entries}},
+                         "data": {"rows": joined_rows,
+                                  "rowCount": len(joined_rows),
+                                  "isDataGolden": is_data_golden,
+                                  **sampling}}],
+            "metrics": [entry["name"] for entry in metric_header_entries]}
+
+def get_query_pages(client, report, window):
+    """
+    Returns the pages of a report for a window of one or more days.
+
+    Reports with more metrics than the API allows in one request are split
+    into groups of metrics with the same dimensions, which are fetched in
+    the same batch call and joined into a single page.
+    """
+    window_start, window_end = window
+    if len(report['metrics']) <= MAX_METRICS_PER_QUERY and window_start == window_end and not report.get('filters'):
+        return client.get_report(report['name'], report['profile_id'],
+                                 window_start, report['metrics'],
+                                 report['dimensions'])
+
+    if len(report['metrics']) <= MAX_METRICS_PER_QUERY:
+        report_requests = get_query_requests(report, window, [report.get('filters')])
+        return (page for _, page in client.get_reports(report['name'], report_requests))
+    return get_filtered_query_pages(client, report, window, [report.get('filters')])
+
+def get_query_requests(report, window, filters):
+    """ Returns the report requests for each group of the report's metrics with each filter expression in `filters`. """
+    window_start, window_end = window
+    return [{"profile_id": report['profile_id'],
+             "report_date": window_start,
+             "end_date": window_end,
+             "metrics": metrics,
+             "dimensions": report['dimensions'],
+             "filters": filter_expression}
+            for filter_expression in filters
+            for metrics in split_metrics(report['metrics'])]
+
+def get_filtered_query_pages(client, report, window, filters):
+    """
+    Returns a list of the pages of a report for a window with each filter
+    expression in `filters`, e.g., the shards of `get_shard_filters`. The
+    requests for every filter and group of metrics are made in the same
+    batch calls, and the groups of each filter are joined into a page (see
+    `join_metric_group_pages`).
+    """
+    group_count = len(split_metrics(report['metrics']))
+    report_requests = get_query_requests(report, window, filters)
+    pages_per_request = [[] for _ in report_requests]
+    for index, page in client.get_reports(report['name'], report_requests):
+        pages_per_request[index].append(page)
+    if group_count == 1:
+        return [page for pages in pages_per_request for page in pages]
+    return [join_metric_group_pages(pages_per_request[i:i + group_count])
+            for i in range(0, len(report_requests), group_count)]
+
+def get_unsampled_pages(client, report, window, window_sizer, sampling_shards=None):
+    """
+    Returns a list of (window, pages) covering `window`.
+
+    If the report comes back sampled, multi-day windows are split in half
+    and requested again, recursively. Sampled single days are requested in
+    shards of the `sampling_shards` dimension instead, when it is
+    configured and selected, or kept as they are otherwise.
+    """
+    window_start, window_end = window
+    if window_start == window_end and not get_shard_filters(report, sampling_shards):
+        # NB: Such a day would be kept as it is anyway, so it's checked after
+        # its first page is read, as streamed responses only give sampling
+        # after the rows
+        return [(window, check_sampled_day(report, window, window_sizer,
+                                           get_query_pages(client, report, window)))]
+
+    pages = iter(get_query_pages(client, report, window))
+    first_page = next(pages, None)
+    if first_page is None:
+        return [(window, [])]
+    if not is_sampled(first_page):
+        return [(window, itertools.chain([first_page], pages))]
+
+    window_sizer.record_sampled(window)
+    if window_start < window_end:
+        LOGGER.info("Report %s for view_id %s is sampled from %s to %s, splitting the date range.",
+                    report['name'], report['profile_id'],
+                    window_start.strftime("%Y-%m-%d"), window_end.strftime("%Y-%m-%d"))
+        middle = window_start + timedelta(days=(window_end - window_start).days // 2)
+        return (get_unsampled_pages(client, report, (window_start, middle), window_sizer, sampling_shards)
+                + get_unsampled_pages(client, report, (middle + timedelta(days=1), window_end), window_sizer, sampling_shards))
+
+    shard_filters = get_shard_filters(report, sampling_shards)
+    if not shard_filters:
+        LOGGER.warning("Report %s for view_id %s is sampled on %s.",
+                       report['name'], report['profile_id'], window_start.strftime("%Y-%m-%d"))
+        return [(window, itertools.chain([first_page], pages))]
+
+    LOGGER.info("Report %s for view_id %s is sampled on %s, requesting it in shards of %s.",
+                report['name'], report['profile_id'], window_start.strftime("%Y-%m-%d"), sampling_shards['dimension'])
+    shard_pages = get_filtered_query_pages(client, report, window, shard_filters)
+    if any(is_sampled(page) for page in shard_pages):
+        LOGGER.warning("Report %s for view_id %s is still sampled on %s after sharding.",
+                       report['name'], report['profile_id'], window_start.strftime("%Y-%m-%d"))
+    return [(window, shard_pages)]
+
+def check_sampled_day(report, window, window_sizer, pages):
+    """ Yields `pages`, warning once the first has been read if it is sampled. """
+    for page_number, page in enumerate(pages):
+        yield page
+        if page_number == 0 and is_sampled(page):
+            window_sizer.record_sampled(window)
+            LOGGER.warning("Report %s for view_id %s is sampled on %s.",
+                           report['name'], report['profile_id'], window[0].strftime("%Y-%m-%d"))
+
+def fetch_report_pages(client, report, window, window_sizer, sampling_shards=None):
+    return [(unsampled_window, list(pages))
+            for unsampled_window, pages in get_unsampled_pages(client, report, window, window_sizer, sampling_shards)]
+
+def split_window_pages(report, window, pages):
+    """
+    Yields (report_date, pages) for each day of the window.
+
+    Multi-day windows are split on the report's date dimension into a page
+    per day, shaped as if that day had been requested on its own, so that
+    records and their hashes are the same as with single-day requests. Every
+    day of a window shares the window's `isDataGolden`.
+    """
+    window_start, window_end = window
+    if window_start == window_end:
+        yield window_start, pages
+        return
+
+    pages = list(pages)
+    first_report = pages[0]["reports"][0]
+    date_index = first_report["columnHeader"]["dimensions"].index(get_date_dimension(report['dimensions']))
+
+    report_dates = list(generate_report_dates(window_start, window_end))
+    rows_per_date = {report_date.strftime("%Y%m%d"): [] for report_date in report_dates}
+    is_data_golden = True
+    for page in pages:
+        data = page["reports"][0].get("data", {})
+        is_data_golden = is_data_golden and bool(data.get("isDataGolden"))
+        for row in data.get("rows", []):
+            rows_per_date[row["dimensions"][date_index][:8]].append(row)
+
+    for report_date in report_dates:
+        rows = rows_per_date[report_date.strftime("%Y%m%d")]
+        yield report_date, [{**pages[0],
+                             "reports": [{"columnHeader": first_report["columnHeader"],
+                                          "data": {"rows": rows,
+                                                   "rowCount": len(rows),
+                                                   "isDataGolden": is_data_golden}}],
+                             "reportDate": report_date}]
+
+def get_report_pages(client, report, windows, window_sizer, max_workers=1, sampling_shards=None):
+    """
+    Returns a generator of (window, pages) covering each window in
+    `windows`, in date order. Sampled windows are covered by several
+    smaller windows (see `get_unsampled_pages`).
+
+    With more than one worker, up to `max_workers` windows are fetched
+    concurrently ahead of the caller, and each window's pages are held in
+    memory until the caller reaches that window.
+    """
+    if max_workers <= 1:
+        for window in windows:
+            yield from get_unsampled_pages(client, report, window, window_sizer, sampling_shards)
+        return
+
+    windows = iter(windows)
+    fetch_args = (window_sizer, sampling_shards)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = deque()
+        for window in windows:
+            in_flight.append(executor.submit(fetch_report_pages, client, report, window, *fetch_args))
+            if len(in_flight) >= max_workers:
+                break
+
+        while in_flight:
+            future = in_flight.popleft()
+            # NB: Keep the pool busy with the next window while the caller
+            # processes this one
+            next_window = next(windows, None)
+            if next_window is not None:
+                in_flight.append(executor.submit(fetch_report_pages, client, report, next_window, *fetch_args))
+            yield from future.result()
+
+def get_day_pages(client, report, windows, window_sizer, max_workers=1, sampling_shards=None, read_whole_pages=False):
+    """
+    Yields (report_date, raw_report_response) for each page of each day
+    in `windows` (see `get_report_pages` and `split_window_pages`), with
+    streamed pages read whole first if `read_whole_pages` is set.
+    """
+    for window, window_pages in get_report_pages(client, report, windows, window_sizer,
+                                                 max_workers, sampling_shards):
+        for report_date, raw_report_responses in split_window_pages(report, window, window_pages):
+            for raw_report_response in raw_report_responses:
+                if read_whole_pages:
+                    read_all_rows(raw_report_response)
+                yield report_date, raw_report_response
+
 def report_to_records(raw_report):
     """
     Parse a single report object into Singer records, with added runtime info and PK.
@@ -56,21 +431,27 @@ def report_to_records(raw_report):
     per request. For optimizations, the structure of the response will
     change, and this will need to be refactored.
     """
+    # NB: Sampled responses are requested again with smaller date ranges
+    # or in shards before they get here (see `get_unsampled_pages`)
     # TODO: Handle data sampling keys and values, either in the records or as a separate stream? They look like arrays.
     # - https://developers.google.com/analytics/devguides/reporting/core/v4/rest/v4/reports/batchGet#ReportData
     report = raw_report["reports"][0]
     column_headers = report["columnHeader"]
     metrics_headers = [mh["name"] for mh in column_headers["metricHeader"]["metricHeaderEntries"]]
     dimensions_headers = column_headers.get("dimensions", [])
+    rows = report.get("data", {}).get("rows", [])
+    if not rows:
+        return
+    report_date = raw_report["reportDate"]
+    # NB: Equivalent to `generate_sdc_record_hash` for each row
+    hasher = RecordHasher(raw_report, report_date, report_date)
 
-    for row in report.get("data", {}).get("rows", []):
+    for row in rows:
         record = {}
         record.update(zip(dimensions_headers, row.get("dimensions", [])))
         record.update(zip(metrics_headers, row["metrics"][0]["values"]))
 
-        report_date = raw_report["reportDate"]
-        _sdc_record_hash = generate_sdc_record_hash(raw_report, row, report_date, report_date)
-        record["_sdc_record_hash"] = _sdc_record_hash
+        record["_sdc_record_hash"] = hasher.hash_row(row)
 
         report_date_string = report_date.strftime("%Y-%m-%d")
         record["start_date"] = report_date_string
@@ -88,14 +469,544 @@ DATETIME_FORMATS = {
     "ga:date": '%Y%m%d',
 }
 
+# NB: Lengths of the compressed values of each datetime format
+DATETIME_LENGTHS = {
+    "ga:dateHour": 10,
+    "ga:dateHourMinute": 12,
+    "ga:date": 8,
+}
+
+def format_datetime(field_name, value):
+    """
+    Formats a compressed datetime value (e.g., "2019110123" for
+    `ga:dateHour`) as a Singer datetime string, by slicing rather than
+    parsing it. Values of an unexpected shape are parsed with strptime.
+    """
+    if len(value) != DATETIME_LENGTHS[field_name] or not value.isdigit():
+        return datetime.strptime(value, DATETIME_FORMATS[field_name]).strftime(singer.utils.DATETIME_FMT)
+    # NB: Constructing the datetime validates the value as strptime would
+    datetime(int(value[0:4]), int(value[4:6]), int(value[6:8]), int(value[8:10] or 0), int(value[10:12] or 0))
+    return "{}-{}-{}T{}:{}:00.000000Z".format(value[0:4],
+                                              value[4:6],
+                                              value[6:8],
+                                              value[8:10] or "00",
+                                              value[10:12] or "00")
+
 def transform_datetimes(rec):
     """ Datetimes have a compressed format, so this ensures they parse correctly. """
     for field_name, value in rec.items():
         if value and field_name in DATETIME_FORMATS:
-            rec[field_name] = datetime.strptime(value, DATETIME_FORMATS[field_name]).strftime(singer.utils.DATETIME_FMT)
+            rec[field_name] = format_datetime(field_name, value)
     return rec
 
-def sync_report(client, schema, report, start_date, end_date, state):
+def get_datetimes_transform(raw_report):
+    """
+    Returns a version of `transform_datetimes` for the records of a page,
+    which only looks at the page's datetime columns and remembers each
+    value formatted, as a day's page usually has a single `ga:date`.
+    """
+    dimensions_headers = raw_report["reports"][0].get("columnHeader", {}).get("dimensions", [])
+    datetime_fields = [d for d in dimensions_headers if d in DATETIME_FORMATS]
+    formatted_values = {}
+
+    def transform_page_datetimes(rec):
+        for field_name in datetime_fields:
+            value = rec.get(field_name)
+            if value:
+                try:
+                    rec[field_name] = formatted_values[(field_name, value)]
+                except KeyError:
+                    rec[field_name] = formatted_values[(field_name, value)] = format_datetime(field_name, value)
+        return rec
+    return transform_page_datetimes
+
+# NB: Marks a value missing from a row shorter than the column headers
+MISSING = object()
+
+def transpose(values_per_row, width):
+    """ Returns `width` columns of the values in each row, as `zip` pairs them with headers. """
+    if all(len(values) == width for values in values_per_row):
+        return list(zip(*values_per_row)) if width else []
+    return [tuple(values[i] if i < len(values) else MISSING for values in values_per_row)
+            for i in range(width)]
+
+def is_nonzero(value):
+    try:
+        return float(value or 0) != 0
+    except ValueError:
+        return True
+
+class ColumnarPage():
+    """
+    The rows of a page stored column-wise, with a tuple of values for each
+    dimension, metric and the record hash, and the fields shared by every
+    row (report dates and IDs) stored once. Records are only built as
+    dicts by `records`, at output.
+
+    Each step of `transform_stream_records` returns a new page, sharing
+    the columns it doesn't change.
+    """
+    def __init__(self, fields, columns, constants, row_count):
+        self.fields = fields
+        self.columns = columns
+        self.constants = constants
+        self.row_count = row_count
+
+    @classmethod
+    def from_raw_report(cls, raw_report):
+        """
+        Returns the page of `raw_report`, or None if its rows are streamed
+        or its headers aren't unique, which are left to `report_to_records`.
+        """
+        report = raw_report["reports"][0]
+        rows = report.get("data", {}).get("rows", [])
+        if isinstance(rows, RowStream):
+            return None
+        if not rows:
+            return cls([], [], [], 0)
+
+        column_headers = report["columnHeader"]
+        metrics_headers = [mh["name"] for mh in column_headers["metricHeader"]["metricHeaderEntries"]]
+        dimensions_headers = column_headers.get("dimensions", [])
+        fields = dimensions_headers + metrics_headers + ["_sdc_record_hash"]
+        if len(set(fields)) != len(fields):
+            return None
+
+        report_date = raw_report["reportDate"]
+        hasher = RecordHasher(raw_report, report_date, report_date)
+        columns = (transpose([row.get("dimensions", []) for row in rows], len(dimensions_headers))
+                   + transpose([row["metrics"][0]["values"] for row in rows], len(metrics_headers))
+                   + [tuple(hasher.hash_row(row) for row in rows)])
+
+        report_date_string = report_date.strftime("%Y-%m-%d")
+        constants = [("start_date", report_date_string),
+                     ("end_date", report_date_string),
+                     ("account_id", raw_report["accountId"]),
+                     ("web_property_id", raw_report["webPropertyId"]),
+                     ("profile_id", raw_report["profileId"])]
+        return cls(fields, columns, constants, len(rows))
+
+    def for_stream(self, stream_metrics, other_metrics):
+        """
+        Returns the page without `other_metrics`, keeping only the rows
+        with a non-zero value in `stream_metrics` if there are any (see
+        `has_nonzero_metric`).
+        """
+        if not other_metrics:
+            return self
+        columns_by_field = dict(zip(self.fields, self.columns))
+        metric_columns = [columns_by_field[m] for m in stream_metrics if m in columns_by_field]
+        kept_rows = [i for i in range(self.row_count)
+                     if any(is_nonzero(None if column[i] is MISSING else column[i]) for column in metric_columns)]
+        kept = [(field, column) for field, column in zip(self.fields, self.columns) if field not in other_metrics]
+        return ColumnarPage([field for field, _ in kept],
+                            [tuple(column[i] for i in kept_rows) for _, column in kept],
+                            self.constants,
+                            len(kept_rows))
+
+    def format_datetimes(self):
+        """ Returns the page with its compressed datetime columns formatted (see `format_datetime`). """
+        columns = list(self.columns)
+        for index, field in enumerate(self.fields):
+            if field not in DATETIME_FORMATS:
+                continue
+            formatted_values = {}
+            for value in set(columns[index]):
+                if value and value is not MISSING:
+                    formatted_values[value] = format_datetime(field, value)
+            columns[index] = tuple(formatted_values.get(value, value) if value else value
+                                   for value in columns[index])
+        return ColumnarPage(self.fields, columns, self.constants, self.row_count)
+
+    def convert(self, convert_record):
+        """
+        Returns the page converted column by column with the field
+        converters of a `RecordConverter`, or None if it can't be, in
+        which case its records are converted one by one.
+        """
+        if convert_record.field_converters is None:
+            return None
+        if convert_record.keep_all:
+            return self
+
+        fields, columns = [], []
+        for field, column in zip(self.fields, self.columns):
+            converter = convert_record.field_converters.get(field)
+            if converter is None:
+                continue
+            converted_column = []
+            for value in column:
+                if value is not MISSING:
+                    success, value = converter(value)
+                    if not success:
+                        return None
+                converted_column.append(value)
+            fields.append(field)
+            columns.append(converted_column)
+
+        constants = []
+        for field, value in self.constants:
+            converter = convert_record.field_converters.get(field)
+            if converter is None:
+                continue
+            success, value = converter(value)
+            if not success:
+                return None
+            constants.append((field, value))
+        return ColumnarPage(fields, columns, constants, self.row_count)
+
+    def to_columns(self, fields):
+        """
+        Returns a list of the values of each of `fields`, with None where a
+        row or the page doesn't have it, for columnar output.
+        """
+        columns_by_field = dict(zip(self.fields, self.columns))
+        constants = dict(self.constants)
+        columns = []
+        for field in fields:
+            if field in columns_by_field:
+                columns.append([None if value is MISSING else value for value in columns_by_field[field]])
+            elif field in constants:
+                columns.append([constants[field]] * self.row_count)
+            else:
+                columns.append([None] * self.row_count)
+        return columns
+
+    def records(self):
+        constants = dict(self.constants)
+        if not self.columns:
+            for _ in range(self.row_count):
+                yield dict(constants)
+            return
+        for values in zip(*self.columns):
+            record = {field: value for field, value in zip(self.fields, values) if value is not MISSING}
+            record.update(constants)
+            yield record
+
+def has_nonzero_metric(record, metrics):
+    """
+    The API omits rows whose metrics are all zero. A stream sharing a query
+    may see rows that are only non-zero in another stream's metrics, so
+    these are dropped to return the same rows as the stream's own query.
+    """
+    for metric in metrics:
+        try:
+            if float(record.get(metric) or 0) != 0:
+                return True
+        except ValueError:
+            return True
+    return False
+
+def transform_stream_records(stream, raw_report_response, query_metrics, convert_record, page=None):
+    """
+    Yields the records of a page for `stream`, with only its own metrics,
+    transformed to its schema by `convert_record` (see
+    `compile_record_converter`).
+
+    If the page's `ColumnarPage` is given, the page is transformed column
+    by column, and records are only built at the end.
+    """
+    other_metrics = [m for m in query_metrics if m not in stream['metrics']]
+    if page is not None:
+        stream_page = page.for_stream(stream['metrics'], other_metrics).format_datetimes()
+        converted_page = stream_page.convert(convert_record)
+        if converted_page is not None:
+            yield from converted_page.records()
+        else:
+            # NB: Converted one by one to fail on the same record with the same error
+            for rec in stream_page.records():
+                yield convert_record(rec)
+        return
+
+    transform_page_datetimes = get_datetimes_transform(raw_report_response)
+    for rec in report_to_records(raw_report_response):
+        if other_metrics:
+            if not has_nonzero_metric(rec, stream['metrics']):
+                continue
+            for metric in other_metrics:
+                rec.pop(metric, None)
+        yield convert_record(transform_page_datetimes(rec))
+
+def transform_stream_columns(stream, raw_report_response, query_metrics, convert_record, fields, page=None):
+    """
+    Returns a list of the values of each of `fields` in the records
+    `transform_stream_records` yields for a page, for columnar output.
+    Pages that can be converted column by column keep their columns.
+    """
+    if page is not None:
+        other_metrics = [m for m in query_metrics if m not in stream['metrics']]
+        converted_page = page.for_stream(stream['metrics'], other_metrics).format_datetimes().convert(convert_record)
+        if converted_page is not None:
+            return converted_page.to_columns(fields)
+    records = list(transform_stream_records(stream, raw_report_response, query_metrics, convert_record, page))
+    return [[record.get(field) for record in records] for field in fields]
+
+def transform_page(report_date, raw_report_response, streams, query_metrics, converters, stream_fields=None,
+                   materialize=False):
+    """
+    Returns a list of (stream, records) for each stream syncing
+    `report_date`, with `converters` of each stream ID. Records are
+    given as columns of the fields in `stream_fields`, if given (see
+    `transform_stream_columns`), and as a list if `materialize` is set.
+    """
+    page = ColumnarPage.from_raw_report(raw_report_response)
+    stream_records = []
+    for stream in streams:
+        if report_date < stream['start_date']:
+            continue
+        if stream_fields is not None:
+            stream_records.append((stream, transform_stream_columns(stream, raw_report_response, query_metrics,
+                                                                    converters[stream['id']],
+                                                                    stream_fields[stream['id']], page)))
+            continue
+        records = transform_stream_records(stream, raw_report_response, query_metrics, converters[stream['id']], page)
+        # NB: Without a pipeline, records stream straight from each page to output
+        stream_records.append((stream, list(records) if materialize else records))
+    return stream_records
+
+def write_records(stream, records, time_extracted):
+    with singer.metrics.record_counter(stream['name']) as counter:
+        for record in records:
+            singer.write_record(stream["name"], record, time_extracted=time_extracted)
+            counter.increment()
+
+def write_messages(stream, messages):
+    """
+    Writes RECORD messages already serialized by `format_page_messages`,
+    which hold their own `time_extracted`.
+    """
+    with singer.metrics.record_counter(stream['name']) as counter:
+        if messages:
+            sys.stdout.write("\n".join(messages) + "\n")
+            sys.stdout.flush()
+        counter.increment(len(messages))
+
+def get_transform_pool(config):
+    """
+    Returns a pool of `transform_processes` from config to share across
+    the views and queries of a sync, or None if it isn't set.
+
+    NB: The pool's processes are spawned rather than forked, since the tap
+    is already running threads (e.g., `view_workers`, `day_workers` and
+    `buffer_in_thread`) whose locks a forked process would inherit held.
+    """
+    processes = int(config.get('transform_processes', 0))
+    if processes <= 0:
+        return None
+    return ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+
+# NB: Kept by each transform process, so each query's schemas are only
+# compiled once per process rather than once per page
+_TRANSFORM_CONVERTERS = {}
+_MAX_TRANSFORM_CONVERTERS = 64
+_TRANSFORM_KEYS = itertools.count()
+
+def get_transform_converters(transform_key, streams):
+    if transform_key not in _TRANSFORM_CONVERTERS:
+        if len(_TRANSFORM_CONVERTERS) >= _MAX_TRANSFORM_CONVERTERS:
+            _TRANSFORM_CONVERTERS.clear()
+        _TRANSFORM_CONVERTERS[transform_key] = [compile_record_converter(stream['schema']) for stream in streams]
+    return _TRANSFORM_CONVERTERS[transform_key]
+
+def format_page_messages(transform_key, streams, query_metrics, json_encoder, report_date, raw_report_response,
+                         time_extracted):
+    """
+    Runs in a transform process, returning a list of (stream_index,
+    messages) with the serialized RECORD messages of each stream syncing
+    `report_date`.
+    """
+    output = []
+    converters = get_transform_converters(transform_key, streams)
+    encode_message = get_message_encoder(json_encoder)
+    page = ColumnarPage.from_raw_report(raw_report_response)
+    for stream_index, stream in enumerate(streams):
+        if report_date < stream['start_date']:
+            continue
+        messages = [encode_message(singer.RecordMessage(stream=stream['name'],
+                                                        record=record,
+                                                        time_extracted=time_extracted).asdict())
+                    for record in transform_stream_records(stream, raw_report_response, query_metrics,
+                                                           converters[stream_index], page)]
+        output.append((stream_index, messages))
+    return output
+
+def transform_in_processes(pages, streams, query_metrics, transform_pool, processes, json_encoder=None):
+    """
+    Sends each (report_date, raw_report_response) in `pages` to
+    `transform_pool` (see `get_transform_pool`) to be transformed and
+    serialized, yielding the results in page order. Up to twice as many
+    pages as `processes` are in flight.
+    """
+    transform_key = "{}-{}".format(id(transform_pool), next(_TRANSFORM_KEYS))
+    in_flight = deque()
+    for report_date, raw_report_response in pages:
+        time_extracted = singer.utils.now()
+        in_flight.append((report_date, raw_report_response, time_extracted,
+                          transform_pool.submit(format_page_messages, transform_key, streams, query_metrics,
+                                                json_encoder, report_date, raw_report_response, time_extracted)))
+        while len(in_flight) > processes * 2 or (in_flight and in_flight[0][3].done()):
+            yield _transformed_page(streams, *in_flight.popleft())
+    while in_flight:
+        yield _transformed_page(streams, *in_flight.popleft())
+
+def _transformed_page(streams, report_date, raw_report_response, time_extracted, future):
+    stream_messages = [(streams[stream_index], messages) for stream_index, messages in future.result()]
+    return report_date, raw_report_response, stream_messages, time_extracted
+
+# NB: Sentinel marking the end of a buffered iterable
+_DONE = object()
+
+def buffer_in_thread(iterable, depth):
+    """
+    Consumes `iterable` on a background thread, keeping up to `depth`
+    items ready ahead of the caller. Exceptions raised by `iterable` are
+    re-raised to the caller, and closing the returned generator stops the
+    background thread.
+    """
+    items = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((_DONE, None))
+        except Exception as ex: # pylint: disable=broad-except
+            put((_DONE, ex))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, ex = items.get()
+            if ex is not None:
+                raise ex
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        stopped.set()
+        producer.join()
+
+def get_stream_fields(stream, dimensions):
+    """
+    Returns the fields of a stream's records, in the order of its schema:
+    the report's dimensions, the stream's metrics and the report fields.
+    """
+    fields = set(dimensions) | set(stream['metrics']) | set(REPORT_FIELDS)
+    return [field for field in stream['schema'].get('properties', {}) if field in fields]
+
+def write_report_date_bookmark(state, stream, profile_id, report_date):
+    bookmark = singer.get_bookmark(state, stream["id"], profile_id, default={})
+    return singer.write_bookmark(state,
+                                 stream["id"],
+                                 profile_id,
+                                 {**bookmark, 'last_report_date': report_date.strftime("%Y-%m-%d")})
+
+def write_written_bookmarks(state, streams, profile_id, bookmark_dates, arrow_writer):
+    """
+    Bookmarks each stream at its date in `bookmark_dates`, or at the
+    earliest day with records still buffered by `arrow_writer` if that is
+    before it, and writes STATE if any bookmark moved. A bookmarked day is
+    synced again on the next sync, so its own records may be buffered.
+    """
+    bookmarked = False
+    for stream in streams:
+        report_date = bookmark_dates.get(stream['id'])
+        if report_date is None:
+            continue
+        buffered_date = arrow_writer.earliest_buffered_date(stream['id'])
+        if buffered_date is not None and buffered_date < report_date:
+            report_date = buffered_date
+        bookmark = singer.get_bookmark(state, stream["id"], profile_id, default={})
+        if bookmark.get('last_report_date') != report_date.strftime("%Y-%m-%d"):
+            write_report_date_bookmark(state, stream, profile_id, report_date)
+            bookmarked = True
+    if bookmarked:
+        singer.write_state(state)
+
+def get_max_window_days(config, report):
+    """ Returns `date_window_days` in config, or 1 if the report has no date dimension to split windows on. """
+    if not get_date_dimension(report['dimensions']):
+        return 1
+    return max(int(config.get('date_window_days', 1)), 1)
+
+def get_window_days(config, report, state):
+    """
+    Returns the number of days to request at once for a report on a view:
+    the smaller of `date_window_days` in config and any size bookmarked
+    by its streams on a previous sync (see `WindowSizer.next_window_days`).
+    """
+    if not get_date_dimension(report['dimensions']):
+        return 1
+    window_days = [get_max_window_days(config, report)]
+    for stream in report['streams']:
+        bookmark = singer.get_bookmark(state, stream['id'], report['profile_id'], default={})
+        if bookmark.get('date_window_days'):
+            window_days.append(int(bookmark['date_window_days']))
+    return max(min(window_days), 1)
+
+def get_arrow_writer(config):
+    """ Returns an `ArrowWriter` if `output_format` in config is a file format, and None for Singer output. """
+    if config.get('output_format', 'singer') == 'singer':
+        return None
+    return ArrowWriter(config.get('output_dir') or '.',
+                       config['output_format'],
+                       config.get('output_partition', False),
+                       int(config.get('output_file_rows') or DEFAULT_FILE_ROWS))
+
+def get_record_writer(config):
+    """ Returns the function writing a stream's records as RECORD messages, buffered if configured. """
+    if config.get('output_buffer_records') or config.get('json_encoder'):
+        return RecordWriter(get_message_encoder(config.get('json_encoder')),
+                            int(config.get('output_buffer_records') or DEFAULT_BUFFER_RECORDS)).write_records
+    return write_records
+
+def pipeline_pages(pages, transform_pages, streams, query_metrics, pipeline_depth, transform_processes,
+                   json_encoder=None, transform_pool=None):
+    """
+    Returns a generator of (report_date, raw_report_response,
+    stream_records, time_extracted) for each of `pages`, transformed by
+    `transform_pages(pages, materialize)`, or serialized in
+    `transform_pool` of `transform_processes` (see
+    `transform_in_processes`). With a
+    `pipeline_depth`, pages are fetched and transformed on background
+    threads (see `buffer_in_thread`).
+    """
+    if pipeline_depth > 0:
+        pages = buffer_in_thread(pages, pipeline_depth)
+    if transform_processes > 0:
+        return transform_in_processes(pages, streams, query_metrics, transform_pool, transform_processes,
+                                      json_encoder)
+    if pipeline_depth > 0:
+        return buffer_in_thread(transform_pages(pages, True), pipeline_depth)
+    return transform_pages(pages, False)
+
+def write_window_days_bookmarks(state, streams, profile_id, window_sizer):
+    """ Bookmarks the window size to start the next sync from, if it changed (see `WindowSizer.next_window_days`). """
+    window_days = window_sizer.next_window_days()
+    if not window_sizer.sampled and window_days == window_sizer.window_days:
+        return
+    with OUTPUT_LOCK:
+        for stream in streams:
+            bookmark = singer.get_bookmark(state, stream["id"], profile_id, default={})
+            singer.write_bookmark(state,
+                                  stream["id"],
+                                  profile_id,
+                                  {**bookmark, 'date_window_days': window_days})
+        singer.write_state(state)
+
+def sync_report(client, schema, report, start_date, end_date, state, config=None):
     """
     Run a sync, beginning from either the start_date or bookmarked date,
     requesting a report per day, until the last full day of data. (e.g.,
@@ -106,38 +1017,143 @@ def sync_report(client, schema, report, start_date, end_date, state):
               "metrics": metrics,
               "dimensions": dimensions}
     """
-    LOGGER.info("Syncing %s for view_id %s", report['name'], report['profile_id'])
-    all_data_golden = True
-    # TODO: Is it better to query by multiple days if `ga:date` is present?
-    # - If so, we can optimize the calls here to generate date ranges and reduce request volume
-    for report_date in generate_report_dates(start_date, end_date):
-        for raw_report_response in client.get_report(report['name'], report['profile_id'],
-                                                     report_date, report['metrics'],
-                                                     report['dimensions']):
-
-            with singer.metrics.record_counter(report['name']) as counter:
-                time_extracted = singer.utils.now()
-                with Transformer() as transformer:
-                    for rec in report_to_records(raw_report_response):
-                        singer.write_record(report["name"],
-                                            transformer.transform(
-                                                transform_datetimes(rec),
-                                                schema),
-                                            time_extracted=time_extracted)
-                        counter.increment()
-
-                # NB: Bookmark all days with "golden" data until you find the first non-golden day
-                # - "golden" refers to data that will not change in future
-                #   requests, so we can use it as a bookmark
-                is_data_golden = raw_report_response["reports"][0]["data"].get("isDataGolden")
-
-                if all_data_golden:
-                    singer.write_bookmark(state,
-                                          report["id"],
-                                          report['profile_id'],
-                                          {'last_report_date': report_date.strftime("%Y-%m-%d")})
-                    singer.write_state(state)
+    stream = {"name": report["name"],
+              "id": report["id"],
+              "schema": schema,
+              "metrics": report["metrics"],
+              "start_date": start_date}
+    sync_report_streams(client, {**report, "streams": [stream]}, end_date, state, config)
+
+def sync_report_streams(client, report, end_date, state, config=None, transform_pool=None):
+    """
+    Run a sync of a single query shared by one or more streams, beginning
+    from the earliest of their start dates and requesting a report per day
+    until the last full day of data. Each stream gets the rows of each day
+    from its own start date, with only its own metrics, and is bookmarked
+    separately.
+
+    If `day_workers` is greater than 1 in `config`, that many days (or
+    windows) are requested concurrently. Records and bookmarks are still
+    written in date order.
+
+    If `date_window_days` is greater than 1 in `config` and the report has
+    a date dimension (e.g., `ga:date`), up to that many days are requested
+    at once and split back into a day each. Windows that come back sampled
+    are split until they are not, and the smaller size is bookmarked per
+    view as `date_window_days` to start from on the next sync, which
+    doubles again on each sync without sampling. Sampled days are
+    requested in shards if `sampling_shards` is configured (see
+    `get_shard_filters`).
+
+    If `pipeline_depth` is set in `config`, fetching pages, transforming
+    records, and writing output run as separate stages, each keeping up
+    to that many pages ready for the next.
+
+    If `transform_processes` is set in `config`, records are transformed
+    and serialized by a pool of that many processes instead, and written
+    in page order. The pool is `transform_pool` if given, so it can be
+    shared across views (see `get_transform_pool`).
+
+    If `output_buffer_records` or `json_encoder` (`json` or `orjson`) is
+    set in `config`, records are serialized with that encoder and written
+    in chunks of up to that many records (see `RecordWriter`).
+
+    If `output_format` is `parquet` or `arrow` in `config`, records are
+    written to files under `output_dir` instead, of up to
+    `output_file_rows` rows, or partitioned by view and report date if
+    `output_partition` is set (see `ArrowWriter`). SCHEMA and STATE
+    messages are still written to stdout, and a stream is only bookmarked
+    past days whose records are written.
+
+    report = {"name": query_name,
+              "profile_id": view_id,
+              "metrics": union_of_stream_metrics,
+              "dimensions": dimensions,
+              "streams": [{"name": stream.stream,
+                           "id": stream.tap_stream_id,
+                           "schema": schema,
+                           "metrics": metrics,
+                           "start_date": start_date}, ...]}
+    """
+    config = config or {}
+    if transform_pool is None and int(config.get('transform_processes', 0)) > 0:
+        with get_transform_pool(config) as pool:
+            sync_report_streams(client, report, end_date, state, config, pool)
+        return
+    streams = report["streams"]
+    LOGGER.info("Syncing %s for view_id %s", ", ".join(s['name'] for s in streams), report['profile_id'])
+    all_data_golden = {stream['id']: True for stream in streams}
+    start_date = min(stream['start_date'] for stream in streams)
+    window_sizer = WindowSizer(get_window_days(config, report, state), get_max_window_days(config, report))
+    max_workers = int(config.get('day_workers', 1))
+    pipeline_depth = int(config.get('pipeline_depth', 0))
+    transform_processes = int(config.get('transform_processes', 0))
+
+    # NB: Streamed pages (see `Client.get_reports`) can only be read on the
+    # thread requesting them, and their rows only once, so pages handed to
+    # another thread or read by several streams are read whole first
+    read_whole_pages = pipeline_depth > 0 or transform_processes > 0 or len(streams) > 1
+
+    # NB: Each stream's schema is compiled once for the whole sync
+    converters = {stream['id']: compile_record_converter(stream['schema']) for stream in streams}
+
+    # NB: With `view_workers`, each page's records are read and transformed
+    # before taking OUTPUT_LOCK, so views only wait on each other's writes
+    def transform_pages(pages, materialize):
+        for report_date, raw_report_response in pages:
+            stream_records = transform_page(report_date, raw_report_response, streams, report['metrics'],
+                                            converters, stream_fields if arrow_writer else None,
+                                            materialize or int(config.get('view_workers', 1)) > 1)
+            yield report_date, raw_report_response, stream_records, singer.utils.now()
+
+    arrow_writer = get_arrow_writer(config)
+    if arrow_writer and transform_processes > 0:
+        LOGGER.warning("transform_processes only applies to Singer output, transforming records in process.")
+        transform_processes = 0
+    stream_fields = {stream['id']: get_stream_fields(stream, report['dimensions']) for stream in streams}
+    # NB: Report dates to bookmark for each stream once the records before
+    # them are written to files
+    bookmark_dates = {}
+
+    write_output = get_record_writer(config)
+    pages = get_day_pages(client, report, window_sizer.windows(start_date, end_date), window_sizer, max_workers,
+                          config.get('sampling_shards'), read_whole_pages)
+    transformed_pages = pipeline_pages(pages, transform_pages, streams, report['metrics'],
+                                       pipeline_depth, transform_processes, config.get('json_encoder'),
+                                       transform_pool)
+
+    for report_date, raw_report_response, stream_records, time_extracted in transformed_pages:
+        # NB: Bookmark all days with "golden" data until you find the first non-golden day
+        # - "golden" refers to data that will not change in future
+        #   requests, so we can use it as a bookmark
+        is_data_golden = raw_report_response["reports"][0]["data"].get("isDataGolden")
+
+        with OUTPUT_LOCK:
+            for stream, records in stream_records:
+                if arrow_writer:
+                    arrow_writer.write_columns(stream, stream_fields[stream['id']], records,
+                                               report['profile_id'], report_date)
+                elif transform_processes > 0:
+                    write_messages(stream, records)
+                else:
+                    write_output(stream, records, time_extracted)
+
+                if all_data_golden[stream['id']]:
+                    if arrow_writer:
+                        bookmark_dates[stream['id']] = report_date
+                    else:
+                        write_report_date_bookmark(state, stream, report['profile_id'], report_date)
+                        singer.write_state(state)
                     if not is_data_golden:
                         # Stop bookmarking on first "isDataGolden": False
-                        all_data_golden = False
-    LOGGER.info("Done syncing %s for view_id %s", report['name'], report['profile_id'])
+                        all_data_golden[stream['id']] = False
+            if arrow_writer:
+                write_written_bookmarks(state, streams, report['profile_id'], bookmark_dates, arrow_writer)
+
+    if arrow_writer:
+        with OUTPUT_LOCK:
+            arrow_writer.flush()
+            write_written_bookmarks(state, streams, report['profile_id'], bookmark_dates, arrow_writer)
+
+    write_window_days_bookmarks(state, streams, report['profile_id'], window_sizer)
+    LOGGER.info("Done syncing %s for view_id %s", ", ".join(s['name'] for s in streams), report['profile_id'])
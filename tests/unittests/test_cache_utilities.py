@@ -0,0 +1,83 @@
+import tempfile
+import unittest
+from unittest.mock import Mock, patch
+
+from tap_google_analytics.cache import ManagementCache, get_resource_type
+from tap_google_analytics.client import Client, GOALS_URL, ACCOUNT_SUMMARIES_URL
+
+GOALS = GOALS_URL.format(accountId="1", webPropertyId="UA-1", profileId="12345")
+
+class TestManagementCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.cache_dir.cleanup)
+
+    def cache(self, token_identity="token", **kwargs):
+        return ManagementCache(self.cache_dir.name, token_identity, **kwargs)
+
+    def test_resource_types(self):
+        self.assertEqual("goals", get_resource_type(GOALS))
+        self.assertEqual("accountSummaries", get_resource_type(ACCOUNT_SUMMARIES_URL + "?start-index=1"))
+
+    def test_responses_are_cached_per_url_params_and_token(self):
+        self.cache().put(GOALS, {"start-index": 1}, {"items": [{"id": "1"}]})
+
+        self.assertEqual({"items": [{"id": "1"}]}, self.cache().get(GOALS, {"start-index": 1}))
+        self.assertIsNone(self.cache().get(GOALS, {"start-index": 2}))
+        self.assertIsNone(self.cache("another token").get(GOALS, {"start-index": 1}))
+
+    def test_responses_expire_after_their_ttl(self):
+        with patch("time.time", return_value=1000):
+            self.cache().put(GOALS, None, {"items": []})
+        with patch("time.time", return_value=1059):
+            self.assertEqual({"items": []}, self.cache(ttls={"goals": 60}).get(GOALS))
+        with patch("time.time", return_value=1060):
+            self.assertIsNone(self.cache(ttls={"goals": 60}).get(GOALS))
+
+    def test_force_refresh_ignores_cached_responses(self):
+        self.cache().put(GOALS, None, {"items": []})
+        self.assertIsNone(self.cache(force_refresh=True).get(GOALS))
+
+    def test_client_requests_cached_responses_once(self):
+        def get_client():
+            client = Client({"auth_method": "oauth2",
+                             "refresh_token": "a_refresh_token",
+                             "client_id": "a_client_id",
+                             "client_secret": "a_client_secret",
+                             "management_cache_dir": self.cache_dir.name})
+            client.get = Mock(return_value=Mock(json=Mock(return_value={"items": [{"id": "1"}]})))
+            return client
+
+        first_client = get_client()
+        second_client = get_client()
+        self.assertEqual(["1"], first_client.get_goals("1", "UA-1", "12345"))
+        self.assertEqual(["1"], second_client.get_goals("1", "UA-1", "12345"))
+        self.assertEqual(1, first_client.get.call_count)
+        self.assertEqual(0, second_client.get.call_count)
+
+    def test_profiles_missing_from_cached_account_summaries_are_requested_again(self):
+        def get_client(profile_ids):
+            client = Client({"auth_method": "oauth2",
+                             "refresh_token": "a_refresh_token",
+                             "client_id": "a_client_id",
+                             "client_secret": "a_client_secret",
+                             "management_cache_dir": self.cache_dir.name})
+            summaries = {"items": [{"id": "1", "webProperties": [{"id": "UA-1",
+                                                                  "profiles": [{"id": p} for p in profile_ids]}]}]}
+            client.get = Mock(return_value=Mock(json=Mock(return_value=summaries)))
+            return client
+
+        first_client = get_client(["111"])
+        self.assertEqual("UA-1", first_client.profile_lookup["111"]["web_property_id"])
+
+        # NB: View 222 was added to the account after the summaries were cached
+        second_client = get_client(["111", "222"])
+        self.assertEqual("UA-1", second_client.profile_lookup["111"]["web_property_id"])
+        self.assertEqual(0, second_client.get.call_count)
+        self.assertEqual("UA-1", second_client.profile_lookup["222"]["web_property_id"])
+        self.assertEqual(1, second_client.get.call_count)
+
+        with self.assertRaises(KeyError):
+            second_client.profile_lookup["333"] # pylint: disable=pointless-statement
+        self.assertEqual(1, second_client.get.call_count)
+        self.assertIn("222", get_client([]).profile_lookup)
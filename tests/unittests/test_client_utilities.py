@@ -0,0 +1,488 @@
+import asyncio
+import json
+import pickle
+import random
+import unittest
+from unittest.mock import Mock, MagicMock, AsyncMock, patch
+import requests
+from singer import utils
+
+from tap_google_analytics.client import Client, PageSizer, ProfileLookup, MAX_PAGE_SIZE, get_remaining_page_tokens
+from tap_google_analytics.streaming import StreamedResponse, decode_chunks
+from tap_google_analytics.async_client import AsyncClient, AsyncResponseError, BufferedResponse, \
+    should_giveup_async, aiohttp, RETRYABLE_TRANSPORT_ERRORS
+
+def get_test_client():
+    client = Client({"auth_method": "oauth2",
+                     "refresh_token": "a_refresh_token",
+                     "client_id": "a_client_id",
+                     "client_secret": "a_client_secret"})
+    client.profile_lookup = {"12345": {"web_property_id": "UA-1", "account_id": "1"},
+                             "67890": {"web_property_id": "UA-2", "account_id": "2"}}
+    return client
+
+def mock_batch_response(reports):
+    response = Mock()
+    response.json.return_value = {"reports": reports}
+    response.content = json.dumps({"reports": reports}).encode()
+    return response
+
+class TestGetReports(unittest.TestCase):
+    def setUp(self):
+        self.client = get_test_client()
+        self.report_date = utils.strptime_to_utc("2019-11-01")
+
+    def report_request(self, profile_id, metric, report_date=None):
+        return {"profile_id": profile_id,
+                "report_date": report_date or self.report_date,
+                "metrics": [metric],
+                "dimensions": ["ga:date"]}
+
+    def test_batches_up_to_five_requests_per_call(self):
+        report_requests = [self.report_request("12345", "ga:metric{}".format(i)) for i in range(7)]
+        self.client.post = MagicMock(side_effect=[mock_batch_response([{"id": i} for i in range(5)]),
+                                                  mock_batch_response([{"id": i} for i in range(5, 7)])])
+
+        actual = [(index, report["reports"][0]["id"])
+                  for index, report in self.client.get_reports("test_report", report_requests)]
+
+        self.assertEqual([(i, i) for i in range(7)], actual)
+        self.assertEqual(2, self.client.post.call_count)
+        first_body = self.client.post.call_args_list[0][0][1]
+        self.assertEqual(5, len(first_body["reportRequests"]))
+
+    def test_groups_requests_by_view_and_date(self):
+        other_date = utils.strptime_to_utc("2019-11-02")
+        report_requests = [self.report_request("12345", "ga:users"),
+                           self.report_request("67890", "ga:users"),
+                           self.report_request("12345", "ga:sessions"),
+                           self.report_request("12345", "ga:users", other_date)]
+        self.client.post = MagicMock(side_effect=[mock_batch_response([{}, {}]),
+                                                  mock_batch_response([{}]),
+                                                  mock_batch_response([{}])])
+
+        actual = [(index, report["profileId"], report["accountId"])
+                  for index, report in self.client.get_reports("test_report", report_requests)]
+
+        self.assertEqual([(0, "12345", "1"), (2, "12345", "1"), (1, "67890", "2"), (3, "12345", "1")], actual)
+        for call in self.client.post.call_args_list:
+            view_ids = {r["viewId"] for r in call[0][1]["reportRequests"]}
+            date_ranges = {str(r["dateRanges"]) for r in call[0][1]["reportRequests"]}
+            self.assertEqual(1, len(view_ids))
+            self.assertEqual(1, len(date_ranges))
+
+    def test_date_ranges_are_requested_and_batched_separately(self):
+        end_date = utils.strptime_to_utc("2019-11-07")
+        report_requests = [{**self.report_request("12345", "ga:users"), "end_date": end_date},
+                           self.report_request("12345", "ga:sessions")]
+        self.client.post = MagicMock(side_effect=[mock_batch_response([{}]),
+                                                  mock_batch_response([{}])])
+
+        list(self.client.get_reports("test_report", report_requests))
+
+        self.assertEqual([[{"startDate": "2019-11-01", "endDate": "2019-11-07"}],
+                          [{"startDate": "2019-11-01", "endDate": "2019-11-01"}]],
+                         [call[0][1]["reportRequests"][0]["dateRanges"] for call in self.client.post.call_args_list])
+
+    def test_follows_next_page_token_per_report(self):
+        report_requests = [self.report_request("12345", "ga:users"),
+                           self.report_request("12345", "ga:sessions")]
+        self.client.post = MagicMock(side_effect=[mock_batch_response([{"id": "users-1", "nextPageToken": "1000"},
+                                                                       {"id": "sessions-1"}]),
+                                                  mock_batch_response([{"id": "users-2"}])])
+
+        actual = [(index, report["reports"][0]["id"])
+                  for index, report in self.client.get_reports("test_report", report_requests)]
+
+        self.assertEqual([(0, "users-1"), (1, "sessions-1"), (0, "users-2")], actual)
+        second_body = self.client.post.call_args_list[1][0][1]
+        self.assertEqual([{"viewId": "12345",
+                           "dateRanges": [{"startDate": "2019-11-01", "endDate": "2019-11-01"}],
+                           "metrics": [{"expression": "ga:users"}],
+                           "dimensions": [{"name": "ga:date"}],
+                           "pageToken": "1000"}],
+                         second_body["reportRequests"])
+
+
+class TestPrefetchPages(unittest.TestCase):
+    def setUp(self):
+        self.client = get_test_client()
+        self.client.prefetch_pages = True
+        self.report_request = {"profile_id": "12345",
+                               "report_date": utils.strptime_to_utc("2019-11-01"),
+                               "metrics": ["ga:users"],
+                               "dimensions": ["ga:date"]}
+
+    def page(self, page_id, row_count, next_page_token=None):
+        page = {"id": page_id, "data": {"rows": [{}, {}], "rowCount": row_count}}
+        if next_page_token:
+            page["nextPageToken"] = next_page_token
+        return page
+
+    def test_remaining_page_tokens_are_offsets(self):
+        self.assertEqual(["2", "4", "6"], get_remaining_page_tokens(self.page(1, 7, "2")))
+        self.assertIsNone(get_remaining_page_tokens(self.page(1, 7)))
+        self.assertIsNone(get_remaining_page_tokens(self.page(1, 7, "not-an-offset")))
+
+    def test_prefetches_remaining_pages_in_order(self):
+        requests_by_token = {}
+
+        def post(_, body, **kwargs):
+            page_token = body["reportRequests"][0].get("pageToken")
+            requests_by_token[page_token] = body["reportRequests"][0]
+            if page_token is None:
+                return mock_batch_response([self.page("page-0", 14, "2")])
+            return mock_batch_response([self.page("page-" + page_token, 14) for _ in body["reportRequests"]])
+
+        self.client.post = MagicMock(side_effect=post)
+
+        actual = [report["reports"][0]["id"]
+                  for _, report in self.client.get_reports("test_report", [self.report_request])]
+
+        self.assertEqual(["page-0", "page-2", "page-2", "page-2", "page-2", "page-2", "page-12"], actual)
+        self.assertEqual(3, self.client.post.call_count)
+        self.assertEqual(2, requests_by_token["2"]["pageSize"])
+        # NB: Prefetched batches may be sent in any order
+        self.assertEqual([[None], ["12"], ["2", "4", "6", "8", "10"]],
+                         sorted(([r.get("pageToken") for r in call[0][1]["reportRequests"]]
+                                 for call in self.client.post.call_args_list),
+                                key=len))
+
+    def test_follows_rows_added_after_first_page(self):
+        self.client.post = MagicMock(side_effect=[mock_batch_response([self.page("page-0", 4, "2")]),
+                                                  mock_batch_response([self.page("page-2", 6, "4")]),
+                                                  mock_batch_response([self.page("page-4", 6)])])
+
+        actual = [report["reports"][0]["id"]
+                  for _, report in self.client.get_reports("test_report", [self.report_request])]
+
+        self.assertEqual(["page-0", "page-2", "page-4"], actual)
+
+
+class TestPageSize(unittest.TestCase):
+    def setUp(self):
+        self.client = get_test_client()
+        self.report_request = {"profile_id": "12345",
+                               "report_date": utils.strptime_to_utc("2019-11-01"),
+                               "metrics": ["ga:users"],
+                               "dimensions": ["ga:date"]}
+
+    def test_page_size_is_only_sent_when_configured(self):
+        self.client.post = MagicMock(side_effect=[mock_batch_response([{}])])
+        list(self.client.get_reports("test_report", [self.report_request]))
+        self.assertNotIn("pageSize", self.client.post.call_args[0][1]["reportRequests"][0])
+
+        self.client.page_sizer = PageSizer(10000)
+        self.client.post = MagicMock(side_effect=[mock_batch_response([{}])])
+        list(self.client.get_reports("test_report", [self.report_request]))
+        self.assertEqual(10000, self.client.post.call_args[0][1]["reportRequests"][0]["pageSize"])
+
+    def test_page_size_over_api_maximum_is_invalid(self):
+        with self.assertRaises(Exception):
+            PageSizer(MAX_PAGE_SIZE + 1)
+
+    def test_adaptive_page_size_grows_on_fast_full_pages(self):
+        page_sizer = PageSizer(1000, adaptive=True, max_latency=10, max_bytes=1000)
+        page_sizer.record_page(1, 100, page_was_full=True)
+        self.assertEqual(2000, page_sizer.page_size)
+        # NB: The last page of a report says nothing about larger pages
+        page_sizer.record_page(1, 100, page_was_full=False)
+        self.assertEqual(2000, page_sizer.page_size)
+        page_sizer.record_page(6, 100, page_was_full=True)
+        self.assertEqual(2000, page_sizer.page_size)
+
+    def test_adaptive_page_size_shrinks_over_ceilings(self):
+        page_sizer = PageSizer(1000, adaptive=True, max_latency=10, max_bytes=1000)
+        page_sizer.record_page(11, 100, page_was_full=True)
+        self.assertEqual(500, page_sizer.page_size)
+        page_sizer.record_page(1, 1001, page_was_full=True)
+        self.assertEqual(250, page_sizer.page_size)
+
+    def test_fixed_page_size_is_not_adapted(self):
+        page_sizer = PageSizer(1000)
+        page_sizer.record_page(1, 100, page_was_full=True)
+        self.assertEqual(1000, page_sizer.page_size)
+        self.assertFalse(page_sizer.shrink())
+
+    def test_adaptive_retries_smaller_page_after_server_error(self):
+        self.client.page_sizer = PageSizer(4000, adaptive=True)
+        error_response = Mock(status_code=503)
+        self.client.post = MagicMock(side_effect=[requests.exceptions.HTTPError(response=error_response),
+                                                  requests.exceptions.Timeout(),
+                                                  mock_batch_response([{"id": "users-1"}])])
+
+        actual = [report["reports"][0]["id"]
+                  for _, report in self.client.get_reports("test_report", [self.report_request])]
+
+        self.assertEqual(["users-1"], actual)
+        self.assertEqual([4000, 2000, 1000],
+                         [call[0][1]["reportRequests"][0]["pageSize"] for call in self.client.post.call_args_list])
+
+    def test_page_size_must_be_positive(self):
+        for page_size in [0, -1, "0"]:
+            with self.assertRaisesRegex(Exception, "Config Validation Error"):
+                PageSizer(page_size)
+
+    def send_reports_with_errors(self, errors):
+        self.client._ensure_access_token = Mock()
+        self.client._request_headers_and_params = Mock(return_value=({}, {}))
+        response = mock_batch_response([{"id": "users-1"}])
+        response.status_code = 200
+        self.client.session.post = Mock(side_effect=errors + [response])
+        with patch("time.sleep") as mock_sleep:
+            actual = [report["reports"][0]["id"]
+                      for _, report in self.client.get_reports("test_report", [self.report_request])]
+        self.assertEqual(["users-1"], actual)
+        return [call[1]["json"]["reportRequests"][0]["pageSize"] for call in self.client.session.post.call_args_list], \
+            mock_sleep.call_count
+
+    def test_adaptive_page_size_shrinks_on_first_timeout(self):
+        self.client.page_sizer = PageSizer(400, adaptive=True)
+        # NB: At the minimum page size, errors are retried as usual
+        page_sizes, sleeps = self.send_reports_with_errors([requests.exceptions.Timeout()] * 4)
+        self.assertEqual([400, 200, 100, 100, 100], page_sizes)
+        self.assertEqual(2, sleeps)
+
+    def test_fixed_page_size_retries_timeouts(self):
+        self.client.page_sizer = PageSizer(400)
+        page_sizes, sleeps = self.send_reports_with_errors([requests.exceptions.Timeout()] * 2)
+        self.assertEqual([400, 400, 400], page_sizes)
+        self.assertEqual(2, sleeps)
+
+    def test_client_errors_are_not_retried_with_smaller_pages(self):
+        self.client.page_sizer = PageSizer(4000, adaptive=True)
+        self.client.post = MagicMock(side_effect=requests.exceptions.HTTPError(response=Mock(status_code=400)))
+
+        with self.assertRaises(requests.exceptions.HTTPError):
+            list(self.client.get_reports("test_report", [self.report_request]))
+        self.assertEqual(1, self.client.post.call_count)
+
+
+def split_into_chunks(content, rng, max_size=40):
+    chunks = []
+    while content:
+        size = rng.randint(1, max_size)
+        chunks.append(content[:size])
+        content = content[size:]
+    return chunks
+
+class TestStreamedResponses(unittest.TestCase):
+    def batch_response(self, rng, reports=2, rows=20):
+        return {"reports": [{"columnHeader": {"dimensions": ["ga:country", "ga:date"],
+                                              "metricHeader": {"metricHeaderEntries": [{"name": "ga:users",
+                                                                                        "type": "INTEGER"}]}},
+                             "data": {"rows": [{"dimensions": [rng.choice(["France", "Côte d'Ivoire", "中国", "a\"b\\"]),
+                                                               "20191101"],
+                                                "metrics": [{"values": [str(rng.randint(0, 10 ** 6))]}]}
+                                               for _ in range(rows)],
+                                      "totals": [{"values": ["12"]}],
+                                      "rowCount": rows,
+                                      "isDataGolden": True},
+                             "nextPageToken": str(rows)}
+                            for _ in range(reports)]}
+
+    def test_matches_json_loads_for_any_chunking(self):
+        rng = random.Random(20191101)
+        for _ in range(50):
+            response = self.batch_response(rng, reports=rng.randint(0, 3), rows=rng.randint(0, 30))
+            content = json.dumps(response, indent=rng.choice([None, 2]), ensure_ascii=rng.random() < 0.5).encode("utf-8")
+            streamed = StreamedResponse(decode_chunks(split_into_chunks(content, rng)))
+
+            actual = []
+            for report in streamed.reports():
+                actual.append({"columnHeader": report["columnHeader"],
+                               "data": {"rows": list(report["data"]["rows"]),
+                                        "totals": report["data"]["totals"],
+                                        "rowCount": report["data"]["rowCount"],
+                                        "isDataGolden": report["data"]["isDataGolden"]},
+                               "nextPageToken": report["nextPageToken"]})
+            self.assertEqual(response["reports"], actual)
+
+    def test_rows_are_decoded_as_they_are_iterated(self):
+        content = json.dumps(self.batch_response(random.Random(1), reports=1, rows=100)).encode("utf-8")
+        chunks_read = []
+        def chunks():
+            for chunk in split_into_chunks(content, random.Random(2), max_size=100):
+                chunks_read.append(chunk)
+                yield chunk
+
+        report = next(StreamedResponse(decode_chunks(chunks())).reports())
+        self.assertEqual(["ga:country", "ga:date"], report["columnHeader"]["dimensions"])
+        rows = iter(report["data"]["rows"])
+        next(rows)
+        self.assertLess(len(b"".join(chunks_read)), len(content) / 2)
+
+        self.assertEqual(99, len(list(rows)))
+        self.assertTrue(report["data"].get("isDataGolden"))
+        self.assertEqual("100", report.get("nextPageToken"))
+
+    def test_keys_after_rows_keep_unread_rows(self):
+        content = json.dumps(self.batch_response(random.Random(1), reports=1, rows=5)).encode("utf-8")
+        report = next(StreamedResponse(decode_chunks([content])).reports())
+
+        self.assertEqual("5", report.get("nextPageToken"))
+        self.assertEqual(5, len(list(report["data"]["rows"])))
+
+    def test_streamed_pages_pickle_as_plain_values(self):
+        response = self.batch_response(random.Random(1), reports=1, rows=3)
+        report = next(StreamedResponse(decode_chunks([json.dumps(response).encode("utf-8")])).reports())
+        self.assertEqual(response["reports"][0], pickle.loads(pickle.dumps(report)))
+
+    def test_get_reports_streams_pages(self):
+        client = get_test_client()
+        client.stream_responses = True
+        rng = random.Random(3)
+        pages = [self.batch_response(rng, reports=1, rows=3), self.batch_response(rng, reports=1, rows=2)]
+        del pages[1]["reports"][0]["nextPageToken"]
+        responses = []
+        for page in pages:
+            response = Mock()
+            response.iter_content.return_value = split_into_chunks(json.dumps(page).encode("utf-8"), rng)
+            responses.append(response)
+        client.post = MagicMock(side_effect=responses)
+        report_request = {"profile_id": "12345",
+                          "report_date": utils.strptime_to_utc("2019-11-01"),
+                          "metrics": ["ga:users"],
+                          "dimensions": ["ga:country", "ga:date"]}
+
+        actual = [list(report["reports"][0]["data"]["rows"])
+                  for _, report in client.get_reports("test_report", [report_request])]
+
+        self.assertEqual([page["reports"][0]["data"]["rows"] for page in pages], actual)
+        self.assertEqual({"stream": True, "retry_server_errors": True}, client.post.call_args_list[0][1])
+        self.assertEqual("3", client.post.call_args_list[1][0][1]["reportRequests"][0]["pageToken"])
+
+
+def account_summaries_page(account_id, profile_ids, next_link=True):
+    page = {"items": [{"id": account_id,
+                       "webProperties": [{"id": "UA-" + account_id,
+                                          "profiles": [{"id": profile_id} for profile_id in profile_ids]}]}]}
+    if next_link:
+        page["nextLink"] = "https://www.googleapis.com/analytics/v3/management/accountSummaries?start-index=2"
+    return page
+
+class TestProfileLookup(unittest.TestCase):
+    def test_pages_are_read_until_the_profile_is_found(self):
+        pages_read = []
+
+        def account_summaries():
+            for page in [account_summaries_page("1", ["12345"]), account_summaries_page("2", ["67890"])]:
+                pages_read.append(page)
+                yield page
+
+        lookup = ProfileLookup(account_summaries())
+        self.assertEqual({"web_property_id": "UA-1", "account_id": "1"}, lookup["12345"])
+        self.assertEqual(1, len(pages_read))
+        self.assertEqual({"web_property_id": "UA-2", "account_id": "2"}, lookup["67890"])
+        self.assertEqual(2, len(pages_read))
+        with self.assertRaises(KeyError):
+            lookup["missing"] # pylint: disable=pointless-statement
+
+    def test_client_looks_up_profiles_from_account_summaries(self):
+        client = Client({"auth_method": "oauth2",
+                         "refresh_token": "a_refresh_token",
+                         "client_id": "a_client_id",
+                         "client_secret": "a_client_secret"})
+        responses = [Mock(), Mock()]
+        responses[0].json.return_value = account_summaries_page("1", ["12345"])
+        responses[1].json.return_value = account_summaries_page("2", ["67890"], next_link=False)
+        client.get = Mock(side_effect=responses)
+
+        self.assertEqual("2", client.profile_lookup["67890"]["account_id"])
+        self.assertEqual([1, 2], [kwargs["params"]["start-index"] for _, kwargs in client.get.call_args_list])
+        self.assertNotIn("missing", client.profile_lookup)
+        self.assertEqual(2, client.get.call_count)
+
+
+@unittest.skipIf(aiohttp is None, "aiohttp is not installed")
+class TestAsyncClient(unittest.TestCase):
+    def setUp(self):
+        self.client = AsyncClient({"auth_method": "oauth2",
+                                   "refresh_token": "a_refresh_token",
+                                   "client_id": "a_client_id",
+                                   "client_secret": "a_client_secret"})
+        self.client.profile_lookup = {"12345": {"web_property_id": "UA-1", "account_id": "1"}}
+
+    def test_get_reports_matches_client(self):
+        report_requests = [{"profile_id": "12345",
+                            "report_date": utils.strptime_to_utc("2019-11-01"),
+                            "metrics": ["ga:users"],
+                            "dimensions": ["ga:date"]}]
+        pages = [{"reports": [{"id": "users-1", "nextPageToken": "1000"}]},
+                 {"reports": [{"id": "users-2"}]}]
+        self.client.post = AsyncMock(side_effect=[BufferedResponse(200, json.dumps(page).encode()) for page in pages])
+
+        async def collect():
+            return [report async for _, report in self.client.get_reports("test_report", report_requests)]
+
+        actual = asyncio.run(collect())
+
+        self.assertEqual(["users-1", "users-2"], [r["reports"][0]["id"] for r in actual])
+        self.assertEqual({"12345"}, {r["profileId"] for r in actual})
+        self.assertEqual("1000", self.client.post.call_args_list[1][0][1]["reportRequests"][0]["pageToken"])
+
+    def test_get_reports_batches_like_client(self):
+        report_requests = [{"profile_id": "12345",
+                            "report_date": utils.strptime_to_utc("2019-11-01"),
+                            "metrics": ["ga:users"],
+                            "dimensions": ["ga:date"]}] * 6
+        pages = [{"reports": [{"id": str(i)} for i in range(5)]}, {"reports": [{"id": "5"}]}]
+        self.client.post = AsyncMock(side_effect=[BufferedResponse(200, json.dumps(page).encode()) for page in pages])
+
+        async def collect():
+            return [index async for index, _ in self.client.get_reports("test_report", report_requests)]
+
+        self.assertEqual(list(range(6)), asyncio.run(collect()))
+        self.assertEqual([5, 1], [len(call[0][1]["reportRequests"]) for call in self.client.post.call_args_list])
+
+    def test_retry_classification_is_shared(self):
+        rate_limited = BufferedResponse(403, json.dumps({"error": {"errors": [{"reason": "rateLimitExceeded"}]}}).encode())
+        forbidden = BufferedResponse(403, json.dumps({"error": {"errors": [{"reason": "forbidden"}]}}).encode())
+
+        self.assertFalse(should_giveup_async(AsyncResponseError(rate_limited)))
+        self.assertTrue(should_giveup_async(AsyncResponseError(forbidden)))
+        self.assertFalse(should_giveup_async(aiohttp.ClientConnectionError()))
+
+    def test_token_errors_are_classified_as_responses(self):
+        token_response = MagicMock()
+        token_response.status = 400
+        token_response.read = AsyncMock(return_value=json.dumps({"error": "invalid_grant"}).encode())
+        self.client.session = Mock()
+        self.client.session.post.return_value.__aenter__ = AsyncMock(return_value=token_response)
+        self.client.session.post.return_value.__aexit__ = AsyncMock(return_value=False)
+
+        async def request():
+            # NB: Created in the running loop, as `__aenter__` does
+            self.client._AsyncClient__token_lock = asyncio.Lock()
+            await self.client.get("https://www.googleapis.com/analytics/v3/management/accounts")
+
+        with self.assertRaises(AsyncResponseError):
+            asyncio.run(request())
+        self.assertEqual(1, self.client.session.post.call_count)
+
+    def test_session_is_closed_if_entering_fails(self):
+        self.client.populate_profile_lookup = AsyncMock(side_effect=AsyncResponseError(BufferedResponse(400, b"{}")))
+
+        async def enter():
+            async with self.client:
+                pass
+
+        with self.assertRaises(AsyncResponseError):
+            asyncio.run(enter())
+        self.assertTrue(self.client.session.closed)
+
+    def test_only_connection_errors_and_timeouts_are_retried_without_a_response(self):
+        self.assertFalse(should_giveup_async(aiohttp.ServerDisconnectedError()))
+        self.assertFalse(should_giveup_async(asyncio.TimeoutError()))
+        self.assertNotIsInstance(aiohttp.ClientResponseError(Mock(), ()), RETRYABLE_TRANSPORT_ERRORS)
+
+    def test_profile_lookup_is_populated_from_account_summaries(self):
+        pages = [account_summaries_page("1", ["12345"]), account_summaries_page("2", ["67890"], next_link=False)]
+        self.client.profile_lookup = {}
+        self.client.get = AsyncMock(side_effect=[BufferedResponse(200, json.dumps(page).encode()) for page in pages])
+
+        asyncio.run(self.client.populate_profile_lookup())
+
+        self.assertEqual({"12345": {"web_property_id": "UA-1", "account_id": "1"},
+                          "67890": {"web_property_id": "UA-2", "account_id": "2"}},
+                         self.client.profile_lookup)
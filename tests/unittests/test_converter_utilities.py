@@ -0,0 +1,83 @@
+import copy
+import itertools
+import random
+import unittest
+from singer import Transformer
+from singer.transform import SchemaMismatch
+
+from tap_google_analytics.converter import compile_record_converter
+from tap_google_analytics.discover import type_to_schema, types_to_schema, generate_base_schema
+
+GA_TYPES = ["INTEGER", "FLOAT", "CURRENCY", "PERCENT", "TIME", "STRING"]
+
+VALUES = [None, "", "0", "12", "-3", "1,234", "3.5", "0.000", "1e3", "nan", "inf",
+          "abc", "True", "false", "2019-11-01T00:00:00.000000Z", "2019-11-01",
+          "20191101", "12:34:56", 7, 2.5]
+
+def transform_with_singer(record, schema):
+    with Transformer() as transformer:
+        return transformer.transform(record, copy.deepcopy(schema))
+
+def field_schemas():
+    schemas = [{}, {"type": "string"}, {"type": ["null", "integer"]}, {"type": "boolean"},
+               {"type": ["string", "null"], "format": "date-time"},
+               {"type": ["integer", "number", "null"]}]
+    schemas.extend(type_to_schema(ga_type, "ga:field") for ga_type in GA_TYPES)
+    schemas.append(type_to_schema("STRING", "ga:date"))
+    schemas.extend(types_to_schema(ga_types, "ga:field")
+                   for ga_types in itertools.combinations(GA_TYPES, 2))
+    schemas.append(types_to_schema(GA_TYPES, "ga:field"))
+    return schemas
+
+class TestRecordConverter(unittest.TestCase):
+    def assert_same_as_transformer(self, record, schema):
+        try:
+            expected = transform_with_singer(dict(record), schema)
+        except SchemaMismatch:
+            with self.assertRaises(SchemaMismatch):
+                compile_record_converter(schema)(dict(record))
+            return
+        actual = compile_record_converter(schema)(dict(record))
+        # NB: Compared by repr, so that types must match and nan equals nan
+        self.assertEqual(repr(expected), repr(actual))
+
+    def test_every_field_schema_and_value(self):
+        for field_schema in field_schemas():
+            schema = {"type": "object", "properties": {"ga:field": field_schema}}
+            for value in VALUES:
+                with self.subTest(schema=field_schema, value=value):
+                    self.assert_same_as_transformer({"ga:field": value}, schema)
+
+    def test_randomized_records(self):
+        rng = random.Random(20191101)
+        schemas = field_schemas()
+        for _ in range(200):
+            fields = ["ga:field{}".format(i) for i in range(rng.randint(1, 8))]
+            schema = generate_base_schema()
+            schema["properties"].update({f: rng.choice(schemas) for f in fields})
+            record = {f: rng.choice(VALUES) for f in fields}
+            record.update({"_sdc_record_hash": "abc123",
+                           "start_date": "2019-11-01T00:00:00.000000Z",
+                           "end_date": "2019-11-01T00:00:00.000000Z",
+                           "account_id": "1",
+                           "web_property_id": "UA-1",
+                           "profile_id": "12345"})
+            with self.subTest(schema=schema, record=record):
+                self.assert_same_as_transformer(record, schema)
+
+    def test_fields_missing_from_schema_are_dropped(self):
+        schema = {"type": "object", "properties": {"ga:users": {"type": ["integer", "null"]}}}
+        self.assertEqual({"ga:users": 3}, compile_record_converter(schema)({"ga:users": "3", "ga:other": "x"}))
+
+    def test_empty_schema_leaves_records_untouched(self):
+        record = {"ga:users": "3"}
+        schema = {"type": "object", "properties": {}}
+        self.assertEqual(transform_with_singer(dict(record), schema), compile_record_converter(schema)(record))
+
+    def test_datetimes_are_memoized_per_converter(self):
+        schema = {"type": "object", "properties": {"start_date": {"type": "string", "format": "date-time"}}}
+        convert_record = compile_record_converter(schema)
+        first = convert_record({"start_date": "2019-11-01"})
+        second = convert_record({"start_date": "2019-11-01"})
+        self.assertEqual({"start_date": "2019-11-01T00:00:00.000000Z"}, first)
+        self.assertEqual(first, second)
@@ -4,7 +4,12 @@ import unittest
 from unittest.mock import Mock, MagicMock, patch
 
 from tap_google_analytics.discover import calculate_custom_fields_support, \
-    get_custom_fields_supertypes, types_to_schema
+    get_custom_fields_supertypes, types_to_schema, MemoizedClient, handle_dynamic_XX_field, \
+    get_custom_fields, goal_related_field_ids, discover, map_profiles, generate_cubes_lookup, \
+    parse_cube_definitions, handle_static_XX_field
+from tap_google_analytics.client import get_local_raw_cubes
+from tap_google_analytics.cubes_index import build_cubes_index, read_cubes_index, load_cubes_index, \
+    get_cubes_version, match_XX_field
 
 class TestCalculateCustomFieldsSupport(unittest.TestCase):
 
@@ -211,3 +216,131 @@ class TestTypesToSchema(unittest.TestCase):
                               {'type': ['number', 'null']}]}
 
         self.assertEqual(expected, actual)
+
+
+def get_mock_management_client():
+    client = Mock()
+    client.profile_lookup = {"12345": {"web_property_id": "UA-1", "account_id": "1"},
+                             "67890": {"web_property_id": "UA-1", "account_id": "1"},
+                             "13579": {"web_property_id": "UA-2", "account_id": "1"}}
+    client.get_goals.return_value = ["1", "2"]
+    client.get_profiles_for_property.return_value = ["12345", "67890"]
+    client.get_custom_metrics.return_value = {"items": [{"id": "ga:metric1", "kind": "analytics#customMetric",
+                                                         "type": "INTEGER"}]}
+    client.get_custom_dimensions.return_value = {"items": [{"id": "ga:dimension1",
+                                                            "kind": "analytics#customDimension"}]}
+    return client
+
+class TestMemoizedClient(unittest.TestCase):
+    def test_goals_are_requested_once_per_profile(self):
+        client = get_mock_management_client()
+        memoized_client = MemoizedClient(client)
+        cubes_lookup = {field_id: {"cube"} for field_id in goal_related_field_ids}
+
+        for field_id in goal_related_field_ids:
+            field = {"id": field_id, "dataType": "INTEGER", "type": "METRIC", "group": "Goal Conversions"}
+            sub_schemas, _, _ = handle_dynamic_XX_field(memoized_client, field, cubes_lookup, ["12345", "67890"])
+            self.assertEqual(2, len(sub_schemas))
+
+        self.assertEqual(2, client.get_goals.call_count)
+
+    def test_custom_fields_are_requested_once_per_web_property(self):
+        client = get_mock_management_client()
+        memoized_client = MemoizedClient(client)
+
+        custom_fields = {profile_id: get_custom_fields(memoized_client, profile_id)
+                         for profile_id in ["12345", "67890", "13579"]}
+
+        self.assertEqual(2, client.get_custom_metrics.call_count)
+        self.assertEqual(2, client.get_custom_dimensions.call_count)
+        self.assertEqual(2, client.get_profiles_for_property.call_count)
+        self.assertEqual(custom_fields["12345"], custom_fields["67890"])
+
+    def test_errors_are_not_swallowed(self):
+        client = get_mock_management_client()
+        client.get_goals.side_effect = Exception("forbidden")
+        memoized_client = MemoizedClient(client)
+
+        for _ in range(2):
+            with self.assertRaisesRegex(Exception, "forbidden"):
+                memoized_client.get_goals_for_profile("12345")
+
+
+class TestConcurrentDiscovery(unittest.TestCase):
+    def get_client(self):
+        client = get_mock_management_client()
+        client.get_field_metadata.return_value = {"items": [{"id": "ga:users",
+                                                             "attributes": {"uiName": "Users",
+                                                                            "dataType": "INTEGER",
+                                                                            "group": "User",
+                                                                            "status": "PUBLIC",
+                                                                            "type": "METRIC"}},
+                                                            {"id": "ga:date",
+                                                             "attributes": {"uiName": "Date",
+                                                                            "dataType": "STRING",
+                                                                            "group": "Time",
+                                                                            "status": "PUBLIC",
+                                                                            "type": "DIMENSION"}}]}
+        client.get_raw_cubes.return_value = {"cube1": ["ga:users", "ga:date"], "cube2": ["ga:users"]}
+        return client
+
+    def test_map_profiles_keeps_profile_order(self):
+        profile_ids = [str(i) for i in range(20)]
+        self.assertEqual(list(map_profiles(int, profile_ids)),
+                         list(map_profiles(int, profile_ids, max_workers=8)))
+        self.assertEqual({"3": 3}, map_profiles(int, ["3"], max_workers=8))
+
+    def test_concurrent_discovery_matches_serial_discovery(self):
+        profile_ids = ["12345", "67890", "13579"]
+        serial_client = self.get_client()
+        concurrent_client = self.get_client()
+
+        serial_catalog = discover(serial_client, {}, profile_ids)
+        concurrent_catalog = discover(concurrent_client, {"discovery_workers": 4}, profile_ids)
+
+        self.assertEqual(serial_catalog.to_dict(), concurrent_catalog.to_dict())
+        self.assertEqual(serial_client.get_custom_metrics.call_count,
+                         concurrent_client.get_custom_metrics.call_count)
+
+
+class TestCubesIndex(unittest.TestCase):
+    def test_packaged_index_is_built_from_local_cubes(self):
+        # NB: If this fails, rebuild it with `python -m tap_google_analytics.cubes_index`
+        raw_cubes = get_local_raw_cubes()
+        self.assertEqual(build_cubes_index(raw_cubes), load_cubes_index())
+
+    def test_index_matches_cubes_lookup(self):
+        raw_cubes = get_local_raw_cubes()
+        all_cubes, cubes_lookup = read_cubes_index(load_cubes_index())
+        self.assertEqual(set(raw_cubes.keys()), all_cubes)
+        self.assertEqual(generate_cubes_lookup(raw_cubes), dict(cubes_lookup))
+
+    def test_XX_fields_match_like_a_scan(self):
+        _, cubes_lookup = read_cubes_index(load_cubes_index())
+        xx_field_ids = list(cubes_lookup.xx_fields) + ["ga:unknownXX", "ga:goalXXStarts", "ga:metricXX"]
+        for xx_field_id in xx_field_ids:
+            with self.subTest(xx_field_id=xx_field_id):
+                self.assertEqual(match_XX_field(xx_field_id, dict(cubes_lookup).keys()),
+                                 cubes_lookup.match_XX_field(xx_field_id))
+        field = {"id": "ga:contentGroupXX", "dataType": "STRING"}
+        self.assertEqual(handle_static_XX_field(field, dict(cubes_lookup)),
+                         handle_static_XX_field(field, cubes_lookup))
+
+    def test_remote_cubes_are_only_requested_when_checking_the_version(self):
+        client = Mock()
+        client.get_raw_cubes.return_value = get_local_raw_cubes()
+        packaged_cubes = parse_cube_definitions(client)
+        self.assertEqual(0, client.get_raw_cubes.call_count)
+
+        self.assertEqual(packaged_cubes, parse_cube_definitions(client, check_version=True))
+        self.assertEqual(1, client.get_raw_cubes.call_count)
+
+    def test_differing_remote_cubes_are_used(self):
+        client = Mock()
+        client.get_raw_cubes.return_value = {"cube1": ["ga:users", "ga:goal1Starts"]}
+        self.assertNotEqual(get_cubes_version(client.get_raw_cubes.return_value), load_cubes_index()["version"])
+
+        all_cubes, cubes_lookup = parse_cube_definitions(client, check_version=True)
+
+        self.assertEqual({"cube1"}, all_cubes)
+        self.assertEqual({"ga:users": {"cube1"}, "ga:goal1Starts": {"cube1"}}, dict(cubes_lookup))
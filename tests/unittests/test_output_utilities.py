@@ -0,0 +1,199 @@
+import io
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock, patch
+import singer
+from singer import utils
+
+from tap_google_analytics.output import RecordWriter, get_message_encoder, encode_message, \
+    encode_message_orjson, orjson, ArrowWriter, get_arrow_type_name, get_partition_dir, pyarrow
+from tap_google_analytics.discover import type_to_schema, types_to_schema, generate_base_schema
+from tap_google_analytics.sync import get_stream_fields, sync_report_streams
+
+RECORDS = [{"ga:country": "Côte d'Ivoire", "ga:users": 3, "ga:bounceRate": 12.5,
+            "start_date": "2019-11-01T00:00:00.000000Z"},
+           {"ga:country": "中国 \"quoted\"", "ga:users": 2 ** 70, "ga:bounceRate": None,
+            "start_date": "2019-11-01T00:00:00.000000Z"}]
+
+TIME_EXTRACTED = utils.strptime_to_utc("2019-11-02T03:04:05.123456Z")
+
+class TestRecordWriter(unittest.TestCase):
+    def write(self, writer, records=RECORDS):
+        with patch("sys.stdout", new_callable=io.StringIO) as stdout:
+            writer.write_records({"name": "report"}, iter(records), TIME_EXTRACTED)
+        return stdout.getvalue()
+
+    def test_json_output_matches_singer_write_record(self):
+        with patch("sys.stdout", new_callable=io.StringIO) as stdout:
+            for record in RECORDS:
+                singer.write_record("report", record, time_extracted=TIME_EXTRACTED)
+
+        self.assertEqual(stdout.getvalue(), self.write(RecordWriter(encode_message)))
+
+    @unittest.skipIf(orjson is None, "orjson is not installed")
+    def test_orjson_output_parses_the_same(self):
+        expected = [json.loads(line) for line in self.write(RecordWriter(encode_message)).splitlines()]
+        actual = [json.loads(line) for line in self.write(RecordWriter(encode_message_orjson)).splitlines()]
+        self.assertEqual(expected, actual)
+
+    def test_records_are_written_in_chunks(self):
+        writer = RecordWriter(encode_message, buffer_size=2)
+        with patch.object(writer, "_flush", wraps=writer._flush) as flush:
+            output = self.write(writer, RECORDS * 3)
+        self.assertEqual(6, len(output.splitlines()))
+        self.assertEqual([2, 2, 2], [len(call[0][0]) for call in flush.call_args_list])
+
+    def test_unknown_encoder_is_invalid(self):
+        self.assertIs(encode_message, get_message_encoder(None))
+        self.assertIs(encode_message, get_message_encoder("json"))
+        with self.assertRaises(Exception):
+            get_message_encoder("pickle")
+
+def to_columns(fields, records):
+    return [[record.get(field) for record in records] for field in fields]
+
+class TestArrowOutput(unittest.TestCase):
+    def setUp(self):
+        schema = generate_base_schema()
+        schema["properties"].update({"ga:country": type_to_schema("STRING", "ga:country"),
+                                     "ga:date": type_to_schema("STRING", "ga:date"),
+                                     "ga:users": type_to_schema("INTEGER", "ga:users"),
+                                     "ga:bounceRate": type_to_schema("PERCENT", "ga:bounceRate"),
+                                     "ga:metric1": types_to_schema(["INTEGER", "STRING"], "ga:metric1")})
+        self.stream = {"name": "report", "id": "report-id", "schema": schema,
+                       "metrics": ["ga:users", "ga:bounceRate"]}
+
+    def test_arrow_types_follow_the_catalog_schema(self):
+        properties = self.stream["schema"]["properties"]
+        self.assertEqual({"_sdc_record_hash": "string",
+                          "start_date": "timestamp",
+                          "end_date": "timestamp",
+                          "account_id": "string",
+                          "web_property_id": "string",
+                          "profile_id": "string",
+                          "ga:country": "string",
+                          "ga:date": "timestamp",
+                          "ga:users": "int64",
+                          "ga:bounceRate": "float64",
+                          "ga:metric1": "string"},
+                         {field: get_arrow_type_name(field_schema) for field, field_schema in properties.items()})
+
+    def test_stream_fields_are_selected_in_schema_order(self):
+        self.assertEqual(["_sdc_record_hash", "start_date", "end_date", "account_id", "web_property_id",
+                          "profile_id", "ga:country", "ga:users", "ga:bounceRate"],
+                         get_stream_fields(self.stream, ["ga:country"]))
+
+    def test_partition_dirs(self):
+        self.assertEqual(os.path.join("out", "report"), get_partition_dir("out", "report"))
+        self.assertEqual(os.path.join("out", "report", "profile_id=12345", "report_date=2019-11-01"),
+                         get_partition_dir("out", "report", "12345", utils.strptime_to_utc("2019-11-01")))
+
+    def test_unknown_output_format_is_a_config_error(self):
+        with self.assertRaisesRegex(Exception, "Config Validation Error"):
+            ArrowWriter("out", "csv")
+
+    @unittest.skipIf(pyarrow is not None, "pyarrow is installed")
+    def test_missing_pyarrow_is_a_config_error(self):
+        with self.assertRaisesRegex(Exception, "requires pyarrow"):
+            ArrowWriter("out", "parquet")
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_parquet_files_are_written_per_partition(self):
+        import pyarrow.parquet # pylint: disable=import-outside-toplevel
+        fields = get_stream_fields(self.stream, ["ga:country"])
+        records = [{"ga:country": "France", "ga:users": 3, "ga:bounceRate": 12.5,
+                    "_sdc_record_hash": "abc", "start_date": "2019-11-01T00:00:00.000000Z",
+                    "end_date": "2019-11-01T00:00:00.000000Z", "account_id": "1",
+                    "web_property_id": "UA-1", "profile_id": "12345"}]
+        with tempfile.TemporaryDirectory() as output_dir:
+            writer = ArrowWriter(output_dir, "parquet", partition=True)
+            writer.write_columns(self.stream, fields, to_columns(fields, records), "12345", utils.strptime_to_utc("2019-11-01"))
+            writer.flush()
+            partition_dir = get_partition_dir(output_dir, "report", "12345", utils.strptime_to_utc("2019-11-01"))
+            [file_name] = os.listdir(partition_dir)
+            table = pyarrow.parquet.read_table(os.path.join(partition_dir, file_name))
+        self.assertEqual(fields, table.schema.names)
+        self.assertEqual([3], table.column("ga:users").to_pylist())
+
+    def get_record(self, report_date, country="France"):
+        return {"ga:country": country, "ga:users": 3, "ga:bounceRate": 12.5,
+                "_sdc_record_hash": country + report_date, "start_date": report_date + "T00:00:00.000000Z",
+                "end_date": report_date + "T00:00:00.000000Z", "account_id": "1",
+                "web_property_id": "UA-1", "profile_id": "12345"}
+
+    def read_start_dates(self, output_dir):
+        import pyarrow.parquet # pylint: disable=import-outside-toplevel
+        start_dates = []
+        for directory, _, file_names in os.walk(output_dir):
+            for file_name in file_names:
+                if file_name.endswith(".parquet"):
+                    table = pyarrow.parquet.read_table(os.path.join(directory, file_name))
+                    start_dates.append(sorted(d.strftime("%Y-%m-%d") for d in table.column("start_date").to_pylist()))
+        return sorted(start_dates)
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_pages_are_buffered_into_files_of_file_rows(self):
+        fields = get_stream_fields(self.stream, ["ga:country"])
+        with tempfile.TemporaryDirectory() as output_dir:
+            writer = ArrowWriter(output_dir, "parquet", file_rows=3)
+            for day in ["2019-11-01", "2019-11-02", "2019-11-03"]:
+                writer.write_columns(self.stream, fields,
+                                     to_columns(fields, [self.get_record(day, "France"), self.get_record(day, "Spain")]),
+                                     "12345", utils.strptime_to_utc(day))
+            self.assertEqual(utils.strptime_to_utc("2019-11-03"), writer.earliest_buffered_date("report-id"))
+            self.assertEqual([["2019-11-01", "2019-11-01", "2019-11-02", "2019-11-02"]],
+                             self.read_start_dates(output_dir))
+            writer.flush()
+            self.assertIsNone(writer.earliest_buffered_date("report-id"))
+            self.assertEqual([["2019-11-01", "2019-11-01", "2019-11-02", "2019-11-02"],
+                              ["2019-11-03", "2019-11-03"]],
+                             self.read_start_dates(output_dir))
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_partitions_are_written_once_the_next_day_starts(self):
+        fields = get_stream_fields(self.stream, ["ga:country"])
+        with tempfile.TemporaryDirectory() as output_dir:
+            writer = ArrowWriter(output_dir, "parquet", partition=True)
+            for day in ["2019-11-01", "2019-11-01", "2019-11-02"]:
+                writer.write_columns(self.stream, fields, to_columns(fields, [self.get_record(day)]),
+                                     "12345", utils.strptime_to_utc(day))
+            self.assertEqual([["2019-11-01", "2019-11-01"]], self.read_start_dates(output_dir))
+            self.assertEqual(utils.strptime_to_utc("2019-11-02"), writer.earliest_buffered_date("report-id"))
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    @patch("singer.write_state")
+    def test_state_only_follows_written_files(self, mock_write_state):
+        def get_report(name, profile_id, report_date, metrics, dimensions):
+            return [{"reports": [{"columnHeader": {"dimensions": ["ga:country"],
+                                                   "metricHeader": {"metricHeaderEntries": [
+                                                       {"name": "ga:users", "type": "INTEGER"},
+                                                       {"name": "ga:bounceRate", "type": "PERCENT"}]}},
+                                  "data": {"rows": [{"dimensions": ["France"], "metrics": [{"values": ["3", "12.5"]}]}],
+                                           "isDataGolden": True}}],
+                     "reportDate": report_date, "profileId": profile_id,
+                     "accountId": "1", "webPropertyId": "UA-1"}]
+        client = Mock()
+        client.get_report = Mock(side_effect=get_report)
+        with tempfile.TemporaryDirectory() as output_dir:
+            def check_state(state):
+                bookmark = state["bookmarks"]["report-id"]["12345"]["last_report_date"]
+                written_days = sum(self.read_start_dates(output_dir), [])
+                # NB: The bookmarked day is synced again, so only earlier days must be written
+                for day in ["2019-11-01", "2019-11-02", "2019-11-03", "2019-11-04"]:
+                    if day < bookmark:
+                        self.assertIn(day, written_days)
+                bookmarks.append(bookmark)
+            bookmarks = []
+            mock_write_state.side_effect = check_state
+            stream = {**self.stream, "start_date": utils.strptime_to_utc("2019-11-01")}
+            sync_report_streams(client,
+                                {"name": "report", "profile_id": "12345", "dimensions": ["ga:country"],
+                                 "metrics": stream["metrics"], "streams": [stream]},
+                                utils.strptime_to_utc("2019-11-04"),
+                                {},
+                                {"output_format": "parquet", "output_dir": output_dir, "output_file_rows": 2})
+            self.assertEqual(["2019-11-01", "2019-11-02", "2019-11-03", "2019-11-04"], bookmarks)
+            self.assertEqual([["2019-11-01", "2019-11-02"], ["2019-11-03", "2019-11-04"]],
+                             self.read_start_dates(output_dir))
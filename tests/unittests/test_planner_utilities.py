@@ -0,0 +1,40 @@
+import unittest
+
+from tap_google_analytics.planner import plan_report_queries
+
+def report_stream(tap_stream_id, metrics, dimensions, cubes=None):
+    return {"tap_stream_id": tap_stream_id,
+            "metrics": metrics,
+            "dimensions": dimensions,
+            "cubes": cubes or {"cube1"}}
+
+class TestPlanReportQueries(unittest.TestCase):
+
+    def test_merges_streams_with_same_dimensions(self):
+        streams = [report_stream("geo", ["ga:users", "ga:sessions"], ["ga:date", "ga:country"]),
+                   report_stream("other", ["ga:users"], ["ga:date"]),
+                   report_stream("geo_2", ["ga:sessions", "ga:bounceRate"], ["ga:country", "ga:date"])]
+
+        actual = plan_report_queries(streams)
+
+        self.assertEqual([["geo", "geo_2"], ["other"]],
+                         [[s["tap_stream_id"] for s in q["streams"]] for q in actual])
+        self.assertEqual(["ga:users", "ga:sessions", "ga:bounceRate"], actual[0]["metrics"])
+
+    def test_does_not_exceed_metric_limit(self):
+        streams = [report_stream("a", ["ga:m{}".format(i) for i in range(6)], ["ga:date"]),
+                   report_stream("b", ["ga:m{}".format(i) for i in range(6, 12)], ["ga:date"]),
+                   report_stream("c", ["ga:m0", "ga:m1"], ["ga:date"])]
+
+        actual = plan_report_queries(streams)
+
+        self.assertEqual([["a", "c"], ["b"]],
+                         [[s["tap_stream_id"] for s in q["streams"]] for q in actual])
+
+    def test_does_not_merge_without_a_common_cube(self):
+        streams = [report_stream("a", ["ga:users"], ["ga:date"], {"cube1"}),
+                   report_stream("b", ["ga:transactions"], ["ga:date"], {"cube2"})]
+
+        actual = plan_report_queries(streams)
+
+        self.assertEqual(2, len(actual))
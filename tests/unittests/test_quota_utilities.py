@@ -0,0 +1,86 @@
+import unittest
+
+from tap_google_analytics.quota import QuotaLimiter, TokenBucket
+from tap_google_analytics.client import get_api_family, get_view_id
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_burst_up_to_capacity_then_waits(self):
+        bucket = TokenBucket(2, 1, 0.0)
+
+        actual = [bucket.reserve(0.0) for _ in range(4)]
+
+        self.assertEqual([0, 0, 0.5, 1.0], actual)
+
+    def test_refills_over_period(self):
+        bucket = TokenBucket(2, 1, 0.0)
+        bucket.reserve(0.0)
+        bucket.reserve(0.0)
+
+        self.assertEqual(0, bucket.reserve(0.5))
+
+class TestQuotaLimiter(unittest.TestCase):
+
+    def test_waits_for_the_tightest_budget(self):
+        clock = FakeClock()
+        limiter = QuotaLimiter({"reporting": {"per_second": 100, "per_100_seconds": 2, "per_day": None}},
+                               clock=clock)
+
+        actual = [limiter.reserve("reporting") for _ in range(3)]
+
+        self.assertEqual([0, 0, 50.0], actual)
+
+    def test_families_are_limited_separately(self):
+        clock = FakeClock()
+        limiter = QuotaLimiter({"reporting": {"per_second": 1, "per_100_seconds": None, "per_day": None}},
+                               clock=clock)
+
+        limiter.reserve("reporting")
+
+        self.assertEqual(0, limiter.reserve("management"))
+        self.assertEqual(0, limiter.reserve(None))
+        self.assertEqual(1.0, limiter.reserve("reporting"))
+
+    def test_default_reporting_budgets(self):
+        limiter = QuotaLimiter(clock=FakeClock())
+        # NB: Only the user's budget, of 100 requests per 100 seconds
+        per_user_limiter = QuotaLimiter({"reporting": {"per_second": None}}, clock=FakeClock())
+
+        per_second = [limiter.reserve("reporting") for _ in range(11)]
+        per_user = [per_user_limiter.reserve("reporting") for _ in range(101)]
+
+        self.assertEqual([0] * 10, per_second[:10])
+        self.assertAlmostEqual(0.1, per_second[10])
+        self.assertEqual([0] * 100, per_user[:100])
+        self.assertAlmostEqual(1.0, per_user[100])
+
+    def test_views_are_limited_separately(self):
+        clock = FakeClock()
+        limiter = QuotaLimiter({"reporting": {"per_second": None, "per_100_seconds": None,
+                                              "per_user_per_100_seconds": None, "per_day": None,
+                                              "per_view_per_day": 2}},
+                               clock=clock)
+
+        actual = [limiter.reserve("reporting", "12345") for _ in range(3)]
+
+        self.assertEqual([0, 0, 43200.0], actual)
+        self.assertEqual(0, limiter.reserve("reporting", "67890"))
+        self.assertEqual(0, limiter.reserve("reporting"))
+
+    def test_view_ids(self):
+        self.assertEqual("12345", get_view_id({"reportRequests": [{"viewId": "12345"}, {"viewId": "12345"}]}))
+        self.assertIsNone(get_view_id({}))
+        self.assertIsNone(get_view_id(None))
+
+    def test_api_families(self):
+        self.assertEqual("reporting", get_api_family("https://analyticsreporting.googleapis.com/v4/reports:batchGet"))
+        self.assertEqual("management", get_api_family("https://www.googleapis.com/analytics/v3/management/accounts"))
+        self.assertEqual("management", get_api_family("https://www.googleapis.com/analytics/v3/metadata/ga/columns"))
+        self.assertIsNone(get_api_family("https://ga-dev-tools.appspot.com/ga_cubes.json"))
@@ -1,9 +1,16 @@
+import copy
 import datetime
+import io
+import json
+import threading
 import pytz
 import unittest
 from unittest.mock import Mock, MagicMock, patch
+from singer import utils
+from singer.catalog import Catalog
 
-from tap_google_analytics import clean_state_for_report, get_start_date
+from tap_google_analytics import clean_state_for_report, get_start_date, \
+    get_view_ids_to_sync, mark_view_complete, clear_view_markers, do_sync
 
 class TestCleanStateForReport(unittest.TestCase):
 
@@ -164,3 +171,122 @@ class TestGetStartDate(unittest.TestCase):
         expected = datetime.datetime(2020, 3, 15, tzinfo=pytz.utc)
 
         self.assertEqual(expected, actual)
+
+class TestViewResumeMarkers(unittest.TestCase):
+
+    def test_completed_views_are_skipped(self):
+        state = {}
+        mark_view_complete(state, 'report1', '12345')
+
+        actual = get_view_ids_to_sync(state, 'report1', ['12345', '67890'])
+
+        self.assertEqual(['67890'], actual)
+
+    def test_legacy_currently_syncing_view_is_translated(self):
+        state = {'currently_syncing_view': '67890'}
+
+        actual = get_view_ids_to_sync(state, 'report1', ['12345', '67890', '13579'])
+
+        self.assertEqual(['67890', '13579'], actual)
+        self.assertEqual({}, state)
+
+    def test_clearing_markers_keeps_bookmarks(self):
+        state = {
+            'bookmarks': {
+                'report1': {
+                    '12345': {
+                        'last_report_date': '2020-04-01',
+                        'sync_complete': True
+                    },
+                    '67890': {
+                        'sync_complete': True
+                    }
+                }
+            }
+        }
+
+        actual = clear_view_markers(state, 'report1', ['12345', '67890'])
+
+        expected = {
+            'bookmarks': {
+                'report1': {
+                    '12345': {
+                        'last_report_date': '2020-04-01'
+                    }
+                }
+            }
+        }
+        self.assertEqual(expected, actual)
+
+class TestConcurrentViews(unittest.TestCase):
+    """
+    Syncs two views on `view_workers` threads, which request their days in
+    lockstep so that their STATE and RECORD messages interleave.
+    """
+    def get_catalog(self):
+        return Catalog.from_dict({"streams": [{
+            "tap_stream_id": "report1",
+            "stream": "report1",
+            "key_properties": ["_sdc_record_hash"],
+            "schema": {"type": "object",
+                       "properties": {"ga:date": {"type": ["string", "null"]},
+                                      "ga:users": {"type": ["integer", "null"]}}},
+            "metadata": [{"breadcrumb": [], "metadata": {"selected": True}},
+                         {"breadcrumb": ["properties", "ga:date"],
+                          "metadata": {"behavior": "DIMENSION", "tap_google_analytics.cubes": ["cube"]}},
+                         {"breadcrumb": ["properties", "ga:users"],
+                          "metadata": {"behavior": "METRIC", "tap_google_analytics.cubes": ["cube"]}}]}]})
+
+    def get_client(self):
+        barrier = threading.Barrier(2, timeout=5)
+
+        def get_report(name, profile_id, report_date, metrics, dimensions):
+            barrier.wait()
+            day = report_date.strftime("%Y%m%d")
+            return [{"reports": [{"columnHeader": {"dimensions": ["ga:date"],
+                                                   "metricHeader": {"metricHeaderEntries": [{"name": "ga:users"}]}},
+                                  "data": {"rows": [{"dimensions": [day], "metrics": [{"values": [profile_id]}]}],
+                                           "isDataGolden": True}}],
+                     "profileId": profile_id,
+                     "webPropertyId": "UA-1",
+                     "accountId": "1",
+                     "reportDate": report_date}]
+
+        client = MagicMock()
+        client.get_report = MagicMock(side_effect=get_report)
+        return client
+
+    @patch("singer.write_state")
+    def test_views_bookmark_and_complete_independently(self, mock_write_state):
+        states = []
+        mock_write_state.side_effect = lambda state: states.append(copy.deepcopy(state))
+        config = {"view_ids": ["12345", "67890"], "view_workers": 2,
+                  "start_date": "2019-11-01T00:00:00Z", "end_date": "2019-11-03T00:00:00Z"}
+        state = {}
+
+        with patch("sys.stdout", new_callable=io.StringIO) as stdout:
+            do_sync(self.get_client(), config, self.get_catalog(), state)
+
+        records = [json.loads(line)["record"] for line in stdout.getvalue().splitlines()
+                   if json.loads(line)["type"] == "RECORD"]
+        self.assertEqual(6, len(records))
+        # NB: Both views are in flight at once, so their records interleave
+        self.assertEqual({"12345", "67890"}, {str(r["ga:users"]) for r in records[:2]})
+
+        views_per_state = [state.get("bookmarks", {}).get("report1", {}) for state in states]
+        for view_id in config["view_ids"]:
+            dates = [views[view_id]["last_report_date"] for views in views_per_state
+                     if "last_report_date" in views.get(view_id, {})]
+            self.assertEqual(sorted(dates), dates)
+            self.assertEqual("2019-11-03", dates[-1])
+            # NB: A view is only marked complete once all of its days are bookmarked
+            for views in views_per_state:
+                if views.get(view_id, {}).get("sync_complete"):
+                    self.assertEqual("2019-11-03", views[view_id]["last_report_date"])
+
+        self.assertTrue(any(all(views.get(view_id, {}).get("sync_complete") for view_id in config["view_ids"])
+                            for views in views_per_state))
+        self.assertEqual({"currently_syncing": None,
+                          "bookmarks": {"report1": {"12345": {"last_report_date": "2019-11-03"},
+                                                    "67890": {"last_report_date": "2019-11-03"}}}},
+                         states[-1])
@@ -1,9 +1,22 @@
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+import io
+import itertools
+import json
+import random
 import unittest
 from unittest.mock import Mock, MagicMock, patch
 from singer import utils
 
 import tap_google_analytics.sync
-from tap_google_analytics.sync import sync_report, generate_sdc_record_hash
+from tap_google_analytics.sync import sync_report, sync_report_streams, generate_sdc_record_hash, \
+    get_query_pages, get_shard_filters, get_unsampled_pages, WindowSizer, buffer_in_thread, RecordHasher, \
+    format_datetime, get_datetimes_transform, DATETIME_FORMATS, ColumnarPage, transform_stream_records, \
+    transform_stream_columns, get_transform_pool
+from tap_google_analytics.converter import compile_record_converter
+from tap_google_analytics.discover import type_to_schema, generate_base_schema
+from tap_google_analytics.streaming import StreamedResponse, decode_chunks
+from tap_google_analytics.client import Client
 
 reports = {
     utils.strptime_to_utc("2019-11-01"): [{"reports": [{"data": {"isDataGolden": True}}]}],
@@ -50,6 +63,514 @@ class TestIsDataGoldenBookmarking(unittest.TestCase):
         self.assertEqual({'bookmarks': {'123': {'12345': {'last_report_date': '2019-11-03'}}}}, state)
         self.assertEqual(self.client.get_report.call_count, 1)
 
+    @patch("tap_google_analytics.sync.report_to_records")
+    @patch("singer.write_record")
+    @patch("singer.write_state")
+    def test_concurrent_days_bookmark_in_date_order(self, *args):
+        state = {}
+        bookmarked_dates = []
+        def record_bookmark(state):
+            bookmarked_dates.append(state['bookmarks']['123']['12345']['last_report_date'])
+        args[0].side_effect = record_bookmark
+        sync_report(self.client,
+                    {},
+                    {"id": "123", "name":"test_report", "profile_id": "12345", "metrics":[], "dimensions":[]},
+                    utils.strptime_to_utc("2019-11-01"),
+                    utils.strptime_to_utc("2019-11-04"),
+                    state,
+                    {"day_workers": 3})
+        self.assertEqual(['2019-11-01', '2019-11-02', '2019-11-03'], bookmarked_dates)
+        self.assertEqual({'bookmarks': {'123': {'12345': {'last_report_date': '2019-11-03'}}}}, state)
+        self.assertEqual(self.client.get_report.call_count, 4)
+
+    @patch("tap_google_analytics.sync.report_to_records")
+    @patch("singer.write_record")
+    @patch("singer.write_state")
+    def test_pipelined_days_bookmark_in_date_order(self, *args):
+        state = {}
+        bookmarked_dates = []
+        def record_bookmark(state):
+            bookmarked_dates.append(state['bookmarks']['123']['12345']['last_report_date'])
+        args[0].side_effect = record_bookmark
+        sync_report(self.client,
+                    {},
+                    {"id": "123", "name":"test_report", "profile_id": "12345", "metrics":[], "dimensions":[]},
+                    utils.strptime_to_utc("2019-11-01"),
+                    utils.strptime_to_utc("2019-11-04"),
+                    state,
+                    {"pipeline_depth": 2})
+        self.assertEqual(['2019-11-01', '2019-11-02', '2019-11-03'], bookmarked_dates)
+        self.assertEqual(self.client.get_report.call_count, 4)
+
+class TestBufferInThread(unittest.TestCase):
+    def test_items_are_yielded_in_order(self):
+        self.assertEqual(list(range(10)), list(buffer_in_thread(iter(range(10)), 3)))
+
+    def test_errors_are_raised_to_the_caller(self):
+        def failing():
+            yield 1
+            raise ValueError("failed fetching page")
+
+        buffered = buffer_in_thread(failing(), 3)
+        self.assertEqual(1, next(buffered))
+        with self.assertRaises(ValueError):
+            next(buffered)
+
+    def test_closing_stops_the_producer(self):
+        produced = []
+        def counting():
+            for i in itertools.count():
+                produced.append(i)
+                yield i
+
+        buffered = buffer_in_thread(counting(), 2)
+        self.assertEqual(0, next(buffered))
+        buffered.close()
+        # NB: At most the queue's depth, plus the item being put, are read ahead
+        self.assertLessEqual(len(produced), 5)
+
+class TestMergedStreams(unittest.TestCase):
+    def setUp(self):
+        page = {"reports": [{"columnHeader": {"dimensions": ["ga:country"],
+                                              "metricHeader": {"metricHeaderEntries": [{"name": "ga:users"},
+                                                                                       {"name": "ga:goal1Completions"}]}},
+                             "data": {"rows": [{"dimensions": ["France"], "metrics": [{"values": ["3", "0"]}]},
+                                               {"dimensions": ["Peru"], "metrics": [{"values": ["0", "2"]}]}],
+                                      "isDataGolden": True}}],
+                "profileId": "12345",
+                "webPropertyId": "UA-1",
+                "accountId": "1",
+                "reportDate": utils.strptime_to_utc("2019-11-01")}
+        self.client = MagicMock()
+        self.client.get_report = MagicMock(return_value=[page])
+
+    @patch("singer.write_record")
+    @patch("singer.write_state")
+    def test_rows_are_fanned_out_per_stream(self, mock_write_state, mock_write_record):
+        schema = {"type": "object", "properties": {}}
+        streams = [{"name": "users", "id": "users", "schema": schema, "metrics": ["ga:users"],
+                    "start_date": utils.strptime_to_utc("2019-11-01")},
+                   {"name": "goals", "id": "goals", "schema": schema, "metrics": ["ga:goal1Completions"],
+                    "start_date": utils.strptime_to_utc("2019-11-01")}]
+        state = {}
+        sync_report_streams(self.client,
+                            {"name": "users", "profile_id": "12345", "metrics": ["ga:users", "ga:goal1Completions"],
+                             "dimensions": ["ga:country"], "streams": streams},
+                            utils.strptime_to_utc("2019-11-01"),
+                            state)
+
+        written = [(c[0][0], c[0][1]) for c in mock_write_record.call_args_list]
+        self.assertEqual([("users", "France"), ("goals", "Peru")],
+                         [(name, rec["ga:country"]) for name, rec in written])
+        self.assertNotIn("ga:goal1Completions", written[0][1])
+        self.assertNotIn("ga:users", written[1][1])
+        self.assertEqual({"users", "goals"}, set(state["bookmarks"].keys()))
+        self.assertEqual(1, self.client.get_report.call_count)
+
+    @patch("singer.write_record")
+    @patch("singer.write_state")
+    def test_streamed_pages_are_fanned_out_per_stream(self, mock_write_state, mock_write_record):
+        page = self.client.get_report.return_value[0]
+        content = json.dumps({"reports": page["reports"]}).encode("utf-8")
+        streamed_report = next(StreamedResponse(decode_chunks([content[:50], content[50:]])).reports())
+        self.client.get_report.return_value = [{**page, "reports": [streamed_report]}]
+        schema = {"type": "object", "properties": {}}
+        streams = [{"name": "users", "id": "users", "schema": schema, "metrics": ["ga:users"],
+                    "start_date": utils.strptime_to_utc("2019-11-01")},
+                   {"name": "goals", "id": "goals", "schema": schema, "metrics": ["ga:goal1Completions"],
+                    "start_date": utils.strptime_to_utc("2019-11-01")}]
+        state = {}
+        sync_report_streams(self.client,
+                            {"name": "users", "profile_id": "12345", "metrics": ["ga:users", "ga:goal1Completions"],
+                             "dimensions": ["ga:country"], "streams": streams},
+                            utils.strptime_to_utc("2019-11-01"),
+                            state)
+
+        self.assertEqual([("users", "France"), ("goals", "Peru")],
+                         [(c[0][0], c[0][1]["ga:country"]) for c in mock_write_record.call_args_list])
+        self.assertEqual({"users", "goals"}, set(state["bookmarks"].keys()))
+
+    @patch("singer.utils.now")
+    @patch("singer.write_state")
+    def test_process_pool_output_matches_serial_output(self, mock_write_state, mock_now):
+        mock_now.return_value = utils.strptime_to_utc("2019-11-02T00:00:00Z")
+        schema = {"type": "object",
+                  "properties": {"ga:country": {"type": ["string", "null"]},
+                                 "ga:users": {"type": ["integer", "null"]},
+                                 "ga:goal1Completions": {"type": ["integer", "null"]}}}
+        output = {}
+        for config in [{}, {"transform_processes": 2}]:
+            streams = [{"name": "users", "id": "users", "schema": schema, "metrics": ["ga:users"],
+                        "start_date": utils.strptime_to_utc("2019-11-01")},
+                       {"name": "goals", "id": "goals", "schema": schema, "metrics": ["ga:goal1Completions"],
+                        "start_date": utils.strptime_to_utc("2019-11-01")}]
+            with patch("sys.stdout", new_callable=io.StringIO) as stdout:
+                sync_report_streams(self.client,
+                                    {"name": "users", "profile_id": "12345",
+                                     "metrics": ["ga:users", "ga:goal1Completions"],
+                                     "dimensions": ["ga:country"], "streams": streams},
+                                    utils.strptime_to_utc("2019-11-01"),
+                                    {},
+                                    config)
+            output[str(config)] = stdout.getvalue()
+
+        self.assertEqual(2, len(output["{}"].splitlines()))
+        self.assertEqual(output["{}"], output[str({"transform_processes": 2})])
+
+    @patch("singer.utils.now")
+    @patch("singer.write_state")
+    def test_process_pool_is_spawned_and_shared_across_views(self, mock_write_state, mock_now):
+        mock_now.return_value = utils.strptime_to_utc("2019-11-02T00:00:00Z")
+        schemas = {"users": {"type": "object",
+                             "properties": {"ga:country": {"type": ["string", "null"]},
+                                            "ga:users": {"type": ["integer", "null"]}}},
+                   "goals": {"type": "object",
+                             "properties": {"ga:country": {"type": ["string", "null"]},
+                                            "ga:goal1Completions": {"type": ["string", "null"]}}}}
+        def sync_views(config, transform_pool=None):
+            with patch("sys.stdout", new_callable=io.StringIO) as stdout:
+                for profile_id, name, metric in [("12345", "users", "ga:users"),
+                                                 ("67890", "goals", "ga:goal1Completions")]:
+                    streams = [{"name": name, "id": name, "schema": schemas[name], "metrics": [metric],
+                                "start_date": utils.strptime_to_utc("2019-11-01")}]
+                    sync_report_streams(self.client,
+                                        {"name": name, "profile_id": profile_id,
+                                         "metrics": ["ga:users", "ga:goal1Completions"],
+                                         "dimensions": ["ga:country"], "streams": streams},
+                                        utils.strptime_to_utc("2019-11-01"),
+                                        {},
+                                        config,
+                                        transform_pool)
+            return stdout.getvalue()
+
+        config = {"transform_processes": 2}
+        expected = sync_views({})
+        with patch("tap_google_analytics.sync.ProcessPoolExecutor", wraps=ProcessPoolExecutor) as mock_pool:
+            transform_pool = get_transform_pool(config)
+            with transform_pool:
+                actual = sync_views(config, transform_pool)
+
+        self.assertEqual(1, mock_pool.call_count)
+        self.assertEqual("spawn", mock_pool.call_args[1]["mp_context"].get_start_method())
+        self.assertEqual(expected, actual)
+        self.assertIn('"ga:goal1Completions": "2"', actual)
+        self.assertIsNone(get_transform_pool({}))
+
+class TestMetricSplitting(unittest.TestCase):
+
+    def test_wide_reports_are_split_and_joined_on_dimensions(self):
+        metrics = ["ga:m{}".format(i) for i in range(12)]
+        def page(group_metrics, rows, golden=True):
+            return {"reports": [{"columnHeader": {"dimensions": ["ga:country"],
+                                                  "metricHeader": {"metricHeaderEntries": [{"name": m} for m in group_metrics]}},
+                                 "data": {"rows": [{"dimensions": [d], "metrics": [{"values": v}]} for d, v in rows],
+                                          "isDataGolden": golden}}],
+                    "profileId": "12345"}
+        client = MagicMock()
+        client.get_reports = MagicMock(return_value=[
+            (0, page(metrics[:10], [("France", [str(i) for i in range(10)])])),
+            (1, page(metrics[10:], [("Peru", ["1", "2"])])),
+            (1, page(metrics[10:], [("France", ["10", "11"])], golden=False)),
+        ])
+        report = {"name": "wide", "profile_id": "12345", "metrics": metrics, "dimensions": ["ga:country"]}
+
+        report_date = utils.strptime_to_utc("2019-11-01")
+        actual = list(get_query_pages(client, report, (report_date, report_date)))
+
+        requested_metrics = [r["metrics"] for r in client.get_reports.call_args[0][1]]
+        self.assertEqual([metrics[:10], metrics[10:]], requested_metrics)
+        self.assertEqual(1, len(actual))
+        joined = actual[0]["reports"][0]
+        self.assertEqual(metrics, [h["name"] for h in joined["columnHeader"]["metricHeader"]["metricHeaderEntries"]])
+        self.assertEqual([{"dimensions": ["France"], "metrics": [{"values": [str(i) for i in range(12)]}]},
+                          {"dimensions": ["Peru"], "metrics": [{"values": ["0"] * 10 + ["1", "2"]}]}],
+                         joined["data"]["rows"])
+        self.assertFalse(joined["data"]["isDataGolden"])
+
+class TestStreamedSync(unittest.TestCase):
+    """
+    Syncs a 3 page report through a `Client` streaming its responses, with
+    each option that hands pages to another thread or process.
+    """
+    def get_client(self, config):
+        client = Client({"auth_method": "oauth2",
+                         "refresh_token": "a_refresh_token",
+                         "client_id": "a_client_id",
+                         "client_secret": "a_client_secret",
+                         **config})
+        client.profile_lookup = {"12345": {"web_property_id": "UA-1", "account_id": "1"}}
+        rows = [{"dimensions": ["country{}".format(i)], "metrics": [{"values": [str(i)]}]} for i in range(3000)]
+
+        def get_report(report_request):
+            offset = int(report_request.get("pageToken") or 0)
+            report = {"columnHeader": {"dimensions": ["ga:country"],
+                                       "metricHeader": {"metricHeaderEntries": [{"name": "ga:users"}]}},
+                      "data": {"rows": rows[offset:offset + 1000], "rowCount": len(rows), "isDataGolden": True}}
+            if offset + 1000 < len(rows):
+                report["nextPageToken"] = str(offset + 1000)
+            return report
+
+        def post(url, data=None, stream=False, retry_server_errors=True):
+            content = json.dumps({"reports": [get_report(r) for r in data["reportRequests"]]}).encode("utf-8")
+            response = Mock()
+            response.json.return_value = json.loads(content)
+            # NB: Small chunks, so that rows are read as they're iterated
+            response.iter_content.side_effect = lambda size: (content[i:i + 64] for i in range(0, len(content), 64))
+            return response
+
+        client.post = MagicMock(side_effect=post)
+        return client
+
+    @patch("singer.utils.now")
+    @patch("singer.write_state")
+    def test_streamed_responses_with_every_pipeline(self, mock_write_state, mock_now):
+        mock_now.return_value = utils.strptime_to_utc("2019-11-02T00:00:00Z")
+        schema = {"type": "object",
+                  "properties": {"ga:country": {"type": ["string", "null"]},
+                                 "ga:users": {"type": ["integer", "null"]}}}
+        output = {}
+        for config in [{}, {"stream_responses": True},
+                       {"stream_responses": True, "pipeline_depth": 2},
+                       {"stream_responses": True, "transform_processes": 2},
+                       {"stream_responses": True, "prefetch_pages": True}]:
+            client = self.get_client(config)
+            streams = [{"name": "users", "id": "users", "schema": schema, "metrics": ["ga:users"],
+                        "start_date": utils.strptime_to_utc("2019-11-01")}]
+            with patch("sys.stdout", new_callable=io.StringIO) as stdout:
+                sync_report_streams(client,
+                                    {"name": "users", "profile_id": "12345", "metrics": ["ga:users"],
+                                     "dimensions": ["ga:country"], "streams": streams},
+                                    utils.strptime_to_utc("2019-11-01"),
+                                    {},
+                                    config)
+            output[str(config)] = stdout.getvalue()
+
+        expected = output.pop("{}")
+        self.assertEqual(3000, len(expected.splitlines()))
+        for config, actual in output.items():
+            with self.subTest(config=config):
+                self.assertEqual(expected, actual)
+
+    def test_streamed_pages_give_remaining_page_tokens(self):
+        client = self.get_client({"stream_responses": True, "prefetch_pages": True})
+        report_request = {"profile_id": "12345",
+                          "report_date": utils.strptime_to_utc("2019-11-01"),
+                          "metrics": ["ga:users"],
+                          "dimensions": ["ga:country"]}
+        rows = [row for _, page in client.get_reports("users", [report_request])
+                for row in page["reports"][0]["data"]["rows"]]
+
+        self.assertEqual(3000, len(rows))
+        # NB: The first page streamed, then both remaining pages prefetched in one batch
+        self.assertEqual(2, client.post.call_count)
+        self.assertEqual(["1000", "2000"], [r["pageToken"] for r in client.post.call_args_list[1][0][1]["reportRequests"]])
+
+class TestDateWindows(unittest.TestCase):
+
+    @patch("singer.write_record")
+    @patch("singer.write_state")
+    def test_window_records_match_single_day_records(self, mock_write_state, mock_write_record):
+        def page(rows, report_date):
+            return {"reports": [{"columnHeader": {"dimensions": ["ga:date", "ga:country"],
+                                                  "metricHeader": {"metricHeaderEntries": [{"name": "ga:users"}]}},
+                                 "data": {"rows": [{"dimensions": d, "metrics": [{"values": ["1"]}]} for d in rows],
+                                          "isDataGolden": True}}],
+                    "profileId": "12345", "webPropertyId": "UA-1", "accountId": "1",
+                    "reportDate": report_date}
+        rows = [["20191101", "France"], ["20191103", "Peru"], ["20191101", "Peru"]]
+        window_client = MagicMock()
+        window_client.get_reports = MagicMock(return_value=[(0, page(rows, utils.strptime_to_utc("2019-11-01")))])
+        day_client = MagicMock()
+        day_client.get_report = MagicMock(side_effect=lambda name, profile_id, report_date, metrics, dimensions:
+                                          [page([r for r in rows if r[0] == report_date.strftime("%Y%m%d")], report_date)])
+
+        written = {}
+        for client, config in [(window_client, {"date_window_days": 7}), (day_client, {})]:
+            state = {}
+            mock_write_record.reset_mock()
+            sync_report(client,
+                        {"type": "object", "properties": {}},
+                        {"id": "123", "name": "test_report", "profile_id": "12345",
+                         "metrics": ["ga:users"], "dimensions": ["ga:date", "ga:country"]},
+                        utils.strptime_to_utc("2019-11-01"),
+                        utils.strptime_to_utc("2019-11-03"),
+                        state,
+                        config)
+            written[client] = sorted(c[0][1]["_sdc_record_hash"] for c in mock_write_record.call_args_list)
+            self.assertEqual({'bookmarks': {'123': {'12345': {'last_report_date': '2019-11-03'}}}}, state)
+
+        self.assertEqual(3, len(written[window_client]))
+        self.assertEqual(written[day_client], written[window_client])
+        self.assertEqual(1, window_client.get_reports.call_count)
+        window_request = window_client.get_reports.call_args[0][1][0]
+        self.assertEqual(utils.strptime_to_utc("2019-11-03"), window_request["end_date"])
+
+class TestSampledWindows(unittest.TestCase):
+
+    @staticmethod
+    def get_sampled_reports(name, report_requests):
+        report_request = report_requests[0]
+        days = (report_request["end_date"] - report_request["report_date"]).days + 1
+        data = {"rows": [], "isDataGolden": True}
+        if days > 2:
+            data.update({"samplesReadCounts": ["1000"], "samplingSpaceSizes": ["5000"]})
+        yield 0, {"reports": [{"columnHeader": {"dimensions": ["ga:date"],
+                                                "metricHeader": {"metricHeaderEntries": [{"name": "ga:users"}]}},
+                               "data": data}],
+                  "profileId": "12345"}
+
+    @patch("singer.write_record")
+    @patch("singer.write_state")
+    def test_sampled_windows_are_split_and_size_is_bookmarked(self, *args):
+        client = MagicMock()
+        client.get_reports = MagicMock(side_effect=self.get_sampled_reports)
+        client.get_report = MagicMock(side_effect=lambda name, profile_id, report_date, metrics, dimensions:
+                                      [page for _, page in self.get_sampled_reports(name, [{"report_date": report_date,
+                                                                                            "end_date": report_date}])])
+        state = {}
+        sync_report(client,
+                    {"type": "object", "properties": {}},
+                    {"id": "123", "name": "test_report", "profile_id": "12345",
+                     "metrics": ["ga:users"], "dimensions": ["ga:date"]},
+                    utils.strptime_to_utc("2019-11-01"),
+                    utils.strptime_to_utc("2019-11-08"),
+                    state,
+                    {"date_window_days": 7})
+
+        requested = [(r[0][1][0]["report_date"].day, r[0][1][0]["end_date"].day) for r in client.get_reports.call_args_list]
+        # 1-7 sampled, split into 1-4 (sampled) and 5-7 (sampled), then
+        # into 2 day windows, after which later windows start at 2 days
+        self.assertEqual([(1, 7), (1, 4), (1, 2), (3, 4), (5, 7), (5, 6)], requested)
+        # NB: Single days are requested through get_report
+        self.assertEqual([7, 8], [r[0][2].day for r in client.get_report.call_args_list])
+        self.assertEqual({'bookmarks': {'123': {'12345': {'last_report_date': '2019-11-08',
+                                                          'date_window_days': 2}}}},
+                         state)
+
+        client.get_reports.reset_mock()
+        sync_report(client,
+                    {"type": "object", "properties": {}},
+                    {"id": "123", "name": "test_report", "profile_id": "12345",
+                     "metrics": ["ga:users"], "dimensions": ["ga:date"]},
+                    utils.strptime_to_utc("2019-11-09"),
+                    utils.strptime_to_utc("2019-11-12"),
+                    state,
+                    {"date_window_days": 7})
+        requested = [(r[0][1][0]["report_date"].day, r[0][1][0]["end_date"].day) for r in client.get_reports.call_args_list]
+        self.assertEqual([(9, 10), (11, 12)], requested)
+        # NB: Without sampling, the next sync tries larger windows again
+        self.assertEqual(4, state['bookmarks']['123']['12345']['date_window_days'])
+
+    @patch("singer.write_record")
+    @patch("singer.write_state")
+    def test_sampled_single_days_keep_the_window_size(self, *args):
+        sampled_day = {"reports": [{"columnHeader": {"dimensions": ["ga:date"],
+                                                     "metricHeader": {"metricHeaderEntries": [{"name": "ga:users"}]}},
+                                    "data": {"rows": [], "isDataGolden": True,
+                                             "samplesReadCounts": ["1000"], "samplingSpaceSizes": ["5000"]}}],
+                       "profileId": "12345"}
+        client = MagicMock()
+        client.get_report = MagicMock(return_value=[sampled_day])
+        state = {'bookmarks': {'123': {'12345': {'date_window_days': 4}}}}
+        sync_report(client,
+                    {"type": "object", "properties": {}},
+                    {"id": "123", "name": "test_report", "profile_id": "12345",
+                     "metrics": ["ga:users"], "dimensions": ["ga:date"]},
+                    utils.strptime_to_utc("2019-11-08"),
+                    utils.strptime_to_utc("2019-11-08"),
+                    state,
+                    {"date_window_days": 7})
+        self.assertEqual(7, state['bookmarks']['123']['12345']['date_window_days'])
+
+    def test_shards_are_requested_in_one_batch(self):
+        def page(sampled):
+            data = {"rows": [], "isDataGolden": True}
+            if sampled:
+                data.update({"samplesReadCounts": ["1000"], "samplingSpaceSizes": ["5000"]})
+            return {"reports": [{"columnHeader": {"dimensions": ["ga:date", "ga:deviceCategory"],
+                                                  "metricHeader": {"metricHeaderEntries": [{"name": "ga:users"}]}},
+                                 "data": data}],
+                    "profileId": "12345"}
+        client = MagicMock()
+        client.get_report = MagicMock(return_value=[page(True)])
+        client.get_reports = MagicMock(side_effect=lambda name, report_requests:
+                                       [(index, page(False)) for index in range(len(report_requests))])
+        report = {"name": "test_report", "profile_id": "12345",
+                  "metrics": ["ga:users"], "dimensions": ["ga:date", "ga:deviceCategory"]}
+        day = utils.strptime_to_utc("2019-11-01")
+
+        [(_, pages)] = get_unsampled_pages(client, report, (day, day), WindowSizer(),
+                                           {"dimension": "ga:deviceCategory", "values": ["desktop", "mobile"]})
+
+        self.assertEqual(3, len(list(pages)))
+        self.assertEqual([["ga:deviceCategory==desktop",
+                           "ga:deviceCategory==mobile",
+                           "ga:deviceCategory!=desktop;ga:deviceCategory!=mobile"]],
+                         [[r["filters"] for r in call[0][1]] for call in client.get_reports.call_args_list])
+
+    def test_shard_filters_partition_selected_dimension(self):
+        report = {"dimensions": ["ga:date", "ga:deviceCategory"]}
+        sampling_shards = {"dimension": "ga:deviceCategory", "values": ["desktop", "a,b"]}
+
+        actual = get_shard_filters(report, sampling_shards)
+
+        self.assertEqual(["ga:deviceCategory==desktop",
+                          "ga:deviceCategory==a\\,b",
+                          "ga:deviceCategory!=desktop;ga:deviceCategory!=a\\,b"],
+                         actual)
+        self.assertEqual([], get_shard_filters({"dimensions": ["ga:date"]}, sampling_shards))
+        self.assertEqual([], get_shard_filters(report, {"dimension": "ga:deviceCategory", "values": []}))
+        self.assertEqual([], get_shard_filters(report, {"dimension": "ga:deviceCategory"}))
+
+    def test_sampled_day_is_kept_without_shard_values(self):
+        page = {"reports": [{"columnHeader": {"dimensions": ["ga:date", "ga:deviceCategory"],
+                                              "metricHeader": {"metricHeaderEntries": [{"name": "ga:users"}]}},
+                             "data": {"rows": [], "isDataGolden": True,
+                                      "samplesReadCounts": ["1000"], "samplingSpaceSizes": ["5000"]}}],
+                "profileId": "12345"}
+        client = MagicMock()
+        client.get_report = MagicMock(return_value=[page])
+        report = {"name": "test_report", "profile_id": "12345",
+                  "metrics": ["ga:users"], "dimensions": ["ga:date", "ga:deviceCategory"]}
+        day = utils.strptime_to_utc("2019-11-01")
+
+        [(_, pages)] = get_unsampled_pages(client, report, (day, day), WindowSizer(),
+                                           {"dimension": "ga:deviceCategory", "values": []})
+
+        self.assertEqual([page], list(pages))
+        self.assertEqual(1, client.get_report.call_count)
+        client.get_reports.assert_not_called()
+
+class TestDatetimeFormatting(unittest.TestCase):
+    def strptime_format(self, field_name, value):
+        return datetime.strptime(value, DATETIME_FORMATS[field_name]).strftime(utils.DATETIME_FMT)
+
+    def test_matches_strptime(self):
+        rng = random.Random(20191101)
+        start = datetime(1999, 1, 1)
+        values = {"ga:date": "%Y%m%d", "ga:dateHour": "%Y%m%d%H", "ga:dateHourMinute": "%Y%m%d%H%M"}
+        for _ in range(500):
+            moment = start + timedelta(minutes=rng.randint(0, 40 * 365 * 24 * 60))
+            for field_name, fmt in values.items():
+                value = moment.strftime(fmt)
+                self.assertEqual(self.strptime_format(field_name, value), format_datetime(field_name, value))
+
+    def test_invalid_values_fail_like_strptime(self):
+        for field_name, value in [("ga:date", "20191301"), ("ga:date", "20190230"), ("ga:dateHour", "2019110125"),
+                                  ("ga:dateHourMinute", "201911012360"), ("ga:date", "2019-1-1"), ("ga:date", "(other)")]:
+            with self.assertRaises(ValueError):
+                self.strptime_format(field_name, value)
+            with self.assertRaises(ValueError):
+                format_datetime(field_name, value)
+
+    def test_page_transform_only_formats_date_columns(self):
+        page = {"reports": [{"columnHeader": {"dimensions": ["ga:country", "ga:dateHour"]}}]}
+        transform_page_datetimes = get_datetimes_transform(page)
+        self.assertEqual({"ga:country": "20191101", "ga:dateHour": "2019-11-01T23:00:00.000000Z", "ga:users": "3"},
+                         transform_page_datetimes({"ga:country": "20191101", "ga:dateHour": "2019110123", "ga:users": "3"}))
+        self.assertEqual({"ga:country": "France", "ga:dateHour": ""},
+                         transform_page_datetimes({"ga:country": "France", "ga:dateHour": ""}))
+
 class TestRecordHashing(unittest.TestCase):
     """
     Canary test with a constant hash, if this value ever changes, it
@@ -70,3 +591,134 @@ class TestRecordHashing(unittest.TestCase):
 
         expected_hash = 'f107fb927002d0cbf257bd53c1a5d88bcb80e4e796f1812cf501107cf1f1544b'
         self.assertEqual(expected_hash, generate_sdc_record_hash(test_report, row, report_start, report_end))
+
+    def test_record_hasher_canary(self):
+        test_report = {"accountId": "12345",
+                       "webPropertyId": "AA-TESTID",
+                       "profileId": "67890",
+                       "reports": [{
+                           "columnHeader": {
+                               "dimensions": ["ga:dim1", "ga:dim2", "ga:apples", "ga:visitDateThing"]
+                           }
+                       }]}
+        row = {"dimensions": [5.23, "a string value", 123, "2019-04-03T00:11:40.04836Z"]}
+        hasher = RecordHasher(test_report, utils.strptime_to_utc("2019-11-20"), utils.strptime_to_utc("2019-11-25"))
+
+        expected_hash = 'f107fb927002d0cbf257bd53c1a5d88bcb80e4e796f1812cf501107cf1f1544b'
+        self.assertEqual(expected_hash, hasher.hash_row(row))
+
+    def test_record_hasher_matches_generate_sdc_record_hash(self):
+        rng = random.Random(20191120)
+        alphabet = 'ab"\\/\n\t\x00\x1f\u00e9\u4e2d\U0001f600 ,:[]'
+
+        def random_string():
+            return "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 8)))
+
+        def random_value():
+            return rng.choice([random_string(), random_string(), rng.randint(-5, 5), rng.random(), None])
+
+        for _ in range(500):
+            headers = ["ga:" + random_string() for _ in range(rng.randint(0, 7))]
+            if headers and rng.random() < 0.2:
+                headers.append(rng.choice(headers))
+            raw_report = {"accountId": random_string(),
+                          "webPropertyId": random_string(),
+                          "profileId": random_string(),
+                          "reports": [{"columnHeader": {"dimensions": headers}}]}
+            start_date = utils.strptime_to_utc("2019-11-01") + timedelta(days=rng.randint(0, 400))
+            end_date = start_date + timedelta(days=rng.randint(0, 7))
+            hasher = RecordHasher(raw_report, start_date, end_date)
+            for _ in range(5):
+                row = {"dimensions": [random_value() for _ in range(rng.randint(0, len(headers)))]}
+                if rng.random() < 0.1:
+                    row = {}
+                with self.subTest(raw_report=raw_report, row=row):
+                    self.assertEqual(generate_sdc_record_hash(raw_report, row, start_date, end_date),
+                                     hasher.hash_row(row))
+
+class TestColumnarPages(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(20191101)
+
+    def random_page(self):
+        rng = self.rng
+        dimensions = rng.sample(["ga:date", "ga:dateHour", "ga:country", "ga:city", "ga:source"], rng.randint(0, 3))
+        metrics = rng.sample(["ga:users", "ga:sessions", "ga:bounceRate", "ga:goal1Completions"], rng.randint(1, 4))
+        dimension_values = {"ga:date": ["20191101", "20191102"],
+                            "ga:dateHour": ["2019110100", "2019110123"]}
+        rows = []
+        for _ in range(rng.randint(0, 6)):
+            row = {"dimensions": [rng.choice(dimension_values.get(d, ["France", "(not set)", ""]))
+                                  for d in dimensions],
+                   "metrics": [{"values": [rng.choice(["0", "3", "1,234", "0.5", "", "abc"]) for _ in metrics]}]}
+            if rng.random() < 0.1:
+                row["metrics"][0]["values"].pop()
+            rows.append(row)
+        return {"reports": [{"columnHeader": {"dimensions": dimensions,
+                                              "metricHeader": {"metricHeaderEntries": [{"name": m} for m in metrics]}},
+                             "data": {"rows": rows}}],
+                "profileId": "12345",
+                "webPropertyId": "UA-1",
+                "accountId": "1",
+                "reportDate": utils.strptime_to_utc("2019-11-01")}, metrics
+
+    def random_schema(self, fields):
+        schema = generate_base_schema()
+        for field in fields:
+            if self.rng.random() < 0.8:
+                ga_type = self.rng.choice(["INTEGER", "FLOAT", "PERCENT", "STRING"])
+                schema["properties"][field] = type_to_schema(ga_type, field)
+        return schema
+
+    def transform(self, stream, raw_report, query_metrics, schema, page=None):
+        try:
+            return repr(list(transform_stream_records(stream, raw_report, query_metrics,
+                                                      compile_record_converter(schema), page)))
+        except Exception as ex: # pylint: disable=broad-except
+            return type(ex)
+
+    def test_columnar_records_match_row_records(self):
+        for _ in range(300):
+            raw_report, query_metrics = self.random_page()
+            page = ColumnarPage.from_raw_report(raw_report)
+            header = raw_report["reports"][0]["columnHeader"]
+            schema = self.random_schema(header["dimensions"] + query_metrics)
+            stream_metrics = self.rng.sample(query_metrics, self.rng.randint(1, len(query_metrics)))
+            stream = {"metrics": stream_metrics}
+            with self.subTest(raw_report=raw_report, stream=stream, schema=schema):
+                self.assertEqual(self.transform(stream, raw_report, query_metrics, schema),
+                                 self.transform(stream, raw_report, query_metrics, schema, page))
+
+    def test_columns_match_row_records(self):
+        for _ in range(300):
+            raw_report, query_metrics = self.random_page()
+            page = ColumnarPage.from_raw_report(raw_report)
+            header = raw_report["reports"][0]["columnHeader"]
+            schema = self.random_schema(header["dimensions"] + query_metrics)
+            stream_metrics = self.rng.sample(query_metrics, self.rng.randint(1, len(query_metrics)))
+            stream = {"metrics": stream_metrics}
+            fields = list(schema["properties"])
+            try:
+                records = list(transform_stream_records(stream, raw_report, query_metrics,
+                                                        compile_record_converter(schema)))
+            except Exception: # pylint: disable=broad-except
+                continue
+            with self.subTest(raw_report=raw_report, stream=stream, schema=schema):
+                self.assertEqual([[record.get(field) for record in records] for field in fields],
+                                 transform_stream_columns(stream, raw_report, query_metrics,
+                                                          compile_record_converter(schema), fields, page))
+
+    def test_records_are_built_for_pages_without_columns(self):
+        raw_report, _ = self.random_page()
+        raw_report["reports"][0]["data"]["rows"] = [{"metrics": [{"values": ["1"]}]}] * 2
+        raw_report["reports"][0]["columnHeader"] = {"metricHeader": {"metricHeaderEntries": [{"name": "ga:users"}]}}
+        schema = {"type": "object", "properties": {"profile_id": {"type": "string"}}}
+        records = list(transform_stream_records({"metrics": ["ga:users"]}, raw_report, ["ga:users"],
+                                                compile_record_converter(schema),
+                                                ColumnarPage.from_raw_report(raw_report)))
+        self.assertEqual([{"profile_id": "12345"}] * 2, records)
+
+    def test_duplicate_headers_use_the_row_path(self):
+        raw_report, _ = self.random_page()
+        raw_report["reports"][0]["columnHeader"]["dimensions"] = ["ga:country", "ga:country"]
+        self.assertIsNone(ColumnarPage.from_raw_report(raw_report))